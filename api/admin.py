@@ -1,18 +1,57 @@
 from typing import Type
 
 import adminactions.actions as actions
-from django.contrib import admin
+import structlog
+from django.contrib import admin, messages
 from django.contrib.admin import site
 from django.db.models import Model
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
 
 from api import models
-from api.services import trade_evaluator
+from api.tasks import sync_coingecko_ohlc_task
+
+logger = structlog.get_logger(__name__)
 
 
 @admin.action(description="Retrieve OHLC for instrument")
 def retrieve_ohlc(modeladmin, request, queryset):
-    for instrument in queryset:
-        trade_evaluator.sync_coingecko_ohlc(instrument)
+    instruments = list(queryset.exclude(coingecko_id=""))
+    if not instruments:
+        modeladmin.message_user(
+            request, "None of the instruments has a coingecko id", messages.WARNING
+        )
+        return
+
+    # The sync runs in a celery worker and reports its progress here
+    sync_history = models.SyncHistory.objects.create(
+        date=timezone.now(),
+        sync_type="coingecko_ohlc",
+        extra_data={"total": len(instruments), "done": 0},
+    )
+    try:
+        sync_coingecko_ohlc_task.delay(
+            [instrument.id for instrument in instruments], sync_history.id
+        )
+    except Exception as e:
+        logger.error("Error queueing the coingecko OHLC sync", exc_info=e)
+        sync_history.delete()
+        modeladmin.message_user(
+            request, "Couldn't queue the sync: {}".format(e), messages.ERROR
+        )
+        return
+
+    url = reverse("admin:api_synchistory_change", args=(sync_history.id,))
+    modeladmin.message_user(
+        request,
+        format_html(
+            'Syncing the OHLC of {} instruments, see <a href="{}">its progress</a>',
+            len(instruments),
+            url,
+        ),
+        messages.SUCCESS,
+    )
 
 
 def register_admin_for_models(
@@ -57,6 +96,11 @@ register_admin_for_models(
     models.DydxCandle, in_list_filter=["instrument", "period_start", "period_end"]
 )
 
+register_admin_for_models(
+    models.DydxCandleBackfill,
+    in_list_filter=["instrument", "resolution", "completed"],
+)
+
 register_admin_for_models(
     models.InvestmentCheck, in_list_filter=["instrument", "date", "dry_run"]
 )
@@ -71,6 +115,36 @@ register_admin_for_models(
     models.SyncHistory, in_list_filter=["date", "sync_type", "records_synced"]
 )
 
+register_admin_for_models(
+    models.EvaluationResult,
+    in_list_display=[
+        "__str__",
+        "instrument",
+        "base_instrument",
+        "date",
+        "corr_30d",
+        "corr_4d",
+        "base_diff_4d",
+        "open_position",
+        "error",
+        "reason",
+    ],
+    in_list_filter=["instrument", "date", "open_position", "error"],
+)
+
+register_admin_for_models(
+    models.RollingCorrelation,
+    in_list_display=[
+        "__str__",
+        "instrument",
+        "base_instrument",
+        "window",
+        "correlation",
+        "last_period_start",
+    ],
+    in_list_filter=["instrument", "window"],
+)
+
 register_admin_for_models(models.Settings)
 
 
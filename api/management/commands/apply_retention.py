@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from api.services.retention import apply_retention
+
+
+class Command(BaseCommand):
+    help = (
+        "Downsamples and deletes the candles and history past their retention, see "
+        "DYDX_CANDLE_RETENTION_DAYS"
+    )
+
+    def handle(self, *args, **options):
+        for table, num_deleted in apply_retention().items():
+            self.stdout.write("{}: deleted {} rows".format(table, num_deleted))
@@ -0,0 +1,114 @@
+import datetime as dt
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api import models
+from api.services.backfill import BACKFILL_BATCH_SIZE, backfill_dydx_candles
+from api.services.dydx_models import CANDLE_RESOLUTIONS
+from api.services.dydx_trader import get_trader
+from api.services.throttle import get_rate_limiter
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfills historical dydx candles, resuming from the last checkpoint of "
+        "interrupted runs"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--symbols",
+            nargs="+",
+            help="Instrument symbols to backfill. Defaults to every instrument with a dydx market.",
+        )
+        parser.add_argument(
+            "--resolutions",
+            nargs="+",
+            default=["1DAY"],
+            choices=list(CANDLE_RESOLUTIONS),
+        )
+        parser.add_argument(
+            "--since",
+            required=True,
+            type=dt.date.fromisoformat,
+            help="Oldest date to backfill, e.g. 2021-01-01",
+        )
+        parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        instruments = models.Instrument.objects.exclude(dydx_market_id="")
+        if options["symbols"]:
+            instruments = instruments.filter(symbol__in=options["symbols"])
+            missing = set(options["symbols"]) - {i.symbol for i in instruments}
+            if missing:
+                raise CommandError(
+                    "Unknown or non-dydx instruments: {}".format(", ".join(missing))
+                )
+
+        start = timezone.make_aware(
+            dt.datetime.combine(options["since"], dt.time()), dt.timezone.utc
+        )
+        trader = get_trader()
+        rate_limiter = get_rate_limiter(
+            settings.DYDX_API_HOST, settings.DYDX_REQUESTS_PER_SECOND
+        )
+
+        total_rows = 0
+        total_start_time = time.perf_counter()
+        for instrument in instruments:
+            for resolution in options["resolutions"]:
+                records_before = (
+                    models.DydxCandleBackfill.objects.filter(
+                        instrument=instrument, resolution=resolution
+                    )
+                    .values_list("records_synced", flat=True)
+                    .first()
+                    or 0
+                )
+
+                start_time = time.perf_counter()
+                backfill = backfill_dydx_candles(
+                    trader,
+                    instrument,
+                    resolution,
+                    start,
+                    batch_size=options["batch_size"],
+                    rate_limiter=rate_limiter,
+                )
+                elapsed = time.perf_counter() - start_time
+                rows = backfill.records_synced - records_before
+                total_rows += rows
+
+                self.stdout.write(
+                    "{} {}: {} rows in {:.1f}s ({:.0f} rows/sec)".format(
+                        instrument.symbol,
+                        resolution,
+                        rows,
+                        elapsed,
+                        rows / elapsed if elapsed else 0,
+                    )
+                )
+
+        total_elapsed = time.perf_counter() - total_start_time
+        rows_per_second = total_rows / total_elapsed if total_elapsed else 0
+        models.SyncHistory.objects.create(
+            date=timezone.now(),
+            records_synced=total_rows,
+            sync_type="dydx_backfill",
+            extra_data={
+                "since": options["since"].isoformat(),
+                "resolutions": options["resolutions"],
+                "seconds": total_elapsed,
+                "rows_per_second": rows_per_second,
+            },
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Backfilled {} rows in {:.1f}s ({:.0f} rows/sec)".format(
+                    total_rows, total_elapsed, rows_per_second
+                )
+            )
+        )
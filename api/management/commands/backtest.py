@@ -0,0 +1,106 @@
+import datetime as dt
+
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api import models
+from api.services.backtest import load_backtest_prices, run_backtest
+from api.services.dydx_models import CANDLE_RESOLUTIONS
+from api.services.sync import BASE_SYMBOL
+from api.services.trade_evaluator import DEFAULT_STRATEGY, StrategyParams
+
+
+class Command(BaseCommand):
+    help = "Replays the evaluate_trade strategy over the synced candles"
+
+    # Strategy params can be given several times by subclasses
+    strategy_nargs = None
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--symbols",
+            nargs="+",
+            help="Instrument symbols to trade. Defaults to every enabled instrument.",
+        )
+        parser.add_argument(
+            "--since",
+            required=True,
+            type=dt.date.fromisoformat,
+            help="First date of the backtest, e.g. 2021-01-01",
+        )
+        parser.add_argument(
+            "--until",
+            type=dt.date.fromisoformat,
+            help="Date the backtest ends, exclusive. Defaults to today.",
+        )
+        parser.add_argument(
+            "--resolution", default="1DAY", choices=list(CANDLE_RESOLUTIONS)
+        )
+        parser.add_argument("--position-size", type=float, default=200)
+        parser.add_argument("--take-profit", type=float, default=0.05)
+        parser.add_argument("--stop-loss", type=float, default=0.05)
+        parser.add_argument("--max-holding-periods", type=int, default=30)
+        parser.add_argument("--fee-rate", type=float, default=0.0)
+
+        for field in StrategyParams._fields:
+            if field == "resolution":
+                # The periods of the windows are the candles loaded with --resolution
+                continue
+            default = getattr(DEFAULT_STRATEGY, field)
+            parser.add_argument(
+                "--{}".format(field.replace("_", "-")),
+                nargs=self.strategy_nargs,
+                type=type(default),
+                default=default if self.strategy_nargs is None else [default],
+            )
+
+    def load_prices(self, options) -> tuple[pd.DataFrame, pd.Series]:
+        base = models.Instrument.objects.get(symbol=BASE_SYMBOL)
+        instruments = models.Instrument.objects.exclude(id=base.id)
+        if options["symbols"]:
+            instruments = instruments.filter(symbol__in=options["symbols"])
+            missing = set(options["symbols"]) - {i.symbol for i in instruments}
+            if missing:
+                raise CommandError("Unknown instruments: {}".format(", ".join(missing)))
+        else:
+            instruments = instruments.filter(enable_dydx_trades=True)
+        instruments = list(instruments)
+
+        start, end = (
+            timezone.make_aware(dt.datetime.combine(date, dt.time()), dt.timezone.utc)
+            for date in (options["since"], options["until"] or dt.date.today())
+        )
+        prices = load_backtest_prices(
+            instruments + [base], start, end, options["resolution"]
+        )
+        return prices.drop(columns=base.symbol), prices[base.symbol]
+
+    def backtest_kwargs(self, options) -> dict:
+        return {
+            "position_size": options["position_size"],
+            "take_profit": options["take_profit"],
+            "stop_loss": options["stop_loss"],
+            "max_holding_periods": options["max_holding_periods"],
+            "fee_rate": options["fee_rate"],
+        }
+
+    def handle(self, *args, **options):
+        closes, base_closes = self.load_prices(options)
+        params = StrategyParams(
+            **{field: options[field] for field in StrategyParams._fields}
+        )
+
+        result = run_backtest(
+            closes, base_closes, params=params, **self.backtest_kwargs(options)
+        )
+
+        if result.num_trades:
+            self.stdout.write(
+                result.trades.groupby("instrument")["pnl"]
+                .agg(["count", "sum"])
+                .sort_values("sum")
+                .to_string()
+            )
+        for key, value in result.summary().items():
+            self.stdout.write("{}: {}".format(key, value))
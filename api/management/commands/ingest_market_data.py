@@ -0,0 +1,46 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api import models
+from api.services.market_data import MarketDataWorker
+
+
+class Command(BaseCommand):
+    help = (
+        "Streams the dydx index prices and trades into the live price cache, and "
+        "writes the completed bars to DydxCandle. Runs until interrupted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default=settings.DYDX_WS_URL)
+        parser.add_argument(
+            "--markets",
+            nargs="+",
+            help="Defaults to the markets of every instrument with a dydx market",
+        )
+        parser.add_argument(
+            "--flush-interval", type=float, default=settings.MARKET_DATA_FLUSH_SECONDS
+        )
+
+    def handle(self, *args, **options):
+        instruments = models.Instrument.objects.exclude(dydx_market_id="")
+        if options["markets"]:
+            instruments = instruments.filter(dydx_market_id__in=options["markets"])
+        instrument_ids = {
+            instrument.dydx_market_id: instrument.id for instrument in instruments
+        }
+        self.stdout.write(
+            "Ingesting {} markets from {}".format(len(instrument_ids), options["url"])
+        )
+
+        worker = MarketDataWorker(
+            options["url"],
+            instrument_ids,
+            flush_interval=options["flush_interval"],
+        )
+        try:
+            asyncio.run(worker.run())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.services import partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Partitions the dydx candle table by resolution and month on postgres, or "
+        "creates the partitions of the coming months once it is"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--months-ahead", type=int, default=3)
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Partitioning requires postgres")
+
+        resolutions = sorted(
+            set(settings.DYDX_CANDLE_RESOLUTIONS)
+            | set(settings.DYDX_CANDLE_ROLLUPS)
+            | set(settings.MARKET_DATA_RESOLUTIONS)
+        )
+        if not partitions.is_partitioned():
+            partitions.convert_to_partitioned(resolutions, options["months_ahead"])
+            self.stdout.write("Partitioned {}".format(partitions.TABLE))
+        num_created = partitions.ensure_partitions(resolutions, options["months_ahead"])
+        self.stdout.write("Created {} partitions".format(num_created))
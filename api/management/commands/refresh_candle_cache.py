@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.services.candle_cache import get_candle_cache
+from api.services.dydx_models import CANDLE_RESOLUTIONS
+
+
+class Command(BaseCommand):
+    help = "Exports new dydx candles into the memory-mapped candle cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--resolutions",
+            nargs="+",
+            default=["1DAY"],
+            choices=list(CANDLE_RESOLUTIONS),
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Export everything from scratch, picking up updated and deleted candles",
+        )
+
+    def handle(self, *args, **options):
+        candle_cache = get_candle_cache()
+        if candle_cache is None:
+            raise CommandError("CANDLE_CACHE_DIR isn't set")
+
+        for resolution in options["resolutions"]:
+            if options["rebuild"]:
+                num_exported = candle_cache.rebuild(resolution)
+            else:
+                num_exported = candle_cache.refresh(resolution)
+            self.stdout.write(
+                "{}: exported {} candles".format(resolution, num_exported)
+            )
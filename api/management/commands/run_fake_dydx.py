@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.services.fake_dydx import FakeDydxExchange, FakeDydxWebsocket
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves a local fake dydx exchange. Point DYDX_API_HOST and WEB3_PROVIDER_URL "
+        "at it to run the sync and trades offline, and DYDX_WS_URL at its websocket "
+        "for the market data worker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=8001)
+        parser.add_argument("--websocket-port", type=int, default=8002)
+        parser.add_argument("--websocket-interval", type=float, default=1.0)
+        parser.add_argument("--num-markets", type=int, default=0)
+        parser.add_argument("--latency", type=float, default=0.0)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+        parser.add_argument("--fill-delay", type=float, default=0.0)
+        parser.add_argument("--cancel-markets", nargs="+", default=[])
+        parser.add_argument("--reject-markets", nargs="+", default=[])
+
+    def handle(self, *args, **options):
+        exchange = FakeDydxExchange(
+            num_markets=options["num_markets"],
+            latency=options["latency"],
+            error_rate=options["error_rate"],
+            fill_delay=options["fill_delay"],
+            cancel_markets=set(options["cancel_markets"]),
+            reject_markets=set(options["reject_markets"]),
+        ).start(options["port"])
+        websocket = FakeDydxWebsocket(
+            exchange, interval=options["websocket_interval"]
+        ).start(options["websocket_port"])
+        self.stdout.write(
+            "Serving {} on {} and {}".format(
+                len(exchange.markets), exchange.host, websocket.url
+            )
+        )
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            websocket.stop()
+            exchange.stop()
@@ -0,0 +1,44 @@
+from api.management.commands import backtest
+from api.services.sweep import make_grid, run_sweep
+from api.services.trade_evaluator import StrategyParams
+
+
+class Command(backtest.Command):
+    help = (
+        "Backtests every combination of the given strategy params in parallel, "
+        "e.g. --min-corr 0.4 0.5 0.6 --corr-window 14 30, and ranks them"
+    )
+
+    strategy_nargs = "+"
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            "--workers", type=int, help="Defaults to the number of CPUs"
+        )
+        parser.add_argument("--rank-by", default="total_pnl")
+        parser.add_argument("--top", type=int, help="Only show the best N param sets")
+
+    def handle(self, *args, **options):
+        closes, base_closes = self.load_prices(options)
+        grid = make_grid(
+            **{
+                field: options[field]
+                for field in StrategyParams._fields
+                if field != "resolution"
+            },
+            resolution=[options["resolution"]],
+        )
+
+        results = run_sweep(
+            closes,
+            base_closes,
+            grid,
+            max_workers=options["workers"],
+            rank_by=options["rank_by"],
+            **self.backtest_kwargs(options),
+        )
+
+        if options["top"]:
+            results = results.head(options["top"])
+        self.stdout.write(results.to_string())
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.2 on 2026-10-18 19:35
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def delete_duplicate_candles(apps, schema_editor):
+    """
+    Keeps the last row of each (instrument, resolution, period_start), which was
+    fetched after its period had the most trades
+    """
+    DydxCandle = apps.get_model("api", "DydxCandle")
+    duplicates = (
+        DydxCandle.objects.values("instrument_id", "resolution", "period_start")
+        .annotate(last_id=Max("id"), num_rows=Count("id"))
+        .filter(num_rows__gt=1)
+    )
+    for duplicate in duplicates:
+        DydxCandle.objects.filter(
+            instrument_id=duplicate["instrument_id"],
+            resolution=duplicate["resolution"],
+            period_start=duplicate["period_start"],
+        ).exclude(id=duplicate["last_id"]).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0012_alter_synchistory_sync_type"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_candles, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="dydxcandle",
+            constraint=models.UniqueConstraint(
+                fields=("instrument", "resolution", "period_start"),
+                name="unique_dydx_candle",
+            ),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 4.2.2 on 2026-10-18 19:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0013_dydxcandle_unique_dydx_candle"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="synchistory",
+            name="sync_type",
+            field=models.CharField(
+                choices=[
+                    ("prices", "Prices"),
+                    ("trades", "Trades"),
+                    ("dydx_candles", "DyDx Candles"),
+                    ("dydx_backfill", "DyDx Candles Backfill"),
+                ],
+                default="prices",
+                max_length=20,
+            ),
+        ),
+        migrations.CreateModel(
+            name="DydxCandleBackfill",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("resolution", models.CharField(max_length=10)),
+                (
+                    "start",
+                    models.DateTimeField(help_text="Oldest period to backfill back to"),
+                ),
+                (
+                    "cursor",
+                    models.DateTimeField(
+                        blank=True,
+                        help_text="Oldest period_start written so far",
+                        null=True,
+                    ),
+                ),
+                ("completed", models.BooleanField(default=False)),
+                ("records_synced", models.IntegerField(default=0)),
+                ("date_created", models.DateTimeField(auto_now_add=True)),
+                ("date_modified", models.DateTimeField(auto_now=True)),
+                (
+                    "instrument",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="api.instrument"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="dydxcandlebackfill",
+            constraint=models.UniqueConstraint(
+                fields=("instrument", "resolution"), name="unique_dydx_candle_backfill"
+            ),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.2 on 2026-10-18 19:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0014_dydxcandlebackfill"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RollingCorrelation",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("resolution", models.CharField(max_length=10)),
+                ("window", models.IntegerField(help_text="Number of periods")),
+                ("count", models.IntegerField(default=0)),
+                ("sum_x", models.FloatField(default=0)),
+                ("sum_y", models.FloatField(default=0)),
+                ("sum_xx", models.FloatField(default=0)),
+                ("sum_yy", models.FloatField(default=0)),
+                ("sum_xy", models.FloatField(default=0)),
+                ("buffer", models.JSONField(blank=True, default=list)),
+                ("last_period_start", models.DateTimeField(blank=True, null=True)),
+                ("last_period_end", models.DateTimeField(blank=True, null=True)),
+                ("correlation", models.FloatField(blank=True, null=True)),
+                ("date_modified", models.DateTimeField(auto_now=True)),
+                (
+                    "base_instrument",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="base_rolling_correlations",
+                        to="api.instrument",
+                    ),
+                ),
+                (
+                    "instrument",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="rolling_correlations",
+                        to="api.instrument",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="rollingcorrelation",
+            constraint=models.UniqueConstraint(
+                fields=("instrument", "base_instrument", "resolution", "window"),
+                name="unique_rolling_correlation",
+            ),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.2 on 2026-10-18 20:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0015_rollingcorrelation"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="coingeckoinstrumentohlc",
+            index=models.Index(
+                fields=["instrument", "date"], name="coingecko_ohlc_date_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="dydxcandle",
+            index=models.Index(
+                fields=["instrument", "resolution", "period_end"],
+                include=("period_start", "close"),
+                name="dydx_candle_end_idx",
+            ),
+        ),
+    ]
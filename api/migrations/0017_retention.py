@@ -0,0 +1,31 @@
+# Generated by Django 4.2.2 on 2026-10-18 20:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0016_candle_indexes"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="synchistory",
+            name="sync_type",
+            field=models.CharField(
+                choices=[
+                    ("prices", "Prices"),
+                    ("trades", "Trades"),
+                    ("dydx_candles", "DyDx Candles"),
+                    ("dydx_backfill", "DyDx Candles Backfill"),
+                    ("retention", "Retention"),
+                ],
+                default="prices",
+                max_length=20,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="synchistory",
+            index=models.Index(fields=["date"], name="sync_history_date_idx"),
+        ),
+    ]
@@ -0,0 +1,118 @@
+# Generated by Django 4.2.2 on 2026-10-18 20:32
+
+import datetime as dt
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_evaluation_results(apps, schema_editor):
+    """Copies the results that do_trades kept in the extra_data of its sync history"""
+    Instrument = apps.get_model("api", "Instrument")
+    SyncHistory = apps.get_model("api", "SyncHistory")
+    EvaluationResult = apps.get_model("api", "EvaluationResult")
+
+    instruments = {
+        instrument.symbol: instrument for instrument in Instrument.objects.all()
+    }
+    for sync_history in SyncHistory.objects.filter(sync_type="trades").iterator():
+        results = []
+        for result in sync_history.extra_data.values():
+            if not isinstance(result, dict):
+                continue
+            instrument = instruments.get(result.get("instr"))
+            base = instruments.get(result.get("base"))
+            if instrument is None or base is None:
+                continue
+            date = dt.datetime.fromisoformat(result["date"])
+            if timezone.is_naive(date):
+                date = timezone.make_aware(date)
+            results.append(
+                EvaluationResult(
+                    sync_history=sync_history,
+                    instrument=instrument,
+                    base_instrument=base,
+                    date=date,
+                    corr_30d=result.get("corr_30d"),
+                    corr_4d=result.get("corr_4d"),
+                    base_diff_4d=result.get("base_diff_4d"),
+                    open_position=result.get("open_position", False),
+                    error=result.get("error", False),
+                    reason=result.get("reason", ""),
+                )
+            )
+        EvaluationResult.objects.bulk_create(results, batch_size=500)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0017_retention"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EvaluationResult",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "date",
+                    models.DateTimeField(help_text="Date the trade was evaluated at"),
+                ),
+                ("resolution", models.CharField(default="1DAY", max_length=10)),
+                ("corr_30d", models.FloatField(blank=True, null=True)),
+                ("corr_4d", models.FloatField(blank=True, null=True)),
+                ("base_diff_4d", models.FloatField(blank=True, null=True)),
+                ("open_position", models.BooleanField(default=False)),
+                ("error", models.BooleanField(default=False)),
+                ("reason", models.CharField(blank=True, default="", max_length=100)),
+                (
+                    "base_instrument",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="base_evaluation_results",
+                        to="api.instrument",
+                    ),
+                ),
+                (
+                    "instrument",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="evaluation_results",
+                        to="api.instrument",
+                    ),
+                ),
+                (
+                    "sync_history",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="evaluation_results",
+                        to="api.synchistory",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["instrument", "date"], name="evaluation_instr_date_idx"
+                    ),
+                    models.Index(fields=["date"], name="evaluation_date_idx"),
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="evaluationresult",
+            constraint=models.UniqueConstraint(
+                fields=("sync_history", "instrument"), name="unique_evaluation_result"
+            ),
+        ),
+        migrations.RunPython(backfill_evaluation_results, migrations.RunPython.noop),
+    ]
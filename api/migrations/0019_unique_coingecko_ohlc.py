@@ -0,0 +1,54 @@
+# Generated by Django 4.2.2 on 2026-10-18 20:35
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def delete_duplicate_ohlc(apps, schema_editor):
+    """Keeps the first row of each (instrument, date), which the sync never updated"""
+    CoingeckoInstrumentOHLC = apps.get_model("api", "CoingeckoInstrumentOHLC")
+    duplicates = (
+        CoingeckoInstrumentOHLC.objects.values("instrument_id", "date")
+        .annotate(first_id=Min("id"), num_rows=Count("id"))
+        .filter(num_rows__gt=1)
+    )
+    for duplicate in duplicates:
+        CoingeckoInstrumentOHLC.objects.filter(
+            instrument_id=duplicate["instrument_id"], date=duplicate["date"]
+        ).exclude(id=duplicate["first_id"]).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0018_evaluation_result"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="coingeckoinstrumentohlc",
+            name="coingecko_ohlc_date_idx",
+        ),
+        migrations.AlterField(
+            model_name="synchistory",
+            name="sync_type",
+            field=models.CharField(
+                choices=[
+                    ("prices", "Prices"),
+                    ("trades", "Trades"),
+                    ("dydx_candles", "DyDx Candles"),
+                    ("dydx_backfill", "DyDx Candles Backfill"),
+                    ("retention", "Retention"),
+                    ("coingecko_ohlc", "Coingecko OHLC"),
+                ],
+                default="prices",
+                max_length=20,
+            ),
+        ),
+        migrations.RunPython(delete_duplicate_ohlc, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="coingeckoinstrumentohlc",
+            constraint=models.UniqueConstraint(
+                fields=("instrument", "date"), name="unique_coingecko_ohlc"
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.2 on 2026-10-18 21:03
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0019_unique_coingecko_ohlc"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dydxcandle",
+            name="updated_at",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now, help_text="Date of the last write"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="dydxcandle",
+            index=models.Index(
+                fields=["instrument", "resolution", "updated_at"],
+                name="dydx_candle_updated_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.2 on 2026-10-18 21:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0020_candle_updated_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="rollingcorrelation",
+            name="candles_read_at",
+            field=models.DateTimeField(
+                blank=True, help_text="When the candles were last read", null=True
+            ),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
 
@@ -33,6 +34,13 @@ class CoingeckoInstrumentOHLC(models.Model):
         help_text="Closing price",
     )
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["instrument", "date"], name="unique_coingecko_ohlc"
+            )
+        ]
+
     def __str__(self):
         return "OHLC of {} on {}".format(self.instrument, self.date)
 
@@ -57,11 +65,67 @@ class DydxCandle(models.Model):
         null=False,
         help_text="Closing price",
     )
+    # Not auto_now, which bulk and raw SQL writes skip, so every writer sets it
+    updated_at = models.DateTimeField(
+        default=timezone.now, null=False, help_text="Date of the last write"
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["instrument", "resolution", "period_start"],
+                name="unique_dydx_candle",
+            )
+        ]
+        indexes = [
+            # Lookups by period_end, e.g. fetch_candles. Lookups by period_start use the
+            # unique constraint. The included columns are what the price store reads,
+            # so postgres can answer from the index alone.
+            models.Index(
+                fields=["instrument", "resolution", "period_end"],
+                include=["period_start", "close"],
+                name="dydx_candle_end_idx",
+            ),
+            # Refreshes of the price store, which read the candles written since
+            models.Index(
+                fields=["instrument", "resolution", "updated_at"],
+                name="dydx_candle_updated_idx",
+            ),
+        ]
 
     def __str__(self):
         return "DyDx Candle of {} on {}".format(self.instrument, self.period_end)
 
 
+class DydxCandleBackfill(models.Model):
+    """Checkpoint of a historical candle backfill, so that interrupted runs resume"""
+
+    instrument = models.ForeignKey(Instrument, on_delete=models.CASCADE, null=False)
+    resolution = models.CharField(max_length=10, null=False)
+    start = models.DateTimeField(
+        help_text="Oldest period to backfill back to", null=False
+    )
+    cursor = models.DateTimeField(
+        help_text="Oldest period_start written so far", null=True, blank=True
+    )
+    completed = models.BooleanField(default=False, null=False)
+    records_synced = models.IntegerField(null=False, default=0)
+
+    date_created = models.DateTimeField(null=False, auto_now_add=True)
+    date_modified = models.DateTimeField(null=False, auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["instrument", "resolution"],
+                name="unique_dydx_candle_backfill",
+            )
+        ]
+
+    def __str__(self):
+        return "Backfill of {} {} candles".format(self.instrument, self.resolution)
+
+
 class InvestmentCheck(models.Model):
     instrument = models.ForeignKey(Instrument, on_delete=models.CASCADE, null=False)
     date = models.DateTimeField(null=False)
@@ -75,6 +139,9 @@ class SyncHistory(models.Model):
         ("prices", "Prices"),
         ("trades", "Trades"),
         ("dydx_candles", "DyDx Candles"),
+        ("dydx_backfill", "DyDx Candles Backfill"),
+        ("retention", "Retention"),
+        ("coingecko_ohlc", "Coingecko OHLC"),
     )
 
     date = models.DateTimeField(null=False)
@@ -82,6 +149,56 @@ class SyncHistory(models.Model):
     sync_type = models.CharField(max_length=20, choices=SYNC_CHOICES, default="prices")
     extra_data = models.JSONField(null=False, blank=True, default=dict)
 
+    class Meta:
+        indexes = [models.Index(fields=["date"], name="sync_history_date_idx")]
+
+
+class EvaluationResult(models.Model):
+    """The evaluate_trade result of one instrument in a do_trades run"""
+
+    sync_history = models.ForeignKey(
+        SyncHistory,
+        on_delete=models.CASCADE,
+        null=False,
+        related_name="evaluation_results",
+    )
+    instrument = models.ForeignKey(
+        Instrument,
+        on_delete=models.CASCADE,
+        null=False,
+        related_name="evaluation_results",
+    )
+    base_instrument = models.ForeignKey(
+        Instrument,
+        on_delete=models.CASCADE,
+        null=False,
+        related_name="base_evaluation_results",
+    )
+    date = models.DateTimeField(null=False, help_text="Date the trade was evaluated at")
+    resolution = models.CharField(max_length=10, null=False, default="1DAY")
+    corr_30d = models.FloatField(null=True, blank=True)
+    corr_4d = models.FloatField(null=True, blank=True)
+    base_diff_4d = models.FloatField(null=True, blank=True)
+    open_position = models.BooleanField(default=False, null=False)
+    error = models.BooleanField(default=False, null=False)
+    reason = models.CharField(max_length=100, null=False, blank=True, default="")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sync_history", "instrument"], name="unique_evaluation_result"
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["instrument", "date"], name="evaluation_instr_date_idx"
+            ),
+            models.Index(fields=["date"], name="evaluation_date_idx"),
+        ]
+
+    def __str__(self):
+        return "{} evaluation at {}".format(self.instrument, self.date)
+
 
 class Position(models.Model):
     instrument = models.ForeignKey(
@@ -102,5 +219,58 @@ class Position(models.Model):
     date_modified = models.DateTimeField(null=False, auto_now=True)
 
 
+class RollingCorrelation(models.Model):
+    """
+    Running sums of the closes of an instrument (x) and a base instrument (y) over the
+    last `window` periods, so the correlation can be updated as each candle lands.
+    """
+
+    instrument = models.ForeignKey(
+        Instrument,
+        on_delete=models.CASCADE,
+        null=False,
+        related_name="rolling_correlations",
+    )
+    base_instrument = models.ForeignKey(
+        Instrument,
+        on_delete=models.CASCADE,
+        null=False,
+        related_name="base_rolling_correlations",
+    )
+    resolution = models.CharField(max_length=10, null=False)
+    window = models.IntegerField(null=False, help_text="Number of periods")
+
+    count = models.IntegerField(null=False, default=0)
+    sum_x = models.FloatField(null=False, default=0)
+    sum_y = models.FloatField(null=False, default=0)
+    sum_xx = models.FloatField(null=False, default=0)
+    sum_yy = models.FloatField(null=False, default=0)
+    sum_xy = models.FloatField(null=False, default=0)
+    # [period_start in ns, x, y] of the candles in the window, oldest first
+    buffer = models.JSONField(null=False, blank=True, default=list)
+
+    last_period_start = models.DateTimeField(null=True, blank=True)
+    last_period_end = models.DateTimeField(null=True, blank=True)
+    correlation = models.FloatField(null=True, blank=True)
+    candles_read_at = models.DateTimeField(
+        null=True, blank=True, help_text="When the candles were last read"
+    )
+
+    date_modified = models.DateTimeField(null=False, auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["instrument", "base_instrument", "resolution", "window"],
+                name="unique_rolling_correlation",
+            )
+        ]
+
+    def __str__(self):
+        return "{} period correlation of {} with {}".format(
+            self.window, self.instrument, self.base_instrument
+        )
+
+
 class Settings(models.Model):
     enable_trades = models.BooleanField(default=False, null=False)
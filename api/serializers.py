@@ -24,3 +24,12 @@ class SyncHistorySerializer(serializers.ModelSerializer):
     class Meta:
         model = models.SyncHistory
         fields = "__all__"
+
+
+class EvaluationResultSerializer(serializers.ModelSerializer):
+    instrument = serializers.SlugRelatedField(slug_field="symbol", read_only=True)
+    base_instrument = serializers.SlugRelatedField(slug_field="symbol", read_only=True)
+
+    class Meta:
+        model = models.EvaluationResult
+        fields = "__all__"
@@ -0,0 +1,105 @@
+import datetime as dt
+
+import structlog
+from django.db import transaction
+from django.utils import timezone
+
+from api import models
+from api.services.dydx_models import CANDLE_RESOLUTIONS
+from api.services.dydx_trader import CANDLES_PAGE_LIMIT, DydxTrader
+from api.services.sync import (
+    dydx_candle_from_api,
+    format_dydx_timestamp,
+    upsert_dydx_candles,
+)
+from api.services.throttle import Limiter
+
+logger = structlog.get_logger(__name__)
+
+# Number of candles buffered before they are written and the checkpoint advances
+BACKFILL_BATCH_SIZE = 5000
+
+
+def backfill_dydx_candles(
+    trader: DydxTrader,
+    instrument: models.Instrument,
+    resolution: str,
+    start: dt.datetime,
+    batch_size: int = BACKFILL_BATCH_SIZE,
+    rate_limiter: Limiter | None = None,
+) -> models.DydxCandleBackfill:
+    """
+    Pages backwards through an instrument's candle history until `start`.
+
+    Progress is checkpointed in DydxCandleBackfill whenever a batch is written, in the
+    same transaction as the batch, so an interrupted backfill resumes from the oldest
+    candle it wrote. Asking for an older `start` than a previous backfill extends it.
+
+    Returns:
+        models.DydxCandleBackfill: The checkpoint
+    """
+    delta = CANDLE_RESOLUTIONS[resolution]
+    now = timezone.now()
+
+    backfill, _ = models.DydxCandleBackfill.objects.get_or_create(
+        instrument=instrument, resolution=resolution, defaults={"start": start}
+    )
+    if start < backfill.start:
+        backfill.start = start
+        backfill.completed = False
+        backfill.save()
+
+    if backfill.completed:
+        logger.info("Backfill already completed", backfill=str(backfill))
+        return backfill
+
+    buffer: list[models.DydxCandle] = []
+
+    def flush() -> None:
+        with transaction.atomic():
+            upsert_dydx_candles(buffer)
+            backfill.cursor = min(candle.period_start for candle in buffer)
+            backfill.records_synced += len(buffer)
+            backfill.save()
+        logger.info(
+            "Wrote backfill batch",
+            backfill=str(backfill),
+            cursor=backfill.cursor.isoformat(),
+        )
+        buffer.clear()
+
+    cursor = backfill.cursor
+    while cursor is None or cursor > backfill.start:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        page = trader.get_candles(
+            instrument.dydx_market_id,
+            resolution,
+            to_iso=format_dydx_timestamp(cursor) if cursor else None,
+            limit=CANDLES_PAGE_LIMIT,
+        )
+        candles = [
+            candle
+            for candle in (
+                dydx_candle_from_api(instrument, candle) for candle in page.candles
+            )
+            if candle.period_start + delta <= now
+            and candle.period_start >= backfill.start
+            and (cursor is None or candle.period_start < cursor)
+        ]
+        if not candles:
+            # Either start or the beginning of the market's history has been reached
+            break
+
+        buffer.extend(candles)
+        cursor = min(candle.period_start for candle in candles)
+        if len(buffer) >= batch_size:
+            flush()
+
+    if buffer:
+        flush()
+
+    backfill.completed = True
+    backfill.save()
+    return backfill
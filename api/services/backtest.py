@@ -0,0 +1,313 @@
+import datetime as dt
+import time
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import structlog
+
+from api import models
+from api.services.candle_cache import get_candle_cache
+from api.services.dydx_models import CANDLE_RESOLUTIONS
+from api.services.price_store import price_store
+from api.services.trade_evaluator import (
+    DEFAULT_STRATEGY,
+    StrategyParams,
+    _make_aware,
+)
+
+logger = structlog.get_logger(__name__)
+
+
+class BacktestResult(NamedTuple):
+    # One row per position, including the ones still open at the end
+    trades: pd.DataFrame
+    # Realized plus unrealized PnL in USD, per period
+    equity: pd.Series
+    runtime_seconds: float
+
+    @property
+    def num_trades(self) -> int:
+        return len(self.trades)
+
+    @property
+    def total_pnl(self) -> float:
+        return float(self.trades["pnl"].sum()) if len(self.trades) else 0.0
+
+    def summary(self) -> dict:
+        closed = self.trades[self.trades["exit_reason"] != "open"]
+        return {
+            "num_trades": self.num_trades,
+            "num_open": self.num_trades - len(closed),
+            "total_pnl": self.total_pnl,
+            "win_rate": float((closed["pnl"] > 0).mean()) if len(closed) else None,
+            "max_drawdown": float((self.equity.cummax() - self.equity).max())
+            if len(self.equity)
+            else 0.0,
+            "runtime_seconds": self.runtime_seconds,
+        }
+
+
+def load_backtest_prices(
+    instruments: list[models.Instrument],
+    start: dt.datetime,
+    end: dt.datetime,
+    resolution: str = "1DAY",
+) -> pd.DataFrame:
+    """
+    Loads the closes of the instruments, one column per symbol, on a regular grid of
+    periods from start (which should fall on a period boundary) to end. Missing
+    candles are NaN.
+
+    The candle cache is used when it is configured, so no database access is needed.
+    """
+    candle_cache = get_candle_cache()
+    if candle_cache is not None:
+        closes = candle_cache.close_matrix(
+            [instrument.id for instrument in instruments], resolution
+        )
+    else:
+        series_by_instrument = price_store.get_many(
+            [instrument.id for instrument in instruments], resolution
+        )
+        closes = pd.concat(
+            {
+                instrument.id: pd.Series(
+                    series_by_instrument[instrument.id].closes,
+                    index=pd.to_datetime(
+                        series_by_instrument[instrument.id].period_starts, utc=True
+                    ),
+                )
+                for instrument in instruments
+            },
+            axis=1,
+        )
+
+    closes = closes.rename(
+        columns={instrument.id: instrument.symbol for instrument in instruments}
+    )
+    grid = pd.date_range(
+        _make_aware(start),
+        _make_aware(end),
+        freq=CANDLE_RESOLUTIONS[resolution],
+        inclusive="left",
+        name="period_start",
+    )
+    return closes.reindex(grid)
+
+
+def _rolling_sum(values: np.ndarray, window: int) -> np.ndarray:
+    """Sum over the last `window` rows, NaN for the first window - 1 rows"""
+    if len(values) < window:
+        return np.full(values.shape, np.nan)
+    cumsum = np.cumsum(values, axis=0)
+    sums = np.full(values.shape, np.nan)
+    sums[window - 1] = cumsum[window - 1]
+    sums[window:] = cumsum[window:] - cumsum[:-window]
+    return sums
+
+
+def rolling_correlation(x: np.ndarray, y: np.ndarray, window: int) -> np.ndarray:
+    """
+    Rolling Pearson correlation of every column of x (periods x instruments) with y.
+
+    Row t covers rows t - window + 1 to t. Like pairwise_correlation, only the rows
+    where both values are present count, and the result is NaN with fewer than two of
+    them or zero variance.
+    """
+    y = np.broadcast_to(y[:, None], x.shape)
+    mask = ~np.isnan(x) & ~np.isnan(y)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Correlation doesn't change with a shift, and centering keeps the sums small
+        count = np.maximum(mask.sum(axis=0), 1)
+        x = np.where(mask, x - np.where(mask, x, 0).sum(axis=0) / count, 0)
+        y = np.where(mask, y - np.where(mask, y, 0).sum(axis=0) / count, 0)
+
+        n = _rolling_sum(mask.astype(float), window)
+        sum_x = _rolling_sum(x, window)
+        sum_y = _rolling_sum(y, window)
+        cov = _rolling_sum(x * y, window) - sum_x * sum_y / n
+        var_x = _rolling_sum(x * x, window) - sum_x * sum_x / n
+        var_y = _rolling_sum(y * y, window) - sum_y * sum_y / n
+        corr = cov / np.sqrt(var_x * var_y)
+
+    corr[(n < 2) | ~(var_x > 0) | ~(var_y > 0)] = np.nan
+    return np.clip(corr, -1, 1)
+
+
+def compute_signals(
+    closes: np.ndarray,
+    base_closes: np.ndarray,
+    params: StrategyParams = DEFAULT_STRATEGY,
+) -> np.ndarray:
+    """
+    The evaluate_trade entry rule for every instrument and period at once, ignoring
+    open positions. The signal of period t uses the candles up to and including t,
+    like evaluate_trade right after candle t ends.
+
+    Returns:
+        np.ndarray: Boolean periods x instruments matrix
+    """
+    corr = rolling_correlation(closes, base_closes, params.corr_window)
+    inverse_corr = rolling_correlation(closes, base_closes, params.inverse_corr_window)
+
+    window = params.base_return_window
+    base_return = np.full(base_closes.shape, np.nan)
+    base_return[window:] = base_closes[window:] / base_closes[:-window] - 1
+
+    with np.errstate(invalid="ignore"):
+        return (
+            (corr >= params.min_corr)
+            & (inverse_corr <= params.max_inverse_corr)
+            & (base_return >= 0)[:, None]
+        )
+
+
+def _ffill(values: np.ndarray) -> np.ndarray:
+    """Forward fills NaNs along the first axis"""
+    index = np.where(~np.isnan(values), np.arange(len(values))[:, None], 0)
+    np.maximum.accumulate(index, axis=0, out=index)
+    return values[index, np.arange(values.shape[1])]
+
+
+def run_backtest(
+    closes: pd.DataFrame,
+    base_closes: pd.Series,
+    position_size: float = 200,
+    take_profit: float = 0.05,
+    stop_loss: float = 0.05,
+    max_holding_periods: int = 30,
+    fee_rate: float = 0.0,
+    params: StrategyParams = DEFAULT_STRATEGY,
+) -> BacktestResult:
+    """
+    Replays the evaluate_trade strategy over history.
+
+    Like open_position, a position shorts position_size / 2 USD of the instrument and
+    longs the same amount of base, at the close of the period that signalled. Only one
+    position per instrument is open at a time. It is closed at the close of the first
+    period where its PnL reaches take_profit or -stop_loss (as fractions of
+    position_size), or after max_holding_periods.
+
+    Args:
+        closes (pd.DataFrame): Closes on a regular grid of periods, one column per
+            instrument, e.g. from load_backtest_prices
+        base_closes (pd.Series): The closes of base on the same grid
+        fee_rate (float): Fee per leg, as a fraction of its notional, on entry and exit
+        params (StrategyParams): The thresholds and windows, in periods, of the entry
+            rule
+    """
+    t0 = time.perf_counter()
+
+    instr_prices = closes.to_numpy(dtype=float)
+    base_prices = base_closes.to_numpy(dtype=float)
+    signals = compute_signals(instr_prices, base_prices, params)
+
+    # Positions are valued at the last known price when a candle is missing
+    instr_prices = _ffill(instr_prices)
+    base_prices = _ffill(base_prices[:, None])[:, 0]
+
+    num_periods, num_instruments = instr_prices.shape
+    leg_size = position_size / 2
+    fees = 4 * leg_size * fee_rate
+
+    is_open = np.zeros(num_instruments, dtype=bool)
+    entry_period = np.zeros(num_instruments, dtype=int)
+    entry_instr_price = np.full(num_instruments, np.nan)
+    entry_base_price = np.full(num_instruments, np.nan)
+
+    realized = 0.0
+    equity = np.zeros(num_periods)
+    trades = []
+
+    def record(columns: np.ndarray, t: int, reasons: np.ndarray, pnl: np.ndarray):
+        trades.append(
+            (
+                columns,
+                entry_period[columns],
+                np.full(len(columns), t),
+                entry_instr_price[columns],
+                entry_base_price[columns],
+                instr_prices[t, columns],
+                np.full(len(columns), base_prices[t]),
+                pnl,
+                reasons,
+            )
+        )
+
+    for t in range(num_periods):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pnl = (
+                leg_size * (1 - instr_prices[t] / entry_instr_price)
+                + leg_size * (base_prices[t] / entry_base_price - 1)
+                - fees
+            )
+        pnl = np.where(is_open, pnl, 0)
+
+        returns = pnl / position_size
+        reasons = np.select(
+            [
+                returns >= take_profit,
+                returns <= -stop_loss,
+                t - entry_period >= max_holding_periods,
+            ],
+            ["take_profit", "stop_loss", "max_holding"],
+            default="",
+        )
+        exits = is_open & (reasons != "")
+        if exits.any():
+            columns = np.flatnonzero(exits)
+            record(columns, t, reasons[columns], pnl[columns])
+            realized += pnl[columns].sum()
+            is_open &= ~exits
+
+        # Enter at this period's close, but not right after exiting
+        entries = signals[t] & ~is_open & ~exits
+        if entries.any():
+            is_open |= entries
+            entry_period[entries] = t
+            entry_instr_price[entries] = instr_prices[t, entries]
+            entry_base_price[entries] = base_prices[t]
+
+        equity[t] = realized + pnl[is_open & ~entries].sum()
+
+    if is_open.any():
+        columns = np.flatnonzero(is_open)
+        last = num_periods - 1
+        pnl = (
+            leg_size * (1 - instr_prices[last, columns] / entry_instr_price[columns])
+            + leg_size * (base_prices[last] / entry_base_price[columns] - 1)
+            - fees
+        )
+        record(columns, last, np.full(len(columns), "open"), pnl)
+
+    columns = (
+        [np.concatenate(column) for column in zip(*trades)]
+        if trades
+        else [np.array([], dtype=int)] * 9
+    )
+    trades_df = pd.DataFrame(
+        {
+            "instrument": closes.columns[columns[0]],
+            "entry_date": closes.index[columns[1]],
+            "exit_date": closes.index[columns[2]],
+            "entry_instr_price": columns[3],
+            "entry_base_price": columns[4],
+            "exit_instr_price": columns[5],
+            "exit_base_price": columns[6],
+            "pnl": columns[7].astype(float),
+            "exit_reason": columns[8].astype(str),
+        }
+    )
+    runtime_seconds = time.perf_counter() - t0
+    logger.info(
+        "Ran backtest",
+        num_periods=num_periods,
+        num_instruments=num_instruments,
+        num_trades=len(trades_df),
+        runtime_seconds=runtime_seconds,
+    )
+    return BacktestResult(
+        trades_df, pd.Series(equity, index=closes.index), runtime_seconds
+    )
@@ -0,0 +1,254 @@
+import datetime as dt
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import structlog
+from django.conf import settings
+from django.utils import timezone
+
+from api import models
+from api.services.price_store import REFRESH_OVERLAP, to_ns
+
+logger = structlog.get_logger(__name__)
+
+# The exported DydxCandle fields and their dtype on disk
+COLUMNS = {
+    "period_start": np.int64,
+    "period_end": np.int64,
+    "open": np.float64,
+    "high": np.float64,
+    "low": np.float64,
+    "close": np.float64,
+}
+
+
+class CachedCandles(NamedTuple):
+    """Memory-mapped candles of one instrument, sorted by period_start"""
+
+    # Nanoseconds since the epoch, in UTC
+    period_start: np.ndarray
+    period_end: np.ndarray
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.period_start)
+
+
+class CandleCache:
+    """
+    Columnar on-disk copy of DydxCandle for research and backtests.
+
+    Each (resolution, instrument) gets one raw binary file per column, which is opened
+    memory-mapped, so reading years of candles for every market neither touches the
+    database nor copies the data. A manifest per resolution records how many candles of
+    each file are valid and when the candles were last read, so refresh only exports the
+    rows written since, by updated_at. Updated candles are overwritten in their slots.
+    Deleted rows are only picked up by rebuild.
+
+    Layout:
+        <root>/<resolution>/manifest.json
+        <root>/<resolution>/<instrument id>/<column>.bin
+    """
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = Path(root)
+
+    def _manifest_path(self, resolution: str) -> Path:
+        return self.root / resolution / "manifest.json"
+
+    def _column_path(self, resolution: str, instrument_id: int, column: str) -> Path:
+        return self.root / resolution / str(instrument_id) / "{}.bin".format(column)
+
+    def manifest(self, resolution: str) -> dict:
+        path = self._manifest_path(resolution)
+        if not path.exists():
+            return {"updated_at": None, "instruments": {}}
+        return json.loads(path.read_text())
+
+    def _write_manifest(self, resolution: str, manifest: dict) -> None:
+        # Write-then-rename so a crash never leaves a half-written manifest
+        path = self._manifest_path(resolution)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(manifest))
+        os.replace(tmp_path, path)
+
+    def open(self, instrument_id: int, resolution: str = "1DAY") -> CachedCandles:
+        """Opens the cached candles of an instrument without reading them into memory"""
+        entry = self.manifest(resolution)["instruments"].get(str(instrument_id))
+        length = entry["length"] if entry else 0
+
+        columns = []
+        for column, dtype in COLUMNS.items():
+            if not length:
+                columns.append(np.empty(0, dtype=dtype))
+                continue
+            columns.append(
+                np.memmap(
+                    self._column_path(resolution, instrument_id, column),
+                    dtype=dtype,
+                    mode="r",
+                    shape=(length,),
+                )
+            )
+        return CachedCandles(*columns)
+
+    def close_matrix(
+        self, instrument_ids: list[int], resolution: str = "1DAY"
+    ) -> pd.DataFrame:
+        """Closes of many instruments, one column per instrument id, aligned on period_start"""
+        columns = {}
+        for instrument_id in instrument_ids:
+            candles = self.open(instrument_id, resolution)
+            columns[instrument_id] = pd.Series(
+                candles.close,
+                index=pd.to_datetime(candles.period_start, utc=True),
+                copy=False,
+            )
+        df = pd.concat(columns, axis=1) if columns else pd.DataFrame()
+        df.index.name = "period_start"
+        return df
+
+    def refresh(self, resolution: str = "1DAY") -> int:
+        """
+        Exports the candles written since the last refresh, by updated_at, which
+        includes candles updated in place and ones that committed late.
+
+        Returns:
+            int: The number of candles exported
+        """
+        manifest = self.manifest(resolution)
+        read_at = timezone.now()
+        qs = models.DydxCandle.objects.filter(
+            # One range of the updated_at index per instrument
+            instrument_id__in=list(
+                models.Instrument.objects.values_list("id", flat=True)
+            ),
+            resolution=resolution,
+        )
+        if manifest.get("updated_at"):
+            qs = qs.filter(
+                updated_at__gte=dt.datetime.fromisoformat(manifest["updated_at"])
+                - REFRESH_OVERLAP
+            )
+        qs = qs.order_by("instrument_id", "period_start").values_list(
+            "instrument_id", *COLUMNS
+        )
+
+        num_exported = 0
+        rows: list[tuple] = []
+        instrument_id = None
+        for row in qs.iterator(chunk_size=10_000):
+            if row[0] != instrument_id and rows:
+                self._write(resolution, manifest, instrument_id, rows)
+                num_exported += len(rows)
+                rows = []
+            instrument_id = row[0]
+            rows.append(row[1:])
+        if rows:
+            self._write(resolution, manifest, instrument_id, rows)
+            num_exported += len(rows)
+
+        manifest["updated_at"] = read_at.isoformat()
+        self._write_manifest(resolution, manifest)
+        logger.info(
+            "Refreshed candle cache", resolution=resolution, num_exported=num_exported
+        )
+        return num_exported
+
+    def rebuild(self, resolution: str = "1DAY") -> int:
+        """Exports every candle of a resolution from scratch"""
+        shutil.rmtree(self.root / resolution, ignore_errors=True)
+        return self.refresh(resolution)
+
+    def _write(
+        self, resolution: str, manifest: dict, instrument_id: int, rows: list[tuple]
+    ) -> None:
+        """Writes candles sorted by period_start, replacing the ones already cached"""
+        new = {
+            column: np.array(
+                [
+                    to_ns(value) if dtype is np.int64 else float(value)
+                    for value in values
+                ],
+                dtype=dtype,
+            )
+            for (column, dtype), values in zip(COLUMNS.items(), zip(*rows))
+        }
+
+        entry = manifest["instruments"].setdefault(
+            str(instrument_id), {"length": 0, "last_period_start": None}
+        )
+        self._column_path(resolution, instrument_id, "close").parent.mkdir(
+            parents=True, exist_ok=True
+        )
+
+        older = np.zeros(len(new["period_start"]), dtype=bool)
+        if entry["length"]:
+            older = new["period_start"] <= entry["last_period_start"]
+        if older.any():
+            existing = self.open(instrument_id, resolution)
+            slots = np.searchsorted(existing.period_start, new["period_start"][older])
+            cached = existing.period_start[np.minimum(slots, len(existing) - 1)]
+            if not np.array_equal(cached, new["period_start"][older]):
+                self._merge(resolution, entry, instrument_id, existing, new)
+                return
+
+            # Updated candles, e.g. the latest one while its period is still going
+            for column, dtype in COLUMNS.items():
+                column_map = np.memmap(
+                    self._column_path(resolution, instrument_id, column),
+                    dtype=dtype,
+                    mode="r+",
+                    shape=(entry["length"],),
+                )
+                column_map[slots] = new[column][older]
+                column_map.flush()
+
+        if older.all():
+            return
+        for column in COLUMNS:
+            path = self._column_path(resolution, instrument_id, column)
+            with open(path, "ab") as f:
+                # Drop anything past the valid length, left by an interrupted refresh
+                f.truncate(entry["length"] * np.dtype(COLUMNS[column]).itemsize)
+                f.write(new[column][~older].tobytes())
+        entry["length"] += int((~older).sum())
+        entry["last_period_start"] = int(new["period_start"][-1])
+
+    def _merge(
+        self,
+        resolution: str,
+        entry: dict,
+        instrument_id: int,
+        existing: CachedCandles,
+        new: dict[str, np.ndarray],
+    ) -> None:
+        """Merges in candles of periods that aren't cached yet, e.g. from a backfill"""
+        period_starts = np.concatenate([new["period_start"], existing.period_start])
+        # np.unique keeps the first occurrence, which is the new candle
+        period_starts, index = np.unique(period_starts, return_index=True)
+        for column in COLUMNS:
+            merged = np.concatenate([new[column], getattr(existing, column)])[index]
+            # Replace the file rather than overwrite it, so open maps stay valid
+            path = self._column_path(resolution, instrument_id, column)
+            tmp_path = path.with_suffix(".tmp")
+            merged.tofile(tmp_path)
+            os.replace(tmp_path, path)
+        entry["length"] = len(period_starts)
+        entry["last_period_start"] = int(period_starts[-1])
+
+
+def get_candle_cache() -> CandleCache | None:
+    """The cache at settings.CANDLE_CACHE_DIR, or None when it isn't configured"""
+    if not settings.CANDLE_CACHE_DIR:
+        return None
+    return CandleCache(settings.CANDLE_CACHE_DIR)
@@ -0,0 +1,145 @@
+"""
+Client of the coingecko API, shared by every thread of a process so that its
+connections are kept alive and its requests stay within one rate budget.
+
+https://www.coingecko.com/api/documentation
+"""
+import datetime as dt
+import email.utils
+import threading
+import time
+
+import requests
+import structlog
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from api.services.throttle import Limiter, get_rate_limiter
+
+logger = structlog.get_logger(__name__)
+
+# Seconds a request may take
+REQUEST_TIMEOUT = 30
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """The seconds to wait from a Retry-After header, in seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (date - dt.datetime.now(dt.timezone.utc)).total_seconds())
+
+
+class CoingeckoClient:
+    """
+    Retries 429 and server errors, waiting for as long as Retry-After asks, or with an
+    exponential backoff without one. A 429 pauses every request of the client, not only
+    the one that got it.
+
+    Args:
+        api_url (str): e.g. https://api.coingecko.com/api/v3
+        rate_limiter (Limiter): Acquired before every request
+        max_attempts (int): Attempts per request
+        pool_size (int): Connections kept alive, i.e. the most concurrent requests
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        rate_limiter: Limiter,
+        max_attempts: int = settings.COINGECKO_MAX_ATTEMPTS,
+        pool_size: int = settings.COINGECKO_FETCH_CONCURRENCY,
+    ) -> None:
+        self.api_url = api_url.rstrip("/")
+        self.rate_limiter = rate_limiter
+        self.max_attempts = max_attempts
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.num_requests = 0
+        # time.monotonic() until which the API asked to be left alone
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait_for_pause(self) -> None:
+        with self._lock:
+            wait_seconds = self._paused_until - time.monotonic()
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+    def _pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def get(self, path: str, params: dict | None = None):
+        """The JSON body of GET path, raising RuntimeError once the attempts run out"""
+        url = "{}/{}".format(self.api_url, path.lstrip("/"))
+        for attempt in range(self.max_attempts):
+            self._wait_for_pause()
+            self.rate_limiter.acquire()
+            with self._lock:
+                self.num_requests += 1
+
+            try:
+                resp = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+                delay = 2**attempt
+            else:
+                if resp.ok:
+                    return resp.json()
+                if resp.status_code != 429 and resp.status_code < 500:
+                    logger.error("Error querying coingecko: {}".format(resp.text))
+                    raise RuntimeError(
+                        "Error querying coingecko: {}".format(resp.status_code)
+                    )
+                error = resp.status_code
+                delay = parse_retry_after(resp.headers.get("Retry-After"))
+                if delay is None:
+                    delay = 2**attempt
+                if resp.status_code == 429:
+                    self._pause(delay)
+
+            if attempt + 1 == self.max_attempts:
+                break
+            logger.warning(
+                "Coingecko request failed, retrying in {}s".format(delay),
+                url=url,
+                error=error,
+            )
+            time.sleep(delay)
+
+        raise RuntimeError("Error querying coingecko: {}".format(error))
+
+    def get_ohlc(self, coingecko_id: str, days: int = 30) -> list[list[float]]:
+        """[timestamp in ms, open, high, low, close] candles of a coin in USD"""
+        return self.get(
+            "coins/{}/ohlc".format(coingecko_id),
+            {"vs_currency": "usd", "days": str(days)},
+        )
+
+
+_client: CoingeckoClient | None = None
+_client_lock = threading.Lock()
+
+
+def get_coingecko_client() -> CoingeckoClient:
+    """Returns the process-wide client, creating it on first use"""
+    global _client
+    with _client_lock:
+        if _client is None or _client.api_url != settings.COINGECKO_API_URL.rstrip("/"):
+            _client = CoingeckoClient(
+                settings.COINGECKO_API_URL,
+                get_rate_limiter(
+                    settings.COINGECKO_API_URL, settings.COINGECKO_REQUESTS_PER_SECOND
+                ),
+            )
+        return _client
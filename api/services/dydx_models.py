@@ -1,11 +1,22 @@
 from __future__ import annotations
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
 from typing import Dict, List
 
 from pydantic import BaseModel, Extra
 
+# Length of the period covered by one candle of each resolution
+CANDLE_RESOLUTIONS = {
+    "1MIN": timedelta(minutes=1),
+    "5MINS": timedelta(minutes=5),
+    "15MINS": timedelta(minutes=15),
+    "30MINS": timedelta(minutes=30),
+    "1HOUR": timedelta(hours=1),
+    "4HOURS": timedelta(hours=4),
+    "1DAY": timedelta(days=1),
+}
+
 
 class Candle(BaseModel):
     startedAt: str
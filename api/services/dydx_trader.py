@@ -1,150 +1,337 @@
 import os
+import threading
 import time
+from typing import NamedTuple
 
 import structlog
+from django.conf import settings
 from dydx3 import Client
 
 from api.services.dydx_models import CandlesModel
+from api.services.live_prices import get_live_price
+from api.services.market_cache import MarketCache, MarketPrecision, round_to_increment
+from api.services.orders import OrderTracker
 
 logger = structlog.get_logger()
 
 # https://github.com/dydxprotocol/dydx-v3-python/blob/master/dydx3/constants.py
 from dydx3.constants import (
-    API_HOST_MAINNET,
     NETWORK_ID_MAINNET,
     ORDER_SIDE_BUY,
     ORDER_SIDE_SELL,
     ORDER_TYPE_LIMIT,
+    TIME_IN_FORCE_GTT,
 )
+from dydx3.errors import DydxApiError
+from dydx3.helpers.request_helpers import random_client_id
+from dydx3.starkex.order import SignableOrder
 from web3 import Web3
 
 
+class AccountSnapshot(NamedTuple):
+    position_id: str
+    equity: float
+    free_collateral: float
+    # Open positions by market, e.g. {"ETH-USD": {"size": "0.1", ...}}
+    open_positions: dict[str, dict]
+    # time.monotonic() of the download
+    loaded_at: float
+
+
+# Maximum number of candles returned by one get_candles request
+CANDLES_PAGE_LIMIT = 100
+
+
+# STARK private keys by ethereum address. Deriving one signs a message with the
+# ethereum key, so it is only done once per process.
+_stark_private_keys: dict[str, str] = {}
+_stark_private_keys_lock = threading.Lock()
+
+
+def _get_stark_private_key(client: Client) -> str:
+    # A configured key skips the derivation altogether
+    if os.environ.get("STARK_PRIVATE_KEY"):
+        return os.environ["STARK_PRIVATE_KEY"]
+
+    with _stark_private_keys_lock:
+        if client.default_address not in _stark_private_keys:
+            logger.info("Deriving the STARK key of {}".format(client.default_address))
+            stark_key_pair_with_y_coordinate = client.onboarding.derive_stark_key()
+            _stark_private_keys[
+                client.default_address
+            ] = stark_key_pair_with_y_coordinate["private_key"]
+        return _stark_private_keys[client.default_address]
+
+
 class DydxTrader:
+    """
+    Wraps the dydx client. Use get_trader() rather than creating one, so the client,
+    its HTTP connections, the STARK key and the markets are shared by the process.
+    """
+
     def __init__(self) -> None:
         eth_private_key = os.environ["ETH_PRIVATE_KEY"]
         eth_public_key = os.environ["ETH_PUBLIC_KEY"]
         web3_provider_url = os.environ["WEB3_PROVIDER_URL"]
 
+        # Configured API key credentials skip recovering them with the ethereum key
+        api_key_credentials = None
+        if os.environ.get("DYDX_API_KEY"):
+            api_key_credentials = {
+                "key": os.environ["DYDX_API_KEY"],
+                "secret": os.environ["DYDX_API_SECRET"],
+                "passphrase": os.environ["DYDX_API_PASSPHRASE"],
+            }
+
         self.client = Client(
             network_id=NETWORK_ID_MAINNET,
-            host=API_HOST_MAINNET,
+            host=settings.DYDX_API_HOST,
             default_ethereum_address=eth_public_key,
             eth_private_key=eth_private_key,
             web3=Web3(Web3.HTTPProvider(web3_provider_url)),
+            api_key_credentials=api_key_credentials,
+        )
+        self._markets = MarketCache(
+            lambda: self.client.public.get_markets().data,
+            ttl=settings.DYDX_MARKETS_TTL_SECONDS,
         )
+        self.order_tracker = OrderTracker(
+            lambda order_id: self.client.private.get_order_by_id(order_id).data["order"]
+        )
+        self._account = None
+        self._account_lock = threading.Lock()
+
+    @property
+    def markets(self) -> dict:
+        """The markets, downloaded on first use and refreshed in the background"""
+        return self._markets.get().markets
+
+    def refresh(self) -> None:
+        """Downloads the markets now"""
+        self._markets.refresh()
 
-        stark_key_pair_with_y_coordinate = self.client.onboarding.derive_stark_key()
-        self.client.stark_private_key = stark_key_pair_with_y_coordinate["private_key"]
-        self.markets = self.client.public.get_markets().data
+    def _ensure_stark_key(self) -> None:
+        # Only needed to sign orders, so public requests don't pay for it
+        if self.client.stark_private_key is None:
+            self.client.stark_private_key = _get_stark_private_key(self.client)
+
+    def warm_up(self) -> None:
+        """Does the setup of the first order ahead of time"""
+        self._ensure_stark_key()
+        self._markets.get()
+
+    def get_account_snapshot(self, max_age: float | None = None) -> AccountSnapshot:
+        """
+        The account, downloaded again once it is older than max_age seconds, which
+        defaults to DYDX_ACCOUNT_TTL_SECONDS.
+        """
+        if max_age is None:
+            max_age = settings.DYDX_ACCOUNT_TTL_SECONDS
+        with self._account_lock:
+            if (
+                self._account is None
+                or time.monotonic() - self._account.loaded_at > max_age
+            ):
+                self._account = self._load_account()
+            return self._account
+
+    def refresh_account(self) -> AccountSnapshot:
+        """Downloads the account now"""
+        with self._account_lock:
+            self._account = self._load_account()
+            return self._account
+
+    def _load_account(self) -> AccountSnapshot:
+        # https://dydxprotocol.github.io/v3-teacher/#get-account
+        account = self.client.private.get_account().data["account"]
+        return AccountSnapshot(
+            position_id=account["positionId"],
+            equity=float(account["equity"]),
+            free_collateral=float(account["freeCollateral"]),
+            open_positions=account["openPositions"],
+            loaded_at=time.monotonic(),
+        )
 
     def get_position_id(self) -> str:
-        account_response = self.client.private.get_account()
-        position_id = account_response.data["account"]["positionId"]
-        return position_id
+        return self.get_account_snapshot().position_id
 
     def get_price(self, market: str) -> float:
-        # https://dydxprotocol.github.io/v3-teacher/#get-markets
-        price = float(self.markets["markets"][market]["indexPrice"])
+        # Streamed by the market data worker when it runs, which is fresher than the
+        # markets snapshot
+        price = get_live_price(market)
+        if price is None:
+            # https://dydxprotocol.github.io/v3-teacher/#get-markets
+            price = float(self.markets["markets"][market]["indexPrice"])
         return self._format_price(price, market)
 
+    def _precision(self, market: str) -> MarketPrecision:
+        return self._markets.get().precision[market]
+
     def _format_price(self, price: float, market: str) -> float:
-        tick_size = float(self.markets["markets"][market]["tickSize"])
+        # Round to the nearest tick size
+        return float(round_to_increment(price, self._precision(market).tick_size))
 
-        # Round to the nearest tick size if needed
-        if "." in str(tick_size):
-            num_decimals = len(str(tick_size).split(".")[1])
-            price = round(price, num_decimals)
+    def _format_size(self, size: float, market: str) -> float:
+        # Round to the nearest step size
+        return float(round_to_increment(size, self._precision(market).step_size))
 
-        return price
+    def cancel_order(self, order_id: str) -> None:
+        self.client.private.cancel_order(order_id)
 
-    def _format_size(self, size: float, market: str) -> float:
-        # Round to the nearest step size if needed
-
-        step_size = float(self.markets["markets"][market]["stepSize"])
-        if step_size < 1:
-            num_decimals = len(str(step_size).split(".")[1])
-            size = round(size, num_decimals)
-        else:
-            step_size = int(step_size)
-            size = round(size, -1 * (len(str(step_size)) - 1))
-
-        return size
-
-    def block_until_no_pending_orders(self, timeout_seconds=120):
-        sleep_time = 10  # seconds
-        time_waited = 0
-        while time_waited < timeout_seconds:
-            orders = self.client.private.get_orders().data["orders"]
-            # If there's no pending orders, we're done
-            if not orders:
-                return
-
-            # otherwise, sleep and try again
-            logger.debug("Sleeping {} seconds".format(sleep_time))
-            time.sleep(sleep_time)
-            time_waited += sleep_time
-
-        raise TimeoutError("Timed out waiting for orders stop pending")
-
-    def get_candles(self, market: str) -> CandlesModel:
+    def wait_for_order(self, order_id: str, timeout_seconds: float = 120) -> dict:
+        """Returns the order once it is filled or canceled, see OrderTracker"""
+        return self.order_tracker.wait(order_id, timeout_seconds)
+
+    def get_candles(
+        self,
+        market: str,
+        resolution: str = "1DAY",
+        from_iso: str | None = None,
+        to_iso: str | None = None,
+        limit: int | None = None,
+    ) -> CandlesModel:
         """
         https://dydxprotocol.github.io/v3-teacher/?python#get-candles-for-market
+
+        Candles are returned newest first, at most `limit` (up to CANDLES_PAGE_LIMIT) of them.
         """
         resp = self.client.public.get_candles(
             market=market,
-            resolution="1DAY",
+            resolution=resolution,
+            from_iso=from_iso,
+            to_iso=to_iso,
+            limit=limit,
         )
         return CandlesModel(**resp.data)
 
-    def short(self, market: str, price: float, size: float) -> dict:
+    def prepare_order(
+        self,
+        market: str,
+        side: str,
+        price: float,
+        size: float,
+        position_id: str | None = None,
+        reduce_only: bool = False,
+        time_in_force: str = TIME_IN_FORCE_GTT,
+    ) -> dict:
+        """
+        Rounds and signs the params of a limit order, so it can be submitted right away.
+
+        Args:
+            price (float): Worst accepted price
+            position_id (str | None): Fetched from the account when not given
+            reduce_only (bool): Whether the order may only shrink the open position.
+                dydx only accepts it with a FOK or IOC time_in_force.
+            time_in_force (str): GTT rests on the book until it expires, FOK and IOC
+                cancel whatever doesn't fill right away
+        """
         # https://dydxprotocol.github.io/v3-teacher/#create-a-new-order
         # https://github.com/chiwalfrm/dydxexamples
 
-        position_id = self.get_position_id()
-        price = self._format_price(price, market)
-        size = self._format_size(size, market)
+        self._ensure_stark_key()
+        if position_id is None:
+            position_id = self.get_position_id()
+        precision = self._precision(market)
+        price = round_to_increment(price, precision.tick_size)
+        size = round_to_increment(size, precision.step_size)
 
-        logger.debug("Shorting {} {} at price {}".format(size, market, price))
+        logger.debug(
+            "{} {:f} {} at price {:f}".format(
+                "Longing" if side == ORDER_SIDE_BUY else "Shorting", size, market, price
+            )
+        )
 
         order_params = {
             "position_id": position_id,
             "market": market,
-            "side": ORDER_SIDE_SELL,
+            "side": side,
             "order_type": ORDER_TYPE_LIMIT,
+            "time_in_force": time_in_force,
             "post_only": False,
-            "size": str(
+            "size": "{:f}".format(
                 size
             ),  # Size of the order, in base currency (i.e. an ETH-USD position of size 1 represents 1 ETH).
-            "price": str(price),  # Worst accepted price of the base asset in USD.
+            "price": "{:f}".format(
+                price
+            ),  # Worst accepted price of the base asset in USD.
             "limit_fee": "0.0015",
             "expiration_epoch_seconds": time.time() + 75,  # 75 seconds from now
+            "client_id": random_client_id(),
         }
-        order_response = self.client.private.create_order(**order_params)
+        if reduce_only:
+            order_params["reduce_only"] = True
+
+        # Sign like create_order would, so submitting doesn't wait for it
+        order_params["signature"] = SignableOrder(
+            network_id=self.client.network_id,
+            position_id=position_id,
+            client_id=order_params["client_id"],
+            market=market,
+            side=side,
+            human_size=order_params["size"],
+            human_price=order_params["price"],
+            limit_fee=order_params["limit_fee"],
+            expiration_epoch_seconds=order_params["expiration_epoch_seconds"],
+        ).sign(self.client.stark_private_key)
+        return order_params
+
+    def submit_order(self, order_params: dict) -> dict:
+        """
+        Submits an order from prepare_order.
+
+        If it is rejected, the account is downloaded again. When the position id
+        changed, the order is signed again with the new one and resubmitted.
+        """
+        try:
+            order_response = self.client.private.create_order(**order_params)
+        except DydxApiError:
+            account = self.refresh_account()
+            if account.position_id == order_params["position_id"]:
+                raise
+
+            logger.warning(
+                "Position id changed to {}, resubmitting the order".format(
+                    account.position_id
+                )
+            )
+            order_params = self.prepare_order(
+                order_params["market"],
+                order_params["side"],
+                float(order_params["price"]),
+                float(order_params["size"]),
+                account.position_id,
+                order_params.get("reduce_only", False),
+                order_params["time_in_force"],
+            )
+            order_response = self.client.private.create_order(**order_params)
         return {"order_params": order_params, "order_data": order_response.data}
 
+    def short(self, market: str, price: float, size: float) -> dict:
+        return self.submit_order(
+            self.prepare_order(market, ORDER_SIDE_SELL, price, size)
+        )
+
     def long(self, market: str, price: float, size: float) -> dict:
-        # https://dydxprotocol.github.io/v3-teacher/#create-a-new-order
-        # https://github.com/chiwalfrm/dydxexamples
+        return self.submit_order(
+            self.prepare_order(market, ORDER_SIDE_BUY, price, size)
+        )
 
-        position_id = self.get_position_id()
-        price = self._format_price(price, market)
-        size = self._format_size(size, market)
 
-        logger.debug("Longing {} {} at price {}".format(size, market, price))
+_trader: DydxTrader | None = None
+_trader_lock = threading.Lock()
 
-        order_params = {
-            "position_id": position_id,
-            "market": market,
-            "side": ORDER_SIDE_BUY,
-            "order_type": ORDER_TYPE_LIMIT,
-            "post_only": False,
-            "size": str(
-                size
-            ),  # Size of the order, in base currency (i.e. an ETH-USD position of size 1 represents 1 ETH).
-            "price": str(price),  # Worst accepted price of the base asset in USD.
-            "limit_fee": "0.0015",
-            "expiration_epoch_seconds": time.time() + 75,  # 75 seconds from now
-        }
-        order_response = self.client.private.create_order(**order_params)
-        order_response.data["order"]["id"]
-        return {"order_params": order_params, "order_data": order_response.data}
+
+def get_trader() -> DydxTrader:
+    """The process-wide trader, created on first use"""
+    global _trader
+    with _trader_lock:
+        if _trader is None:
+            _trader = DydxTrader()
+        return _trader
+
+
+def reset_trader() -> None:
+    """Drops the process-wide trader, e.g. after the credentials changed"""
+    global _trader
+    with _trader_lock:
+        _trader = None
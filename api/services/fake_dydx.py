@@ -0,0 +1,500 @@
+"""
+A local stand-in for the dydx v3 API, serving the endpoints this project uses, so the
+sync and trading pipeline can run and be benchmarked offline.
+
+Point the trader at it with DYDX_API_HOST and WEB3_PROVIDER_URL, both set to its host.
+It also answers the web3 net_version call the dydx client makes on creation.
+FakeDydxWebsocket streams its prices like the websocket API, for the market data
+worker.
+"""
+import asyncio
+import datetime as dt
+import json
+import math
+import random
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import structlog
+from aiohttp import WSMsgType, web
+
+from api.services.dydx_models import CANDLE_RESOLUTIONS
+from api.services.dydx_trader import CANDLES_PAGE_LIMIT
+
+logger = structlog.get_logger(__name__)
+
+DEFAULT_ASSETS = ["ETH", "BTC", "DOGE", "SOL", "LINK", "AVAX"]
+
+
+def _format_timestamp(date: dt.datetime) -> str:
+    return date.strftime("%Y-%m-%dT%H:%M:%S.") + "{:03d}Z".format(
+        date.microsecond // 1000
+    )
+
+
+def _parse_timestamp(value: str) -> dt.datetime:
+    return dt.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class FakeDydxExchange:
+    """
+    Serves markets, candles, the account, and orders from memory.
+
+    Prices follow a deterministic wave per market, so candles are the same across
+    requests and runs. Orders fill `fill_delay` seconds after they are created, or right
+    away for FOK and IOC orders. Like dydx, reduce only orders must be FOK or IOC. The
+    attributes can be changed while the server runs.
+
+    Args:
+        assets (list[str]): Base assets of the markets, e.g. "ETH" for ETH-USD
+        num_markets (int): Adds synthetic markets until there are this many
+        latency (float): Seconds every request takes
+        error_rate (float): Fraction of requests that fail with a 500
+        fill_delay (float): Seconds before an order fills
+        cancel_markets (set[str]): Markets whose orders are canceled instead of filled
+        reject_markets (set[str]): Markets whose orders are rejected with a 400
+    """
+
+    def __init__(
+        self,
+        assets: list[str] | None = None,
+        num_markets: int = 0,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        fill_delay: float = 0.0,
+        cancel_markets: set[str] | None = None,
+        reject_markets: set[str] | None = None,
+        seed: int = 0,
+    ) -> None:
+        assets = list(assets or DEFAULT_ASSETS)
+        assets += ["FAKE{}".format(i) for i in range(num_markets - len(assets))]
+        self.markets = ["{}-USD".format(asset) for asset in assets]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fill_delay = fill_delay
+        self.cancel_markets = cancel_markets or set()
+        self.reject_markets = reject_markets or set()
+
+        self.position_id = "1"
+        self.orders = {}
+        self.open_positions = {}
+        # Number of requests by endpoint, e.g. "GET /v3/candles"
+        self.requests = Counter()
+        self.max_in_flight = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._server = None
+
+    @property
+    def host(self) -> str:
+        return "http://127.0.0.1:{}".format(self._server.server_port)
+
+    def start(self, port: int = 0) -> "FakeDydxExchange":
+        """Serves in a background thread, on a free port by default"""
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info("Fake dydx exchange listening on {}".format(self.host))
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeDydxExchange":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def price(self, market: str, date: dt.datetime) -> float:
+        """The price of market at date"""
+        phase = zlib.crc32(market.encode()) % 1000
+        days = date.timestamp() / 86400
+        base_price = 1 + phase
+        return base_price * (
+            1 + 0.2 * math.sin(days / 20 + phase) + 0.05 * math.sin(days / 3 + phase)
+        )
+
+    # Endpoints
+
+    def get_markets(self, query: dict) -> tuple[int, dict]:
+        now = dt.datetime.now(dt.timezone.utc)
+        markets = {}
+        for market in self.markets:
+            price = self.price(market, now)
+            # Ticks of about 1/10000 of the price
+            tick_size = "{:g}".format(10 ** math.floor(math.log10(price) - 4))
+            markets[market] = {
+                "market": market,
+                "status": "ONLINE",
+                "baseAsset": market.split("-")[0],
+                "quoteAsset": "USD",
+                "stepSize": "{:g}".format(10 ** math.floor(math.log10(10 / price))),
+                "tickSize": tick_size,
+                "indexPrice": "{:f}".format(price),
+                "oraclePrice": "{:f}".format(price),
+                "priceChange24H": "0",
+                "nextFundingRate": "0",
+                "nextFundingAt": _format_timestamp(now + dt.timedelta(hours=1)),
+                "minOrderSize": "0.001",
+                "type": "PERPETUAL",
+                "initialMarginFraction": "0.05",
+                "maintenanceMarginFraction": "0.03",
+                "transferMarginFraction": "0",
+                "volume24H": "0",
+                "trades24H": 0,
+                "openInterest": "0",
+                "incrementalInitialMarginFraction": "0.01",
+                "incrementalPositionSize": 1000,
+                "maxPositionSize": 100000,
+                "baselinePositionSize": 10000,
+                "assetResolution": "1000000000",
+                "syntheticAssetId": "0x0",
+            }
+        return 200, {"markets": markets}
+
+    def get_candles(self, market: str, query: dict) -> tuple[int, dict]:
+        if market not in self.markets:
+            return 400, {"errors": [{"msg": "Unknown market {}".format(market)}]}
+
+        resolution = query.get("resolution", "1DAY")
+        delta = CANDLE_RESOLUTIONS[resolution]
+        limit = min(int(query.get("limit", CANDLES_PAGE_LIMIT)), CANDLES_PAGE_LIMIT)
+        now = dt.datetime.now(dt.timezone.utc)
+        epoch = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+
+        # Like dydx, newest first, including the current candle, with to_iso inclusive
+        to_date = (
+            min(_parse_timestamp(query["toISO"]), now) if "toISO" in query else now
+        )
+        from_date = _parse_timestamp(query["fromISO"]) if "fromISO" in query else epoch
+        period_start = epoch + (to_date - epoch) // delta * delta
+
+        candles = []
+        while len(candles) < limit and period_start >= from_date:
+            period_end = min(period_start + delta, now)
+            open_, close = (
+                self.price(market, period_start),
+                self.price(market, period_end),
+            )
+            candles.append(
+                {
+                    "startedAt": _format_timestamp(period_start),
+                    "updatedAt": _format_timestamp(period_end),
+                    "market": market,
+                    "resolution": resolution,
+                    "low": "{:f}".format(min(open_, close) * 0.99),
+                    "high": "{:f}".format(max(open_, close) * 1.01),
+                    "open": "{:f}".format(open_),
+                    "close": "{:f}".format(close),
+                    "baseTokenVolume": "0",
+                    "trades": "0",
+                    "usdVolume": "0",
+                    "startingOpenInterest": "0",
+                }
+            )
+            period_start -= delta
+        return 200, {"candles": candles}
+
+    def get_account(self, query: dict) -> tuple[int, dict]:
+        return 200, {
+            "account": {
+                "positionId": self.position_id,
+                "equity": "10000",
+                "freeCollateral": "10000",
+                "quoteBalance": "10000",
+                "openPositions": self.open_positions,
+            }
+        }
+
+    def _update_order(self, order: dict) -> dict:
+        # Orders settle lazily, when they are read
+        if order["status"] == "PENDING" and time.time() >= order["_settles_at"]:
+            if order["market"] in self.cancel_markets:
+                order["status"] = "CANCELED"
+            else:
+                order["status"] = "FILLED"
+                order["remainingSize"] = "0"
+                size = float(order["size"]) * (1 if order["side"] == "BUY" else -1)
+                position = self.open_positions.setdefault(
+                    order["market"], {"market": order["market"], "size": "0"}
+                )
+                position["size"] = "{:f}".format(float(position["size"]) + size)
+        return {k: v for k, v in order.items() if not k.startswith("_")}
+
+    def get_order(self, order_id: str, query: dict) -> tuple[int, dict]:
+        if order_id not in self.orders:
+            return 404, {"errors": [{"msg": "Order not found"}]}
+        return 200, {"order": self._update_order(self.orders[order_id])}
+
+    def get_orders(self, query: dict) -> tuple[int, dict]:
+        orders = [self._update_order(order) for order in self.orders.values()]
+        return 200, {"orders": [o for o in orders if o["status"] == "PENDING"]}
+
+    def create_order(self, data: dict) -> tuple[int, dict]:
+        if data["market"] in self.reject_markets:
+            return 400, {"errors": [{"msg": "Order rejected"}]}
+        immediate = data["timeInForce"] in ("FOK", "IOC")
+        if data.get("reduceOnly") and not immediate:
+            return 400, {"errors": [{"msg": "reduceOnly requires FOK or IOC"}]}
+
+        order = {
+            "id": uuid.uuid4().hex,
+            "clientId": data["clientId"],
+            "positionId": self.position_id,
+            "market": data["market"],
+            "side": data["side"],
+            "type": data["type"],
+            "size": data["size"],
+            "remainingSize": data["size"],
+            "price": data["price"],
+            "limitFee": data["limitFee"],
+            "timeInForce": data["timeInForce"],
+            "reduceOnly": bool(data.get("reduceOnly")),
+            "status": "PENDING",
+            "createdAt": _format_timestamp(dt.datetime.now(dt.timezone.utc)),
+            "expiresAt": data["expiration"],
+            "_settles_at": time.time() + (0 if immediate else self.fill_delay),
+        }
+        self.orders[order["id"]] = order
+        return 201, {"order": self._update_order(order)}
+
+    def cancel_order(self, order_id: str) -> tuple[int, dict]:
+        if order_id not in self.orders:
+            return 404, {"errors": [{"msg": "Order not found"}]}
+        order = self.orders[order_id]
+        self._update_order(order)
+        if order["status"] == "PENDING":
+            order["status"] = "CANCELED"
+        return 200, {"cancelOrder": self._update_order(order)}
+
+    def json_rpc(self, data: dict) -> tuple[int, dict]:
+        results = {"net_version": "1", "eth_chainId": "0x1"}
+        return 200, {
+            "jsonrpc": "2.0",
+            "id": data.get("id"),
+            "result": results.get(data.get("method")),
+        }
+
+    def handle(
+        self, method: str, path: str, query: dict, data: dict
+    ) -> tuple[int, dict]:
+        parts = path.strip("/").split("/")
+        if method == "POST" and parts == [""]:
+            return self.json_rpc(data)
+        if parts[:1] != ["v3"]:
+            return 404, {"errors": [{"msg": "Not found"}]}
+
+        endpoint = parts[1:]
+        if method == "GET" and endpoint == ["markets"]:
+            return self.get_markets(query)
+        if method == "GET" and endpoint[:1] == ["candles"] and len(endpoint) == 2:
+            return self.get_candles(endpoint[1], query)
+        if method == "GET" and endpoint[:1] == ["accounts"]:
+            return self.get_account(query)
+        if endpoint == ["orders"]:
+            if method == "GET":
+                return self.get_orders(query)
+            if method == "POST":
+                return self.create_order(data)
+        if endpoint[:1] == ["orders"] and len(endpoint) == 2:
+            if method == "GET":
+                return self.get_order(endpoint[1], query)
+            if method == "DELETE":
+                return self.cancel_order(endpoint[1])
+        return 404, {"errors": [{"msg": "Not found"}]}
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        exchange = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self, method: str) -> None:
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                data = json.loads(body) if body else {}
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+                # Endpoints without their ids, e.g. "GET /v3/orders"
+                name = "{} {}".format(method, "/".join(url.path.split("/")[:3]))
+                with exchange._lock:
+                    exchange.requests[name] += 1
+                    exchange._in_flight += 1
+                    exchange.max_in_flight = max(
+                        exchange.max_in_flight, exchange._in_flight
+                    )
+                    failed = exchange._random.random() < exchange.error_rate
+                try:
+                    time.sleep(exchange.latency)
+                    if failed:
+                        status, payload = 500, {"errors": [{"msg": "Injected error"}]}
+                    else:
+                        with exchange._lock:
+                            status, payload = exchange.handle(
+                                method, url.path, query, data
+                            )
+                finally:
+                    with exchange._lock:
+                        exchange._in_flight -= 1
+
+                response = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def do_GET(self):
+                self._respond("GET")
+
+            def do_POST(self):
+                self._respond("POST")
+
+            def do_DELETE(self):
+                self._respond("DELETE")
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class FakeDydxWebsocket:
+    """
+    Streams the prices of a FakeDydxExchange on the v3_markets and v3_trades channels
+    of the websocket API, one index price update and one trade per market every
+    interval seconds.
+
+    Args:
+        exchange (FakeDydxExchange): Provides the markets and their prices
+        interval (float): Seconds between updates
+    """
+
+    def __init__(self, exchange: FakeDydxExchange, interval: float = 0.1) -> None:
+        self.exchange = exchange
+        self.interval = interval
+        self.num_connections = 0
+        self._loop = None
+        self._runner = None
+        self._websockets = set()
+
+    @property
+    def url(self) -> str:
+        host, port = self._runner.addresses[0][:2]
+        return "ws://{}:{}/v3/ws".format(host, port)
+
+    def start(self, port: int = 0) -> "FakeDydxWebsocket":
+        """Serves in a background thread, on a free port by default"""
+        app = web.Application()
+        app.router.add_get("/v3/ws", self._handle)
+        self._runner = web.AppRunner(app)
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        self._loop.run_until_complete(site.start())
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        logger.info("Fake dydx websocket listening on {}".format(self.url))
+        return self
+
+    def stop(self) -> None:
+        async def close():
+            for websocket in list(self._websockets):
+                await websocket.close()
+            await self._runner.cleanup()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def __enter__(self) -> "FakeDydxWebsocket":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def _index_prices(self, now: dt.datetime) -> dict:
+        return {
+            market: {"indexPrice": "{:f}".format(self.exchange.price(market, now))}
+            for market in self.exchange.markets
+        }
+
+    def _trades(self, market: str, now: dt.datetime) -> dict:
+        trade = {
+            "side": "BUY",
+            "size": "1",
+            "price": "{:f}".format(self.exchange.price(market, now)),
+            "createdAt": _format_timestamp(now),
+        }
+        return {"trades": [trade]}
+
+    async def _handle(self, request: web.Request) -> web.WebSocketResponse:
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        self.num_connections += 1
+        self._websockets.add(websocket)
+
+        connection_id = uuid.uuid4().hex
+        message_ids = iter(range(1_000_000_000))
+        channels = []
+
+        async def send(message_type: str, channel: str, contents: dict, **kwargs):
+            await websocket.send_json(
+                {
+                    "type": message_type,
+                    "connection_id": connection_id,
+                    "message_id": next(message_ids),
+                    "channel": channel,
+                    "contents": contents,
+                    **kwargs,
+                }
+            )
+
+        async def stream():
+            while not websocket.closed:
+                await asyncio.sleep(self.interval)
+                now = dt.datetime.now(dt.timezone.utc)
+                for channel, market in list(channels):
+                    if channel == "v3_markets":
+                        await send("channel_data", channel, self._index_prices(now))
+                    else:
+                        contents = self._trades(market, now)
+                        await send("channel_data", channel, contents, id=market)
+
+        await websocket.send_json({"type": "connected", "connection_id": connection_id})
+        streamer = asyncio.create_task(stream())
+        try:
+            async for message in websocket:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                request = json.loads(message.data)
+                now = dt.datetime.now(dt.timezone.utc)
+                if request.get("channel") == "v3_markets":
+                    channels.append(("v3_markets", None))
+                    contents = {"markets": self._index_prices(now)}
+                    await send("subscribed", "v3_markets", contents)
+                elif request.get("id") in self.exchange.markets:
+                    market = request["id"]
+                    channels.append(("v3_trades", market))
+                    contents = self._trades(market, now)
+                    await send("subscribed", "v3_trades", contents, id=market)
+                else:
+                    await websocket.send_json(
+                        {
+                            "type": "error",
+                            "connection_id": connection_id,
+                            "message": "Invalid subscription",
+                        }
+                    )
+        finally:
+            streamer.cancel()
+            self._websockets.discard(websocket)
+        return websocket
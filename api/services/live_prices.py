@@ -0,0 +1,194 @@
+"""
+Live prices and intraday bars per market, fed from the dydx websocket by the market
+data worker (api.services.market_data).
+
+The worker keeps them in the process-wide `live_prices`, and also copies the prices to
+the Django cache, so that other processes see them when CACHES is a shared backend.
+"""
+import datetime as dt
+import threading
+import time
+from typing import NamedTuple
+
+import structlog
+from django.conf import settings
+from django.core.cache import cache
+
+from api.services.dydx_models import CANDLE_RESOLUTIONS
+
+logger = structlog.get_logger(__name__)
+
+CACHE_KEY = "live_price:{}"
+
+
+class LivePrice(NamedTuple):
+    price: float
+    # time.time() of the update, rather than time.monotonic(), to compare across
+    # processes
+    updated_at: float
+
+
+class Bar(NamedTuple):
+    market: str
+    resolution: str
+    period_start: dt.datetime
+    open: float
+    high: float
+    low: float
+    close: float
+
+    @property
+    def period_end(self) -> dt.datetime:
+        return self.period_start + CANDLE_RESOLUTIONS[self.resolution]
+
+
+def get_period_start(date: dt.datetime, resolution: str) -> dt.datetime:
+    """The start of the period of resolution that date falls in, like dydx candles"""
+    seconds = CANDLE_RESOLUTIONS[resolution].total_seconds()
+    timestamp = date.timestamp()
+    return dt.datetime.fromtimestamp(timestamp - timestamp % seconds, dt.timezone.utc)
+
+
+class LivePriceCache:
+    """
+    The index price and the last trade of every market, and the bars built from the
+    trades, one per (market, resolution) while its period lasts.
+
+    Bars are only built for the periods that start after the trades are observed, see
+    start_observing, so that no bar misses the trades from before a connection.
+
+    Args:
+        resolutions (list[str]): Resolutions of the bars, see CANDLE_RESOLUTIONS
+    """
+
+    def __init__(self, resolutions: list[str]) -> None:
+        self.resolutions = list(resolutions)
+        self._index_prices: dict[str, LivePrice] = {}
+        self._trade_prices: dict[str, LivePrice] = {}
+        self._bars: dict[tuple[str, str], Bar] = {}
+        self._completed: list[Bar] = []
+        # Start of the trades seen without interruption, None while not connected
+        self._observed_since: dt.datetime | None = None
+        self._lock = threading.Lock()
+
+    def set_index_price(self, market: str, price: float) -> None:
+        with self._lock:
+            self._index_prices[market] = LivePrice(price, time.time())
+
+    def start_observing(self, since: dt.datetime) -> None:
+        """Builds bars for the periods starting from since, e.g. a new connection"""
+        with self._lock:
+            self._bars.clear()
+            self._observed_since = since
+
+    def stop_observing(self) -> None:
+        """Drops the bars being built, which miss the trades until the next connection"""
+        with self._lock:
+            self._bars.clear()
+            self._observed_since = None
+
+    def add_trade(self, market: str, price: float, date: dt.datetime) -> None:
+        """Updates the last trade and the bars of market with a trade made at date"""
+        with self._lock:
+            self._trade_prices[market] = LivePrice(price, time.time())
+            for resolution in self.resolutions:
+                key = (market, resolution)
+                period_start = get_period_start(date, resolution)
+                if self._observed_since is None or period_start < self._observed_since:
+                    # Part of the period's trades weren't observed
+                    continue
+                bar = self._bars.get(key)
+                if bar is None or period_start > bar.period_start:
+                    if bar is not None:
+                        self._completed.append(bar)
+                    self._bars[key] = Bar(
+                        market, resolution, period_start, price, price, price, price
+                    )
+                elif period_start == bar.period_start:
+                    self._bars[key] = bar._replace(
+                        high=max(bar.high, price), low=min(bar.low, price), close=price
+                    )
+                # Trades arriving after their bar was completed are dropped, so each
+                # bar is only written once
+
+    def get(self, market: str) -> LivePrice | None:
+        """The index price of market, or its last trade before any index price"""
+        with self._lock:
+            return self._index_prices.get(market) or self._trade_prices.get(market)
+
+    def get_price(self, market: str, max_age: float) -> float | None:
+        """The price of market, or None if there is none newer than max_age seconds"""
+        live_price = self.get(market)
+        if live_price is None or time.time() - live_price.updated_at > max_age:
+            return None
+        return live_price.price
+
+    def current_bar(self, market: str, resolution: str) -> Bar | None:
+        """The bar of the period that is still being built"""
+        with self._lock:
+            return self._bars.get((market, resolution))
+
+    def pop_completed_bars(self, now: dt.datetime | None = None) -> list[Bar]:
+        """
+        Removes and returns the bars whose period is over, including the ones that
+        no trade has completed yet because their market is quiet.
+        """
+        if now is None:
+            now = dt.datetime.now(dt.timezone.utc)
+        with self._lock:
+            for key, bar in list(self._bars.items()):
+                if bar.period_end <= now:
+                    self._completed.append(bar)
+                    del self._bars[key]
+            completed, self._completed = self._completed, []
+            return completed
+
+    def publish(self, timeout: float) -> None:
+        """Copies the prices to the Django cache, where they expire after timeout"""
+        with self._lock:
+            markets = self._index_prices.keys() | self._trade_prices.keys()
+            prices = {
+                CACHE_KEY.format(market): tuple(
+                    self._index_prices.get(market) or self._trade_prices[market]
+                )
+                for market in markets
+            }
+        if prices:
+            cache.set_many(prices, timeout=timeout)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._index_prices.clear()
+            self._trade_prices.clear()
+            self._bars.clear()
+            self._completed.clear()
+            self._observed_since = None
+
+
+live_prices = LivePriceCache(settings.MARKET_DATA_RESOLUTIONS)
+
+
+def get_live_price(market: str, max_age: float | None = None) -> float | None:
+    """
+    The live price of market, from this process or else from the Django cache.
+
+    Args:
+        max_age (float): Prices older than this many seconds are ignored, defaults to
+            LIVE_PRICE_MAX_AGE_SECONDS
+
+    Returns:
+        float | None: None when the market data worker has no recent price
+    """
+    if max_age is None:
+        max_age = settings.LIVE_PRICE_MAX_AGE_SECONDS
+    price = live_prices.get_price(market, max_age)
+    if price is not None:
+        return price
+
+    cached = cache.get(CACHE_KEY.format(market))
+    if cached is None:
+        return None
+    live_price = LivePrice(*cached)
+    if time.time() - live_price.updated_at > max_age:
+        return None
+    return live_price.price
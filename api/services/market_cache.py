@@ -0,0 +1,89 @@
+import threading
+import time
+from decimal import ROUND_HALF_EVEN, Decimal
+from typing import Callable, NamedTuple
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+
+class MarketPrecision(NamedTuple):
+    """The increments that order prices and sizes of a market must be multiples of"""
+
+    tick_size: Decimal
+    step_size: Decimal
+
+
+class MarketsSnapshot(NamedTuple):
+    # The get_markets response, e.g. {"markets": {"ETH-USD": {...}}}
+    markets: dict
+    precision: dict[str, MarketPrecision]
+    # time.monotonic() of the download
+    loaded_at: float
+
+
+def round_to_increment(value: float, increment: Decimal) -> Decimal:
+    """Rounds value to the nearest multiple of increment, e.g. of a tick size"""
+    return (Decimal(repr(value)) / increment).to_integral_value(
+        ROUND_HALF_EVEN
+    ) * increment
+
+
+def _to_snapshot(markets: dict) -> MarketsSnapshot:
+    precision = {
+        market: MarketPrecision(
+            Decimal(data["tickSize"]).normalize(), Decimal(data["stepSize"]).normalize()
+        )
+        for market, data in markets["markets"].items()
+    }
+    return MarketsSnapshot(markets, precision, time.monotonic())
+
+
+class MarketCache:
+    """
+    The markets, downloaded again once they are older than ttl seconds.
+
+    A stale snapshot is still returned while a background thread downloads the new
+    one, so callers only wait for the first download.
+    """
+
+    def __init__(self, load: Callable[[], dict], ttl: float) -> None:
+        """
+        Args:
+            load (Callable): Downloads the markets, e.g. client.public.get_markets().data
+            ttl (float): Seconds after which the markets are downloaded again
+        """
+        self.load = load
+        self.ttl = ttl
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._refreshing = None
+
+    def get(self) -> MarketsSnapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.refresh()
+
+        if time.monotonic() - snapshot.loaded_at > self.ttl:
+            with self._lock:
+                if self._refreshing is None or not self._refreshing.is_alive():
+                    self._refreshing = threading.Thread(
+                        target=self._refresh_in_background, daemon=True
+                    )
+                    self._refreshing.start()
+        return snapshot
+
+    def refresh(self) -> MarketsSnapshot:
+        """Downloads the markets now"""
+        snapshot = _to_snapshot(self.load())
+        self._snapshot = snapshot
+        return snapshot
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        except Exception as e:
+            # Keep using the stale markets, and try again after another ttl
+            logger.error("Error refreshing the markets", exc_info=e)
+            self._snapshot = self._snapshot._replace(loaded_at=time.monotonic())
@@ -0,0 +1,189 @@
+"""
+Ingests dydx market data from the websocket API into api.services.live_prices, and
+writes the bars built from the trades to DydxCandle, for the periods without a candle.
+
+https://dydxprotocol.github.io/v3-teacher/#websocket-api
+"""
+import asyncio
+import datetime as dt
+import json
+
+import aiohttp
+import structlog
+from django.conf import settings
+from django.db import close_old_connections
+
+from api import models
+from api.services.live_prices import LivePriceCache, live_prices
+from api.services.sync import CANDLE_BATCH_SIZE, parse_dydx_timestamp
+
+logger = structlog.get_logger(__name__)
+
+
+class MarketDataWorker:
+    """
+    Subscribes to the markets channel, for the index prices, and to the trades channel
+    of each market. Every flush_interval seconds, the completed bars are written to
+    DydxCandle and the prices are copied to the Django cache. The connection is opened
+    again, with a backoff, when it drops.
+
+    Args:
+        url (str): The websocket API, e.g. wss://api.dydx.exchange/v3/ws
+        instrument_ids (dict[str, int]): Instrument ids by the markets to subscribe to
+        cache (LivePriceCache): Where the prices and bars go
+        flush_interval (float): Seconds between writes
+        max_reconnect_delay (float): Longest wait before connecting again, in seconds
+    """
+
+    def __init__(
+        self,
+        url: str,
+        instrument_ids: dict[str, int],
+        cache: LivePriceCache = live_prices,
+        flush_interval: float = settings.MARKET_DATA_FLUSH_SECONDS,
+        max_reconnect_delay: float = 30.0,
+    ) -> None:
+        self.url = url
+        self.instrument_ids = instrument_ids
+        self.cache = cache
+        self.flush_interval = flush_interval
+        self.max_reconnect_delay = max_reconnect_delay
+        self.num_messages = 0
+        self.num_connections = 0
+
+    async def run(self, stop: asyncio.Event | None = None) -> None:
+        """Ingests until stop is set, then writes the bars that are complete"""
+        if stop is None:
+            stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        flusher = asyncio.create_task(self._flush_periodically(stop))
+        reconnect_delay = 1.0
+        try:
+            async with aiohttp.ClientSession() as session:
+                while not stop.is_set():
+                    try:
+                        async with session.ws_connect(
+                            self.url, heartbeat=30
+                        ) as websocket:
+                            self.num_connections += 1
+                            logger.info("Connected to {}".format(self.url))
+                            reconnect_delay = 1.0
+                            self.cache.start_observing(dt.datetime.now(dt.timezone.utc))
+                            try:
+                                await self._subscribe(websocket)
+                                await self._consume(websocket, stop)
+                            finally:
+                                self.cache.stop_observing()
+                        if stop.is_set():
+                            break
+                        logger.warning("Market data connection closed")
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        logger.warning("Market data connection failed", exc_info=e)
+
+                    logger.info("Reconnecting in {}s".format(reconnect_delay))
+                    try:
+                        await asyncio.wait_for(stop.wait(), reconnect_delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    reconnect_delay = min(reconnect_delay * 2, self.max_reconnect_delay)
+        finally:
+            flusher.cancel()
+            await loop.run_in_executor(None, self._flush_in_thread)
+
+    async def _subscribe(self, websocket: aiohttp.ClientWebSocketResponse) -> None:
+        await websocket.send_json({"type": "subscribe", "channel": "v3_markets"})
+        for market in self.instrument_ids:
+            await websocket.send_json(
+                {"type": "subscribe", "channel": "v3_trades", "id": market}
+            )
+
+    async def _consume(
+        self, websocket: aiohttp.ClientWebSocketResponse, stop: asyncio.Event
+    ) -> None:
+        async def close_on_stop():
+            await stop.wait()
+            await websocket.close()
+
+        # Closing the connection ends the messages
+        closer = asyncio.create_task(close_on_stop())
+        try:
+            async for message in websocket:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    self.handle_message(json.loads(message.data))
+                elif message.type == aiohttp.WSMsgType.ERROR:
+                    raise aiohttp.ClientConnectionError(str(websocket.exception()))
+        finally:
+            closer.cancel()
+
+    async def _flush_periodically(self, stop: asyncio.Event) -> None:
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            await asyncio.sleep(self.flush_interval)
+            try:
+                # The ORM is synchronous, so it runs in a thread
+                await loop.run_in_executor(None, self._flush_in_thread)
+            except Exception as e:
+                logger.error("Error writing market data", exc_info=e)
+
+    def _flush_in_thread(self) -> None:
+        close_old_connections()
+        self.flush()
+
+    def handle_message(self, message: dict) -> None:
+        self.num_messages += 1
+        if message["type"] == "error":
+            logger.error("Market data error: {}".format(message.get("message")))
+            return
+        if message["type"] not in ("subscribed", "channel_data"):
+            return
+
+        contents = message["contents"]
+        if message["channel"] == "v3_markets":
+            # The first message has every market, the updates only what changed
+            markets = (
+                contents["markets"] if message["type"] == "subscribed" else contents
+            )
+            for market, data in markets.items():
+                if "indexPrice" in data:
+                    self.cache.set_index_price(market, float(data["indexPrice"]))
+        elif message["channel"] == "v3_trades" and message["type"] == "channel_data":
+            # The first message has the recent trades, which the candle sync covers
+            for trade in sorted(contents["trades"], key=lambda t: t["createdAt"]):
+                self.cache.add_trade(
+                    message["id"],
+                    float(trade["price"]),
+                    parse_dydx_timestamp(trade["createdAt"]),
+                )
+
+    def flush(self, now: dt.datetime | None = None) -> int:
+        """
+        Writes the bars whose period is over before now, and copies the prices to the
+        Django cache.
+
+        Bars are only inserted for periods without a candle, so the candles synced
+        from the REST API, which has every trade, are never overwritten.
+
+        Returns:
+            int: The number of bars written
+        """
+        self.cache.publish(timeout=settings.LIVE_PRICE_MAX_AGE_SECONDS)
+        candles = [
+            models.DydxCandle(
+                instrument_id=self.instrument_ids[bar.market],
+                resolution=bar.resolution,
+                period_start=bar.period_start,
+                period_end=bar.period_end,
+                open=bar.open,
+                high=bar.high,
+                low=bar.low,
+                close=bar.close,
+            )
+            for bar in self.cache.pop_completed_bars(now)
+            if bar.market in self.instrument_ids
+        ]
+        if candles:
+            models.DydxCandle.objects.bulk_create(
+                candles, batch_size=CANDLE_BATCH_SIZE, ignore_conflicts=True
+            )
+            logger.info("Wrote {} bars".format(len(candles)))
+        return len(candles)
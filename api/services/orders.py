@@ -0,0 +1,79 @@
+import time
+from typing import Callable, Iterable
+
+import structlog
+from dydx3.constants import ORDER_STATUS_CANCELED, ORDER_STATUS_FILLED
+
+logger = structlog.get_logger(__name__)
+
+# Statuses after which an order doesn't change anymore
+FINAL_ORDER_STATUSES = {ORDER_STATUS_FILLED, ORDER_STATUS_CANCELED}
+
+
+class OrderTracker:
+    """
+    Waits for specific orders to be filled or canceled, polling each of them with an
+    exponential backoff: right after submission an order usually settles within a
+    fraction of a second, while polling slowly afterwards keeps the request rate low.
+    """
+
+    def __init__(
+        self,
+        get_order: Callable[[str], dict],
+        initial_delay: float = 0.1,
+        max_delay: float = 2.0,
+        backoff: float = 2.0,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        """
+        Args:
+            get_order (Callable): Fetches an order by id, e.g.
+                lambda order_id: client.private.get_order_by_id(order_id).data["order"]
+            initial_delay (float): Seconds before the first poll
+            max_delay (float): Longest number of seconds between two polls
+            backoff (float): Factor the delay grows by after each poll
+        """
+        self.get_order = get_order
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.sleep = sleep
+
+    def wait(self, order_id: str, timeout_seconds: float = 120) -> dict:
+        """Waits for one order, see wait_all"""
+        return self.wait_all([order_id], timeout_seconds)[order_id]
+
+    def wait_all(
+        self, order_ids: Iterable[str], timeout_seconds: float = 120
+    ) -> dict[str, dict]:
+        """
+        Waits until every order is filled or canceled.
+
+        Returns:
+            dict[str, dict]: The final state of each order by id
+
+        Raises:
+            TimeoutError: If an order is still pending after timeout_seconds
+        """
+        pending = list(dict.fromkeys(order_ids))
+        orders = {}
+        deadline = time.monotonic() + timeout_seconds
+        delay = self.initial_delay
+
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    "Timed out waiting for orders {}".format(", ".join(pending))
+                )
+            self.sleep(min(delay, remaining))
+            delay = min(delay * self.backoff, self.max_delay)
+
+            for order_id in list(pending):
+                order = self.get_order(order_id)
+                if order["status"] in FINAL_ORDER_STATUSES:
+                    logger.debug("Order {} is {}".format(order_id, order["status"]))
+                    orders[order_id] = order
+                    pending.remove(order_id)
+
+        return orders
@@ -0,0 +1,231 @@
+"""
+Optional partitioning of the candle table on postgres, by resolution and then by month
+of period_start. Queries over a time range only read the months they cover, and the
+retention of a resolution drops whole months instead of deleting their rows.
+
+The table is converted once with `manage.py partition_candles`, which then also creates
+the partitions of the coming months. Django keeps using it like the plain table.
+"""
+import datetime as dt
+
+import structlog
+from django.db import connection, transaction
+
+from api import models
+
+logger = structlog.get_logger(__name__)
+
+TABLE = models.DydxCandle._meta.db_table
+
+
+def _month_start(date: dt.datetime) -> dt.datetime:
+    return dt.datetime(date.year, date.month, 1, tzinfo=dt.timezone.utc)
+
+
+def _next_month(date: dt.datetime) -> dt.datetime:
+    return _month_start(date + dt.timedelta(days=32))
+
+
+def resolution_partition(resolution: str) -> str:
+    return "{}_{}".format(TABLE, resolution.lower())
+
+
+def month_partition(resolution: str, month: dt.datetime) -> str:
+    return "{}_{:%Y%m}".format(resolution_partition(resolution), month)
+
+
+def is_partitioned() -> bool:
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+            "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s)",
+            [TABLE],
+        )
+        return cursor.fetchone()[0]
+
+
+def _create_month_partitions(
+    cursor, resolution: str, start: dt.datetime, end: dt.datetime
+) -> int:
+    """Creates the missing monthly partitions of resolution from start until end"""
+    num_created = 0
+    month = _month_start(start)
+    while month < end:
+        cursor.execute(
+            "SELECT to_regclass(%s) IS NULL", [month_partition(resolution, month)]
+        )
+        if cursor.fetchone()[0]:
+            cursor.execute(
+                "CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)".format(
+                    month_partition(resolution, month), resolution_partition(resolution)
+                ),
+                [month, _next_month(month)],
+            )
+            num_created += 1
+        month = _next_month(month)
+    return num_created
+
+
+def _create_resolution_partition(cursor, resolution: str) -> None:
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} FOR VALUES IN (%s) "
+        "PARTITION BY RANGE (period_start)".format(
+            resolution_partition(resolution), TABLE
+        ),
+        [resolution],
+    )
+    # Candles outside of the monthly partitions
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS {0}_default PARTITION OF {0} DEFAULT".format(
+            resolution_partition(resolution)
+        )
+    )
+
+
+def convert_to_partitioned(resolutions: list[str], months_ahead: int = 3) -> None:
+    """
+    Replaces the candle table by a partitioned one with the same columns, constraints
+    and indexes, and copies the candles over. It runs in one transaction that locks
+    the table until the copy is done, so run it during maintenance.
+
+    Postgres requires the partition keys in every unique constraint, so the primary
+    key becomes (id, resolution, period_start). ids stay unique through their
+    sequence.
+    """
+    if connection.vendor != "postgresql":
+        raise NotImplementedError("Partitioning requires postgres")
+    if is_partitioned():
+        raise ValueError("{} is already partitioned".format(TABLE))
+
+    old_table = "{}_unpartitioned".format(TABLE)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("ALTER TABLE {} RENAME TO {}".format(TABLE, old_table))
+        cursor.execute(
+            "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) "
+            "PARTITION BY LIST (resolution)".format(TABLE, old_table)
+        )
+        cursor.execute(
+            "SELECT DISTINCT resolution, min(period_start) FROM {} "
+            "GROUP BY resolution".format(old_table)
+        )
+        oldest = dict(cursor.fetchall())
+        end = _month_start(dt.datetime.now(dt.timezone.utc))
+        for _ in range(months_ahead + 1):
+            end = _next_month(end)
+        for resolution in sorted(set(resolutions) | set(oldest)):
+            _create_resolution_partition(cursor, resolution)
+            _create_month_partitions(
+                cursor, resolution, oldest.get(resolution, end), end
+            )
+        cursor.execute(
+            "CREATE TABLE {0}_default PARTITION OF {0} DEFAULT".format(TABLE)
+        )
+
+        cursor.execute("INSERT INTO {} SELECT * FROM {}".format(TABLE, old_table))
+        cursor.execute("DROP TABLE {}".format(old_table))
+
+        # The old table's names are free again
+        cursor.execute(
+            "ALTER TABLE {} ADD PRIMARY KEY (id, resolution, period_start)".format(
+                TABLE
+            )
+        )
+        cursor.execute(
+            "ALTER TABLE {} ADD CONSTRAINT unique_dydx_candle "
+            "UNIQUE (instrument_id, resolution, period_start)".format(TABLE)
+        )
+        cursor.execute(
+            "CREATE INDEX dydx_candle_end_idx ON {} "
+            "(instrument_id, resolution, period_end) INCLUDE (period_start, close)".format(
+                TABLE
+            )
+        )
+        cursor.execute(
+            "CREATE INDEX dydx_candle_updated_idx ON {} "
+            "(instrument_id, resolution, updated_at)".format(TABLE)
+        )
+        cursor.execute(
+            "ALTER TABLE {} ADD FOREIGN KEY (instrument_id) REFERENCES {} (id) "
+            "DEFERRABLE INITIALLY DEFERRED".format(
+                TABLE, models.Instrument._meta.db_table
+            )
+        )
+        cursor.execute("CREATE SEQUENCE {0}_id_seq OWNED BY {0}.id".format(TABLE))
+        cursor.execute(
+            "ALTER TABLE {0} ALTER COLUMN id SET DEFAULT nextval('{0}_id_seq')".format(
+                TABLE
+            )
+        )
+        cursor.execute(
+            "SELECT setval('{0}_id_seq', coalesce(max(id), 0) + 1, false) "
+            "FROM {0}".format(TABLE)
+        )
+    logger.info("Partitioned {}".format(TABLE), resolutions=sorted(oldest))
+
+
+def ensure_partitions(resolutions: list[str], months_ahead: int = 3) -> int:
+    """
+    Creates the partitions of the resolutions for the months until months_ahead
+    from now, if the table is partitioned.
+
+    Returns:
+        int: The number of partitions created
+    """
+    if not is_partitioned():
+        return 0
+
+    now = dt.datetime.now(dt.timezone.utc)
+    end = _month_start(now)
+    for _ in range(months_ahead + 1):
+        end = _next_month(end)
+    num_created = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        for resolution in resolutions:
+            _create_resolution_partition(cursor, resolution)
+            num_created += _create_month_partitions(
+                cursor, resolution, _month_start(now), end
+            )
+    return num_created
+
+
+def drop_expired_partitions(resolution: str, cutoff: dt.datetime) -> int:
+    """
+    Drops the monthly partitions of resolution that end before cutoff, which is
+    instant compared to deleting their rows.
+
+    Returns:
+        int: The number of candles dropped
+    """
+    if not is_partitioned():
+        return 0
+
+    parent = resolution_partition(resolution)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s",
+            [parent],
+        )
+        partitions = [row[0] for row in cursor.fetchall()]
+
+    num_dropped = 0
+    for partition in sorted(partitions):
+        suffix = partition[len(parent) + 1 :]
+        if not suffix.isdigit():
+            # The default partition
+            continue
+        month = dt.datetime.strptime(suffix, "%Y%m").replace(tzinfo=dt.timezone.utc)
+        if _next_month(month) > cutoff:
+            continue
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM {}".format(partition))
+            num_dropped += cursor.fetchone()[0]
+            cursor.execute(
+                "ALTER TABLE {} DETACH PARTITION {}".format(parent, partition)
+            )
+            cursor.execute("DROP TABLE {}".format(partition))
+        logger.info("Dropped partition {}".format(partition))
+    return num_dropped
@@ -1,61 +1,278 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 
 import structlog
+from django.conf import settings
+from dydx3.constants import (
+    ORDER_SIDE_BUY,
+    ORDER_SIDE_SELL,
+    ORDER_STATUS_FILLED,
+    TIME_IN_FORCE_IOC,
+)
 
 from api import models
-from api.services.dydx_trader import DydxTrader
+from api.services.dydx_trader import DydxTrader, get_trader
 
 logger = structlog.get_logger(__name__)
 
+# Size of a position in usd, split evenly between its two legs
+POSITION_SIZE_USD = 200
+
+# How much worse than the index price a compensating order may fill, so it fills
+# right away
+COMPENSATION_SLIPPAGE = 0.05
+
+
+class OrderNotFilledError(Exception):
+    pass
+
+
+class LegFailedError(Exception):
+    """One leg of a pair trade failed, and the other one was unwound"""
+
 
 def open_position(instr: models.Instrument, base: models.Instrument) -> models.Position:
+    if settings.PAIR_TRADE_EXECUTION == "concurrent":
+        return open_position_concurrently(instr, base)
+
     # Short at 10x leverage, and long the same amount of base at 10x leverage
 
     # leverage is implicit, based on the position size
     # Position size be a multiple of 20 because each
     # individual order must be a multiple of 10 for dydx
 
-    sleep_time_seconds = 15
-    pos_size_usd = 200  # size in usd
+    pos_size_usd = POSITION_SIZE_USD  # size in usd
     trade_size_usd = pos_size_usd / 2.0
 
-    trader = DydxTrader()
+    trader = get_trader()
 
     # Short the instrument
     instr_price = trader.get_price(instr.dydx_market_id)
     instr_trade_size = trade_size_usd / instr_price
-
-    trader.block_until_no_pending_orders()
     short_res = trader.short(instr.dydx_market_id, instr_price, instr_trade_size)
+    short_acked_at = time.perf_counter()
 
-    # TODO: my guess is we dont need the sleep, we need a "check for pending orders"
-    # function that blocks until that's good, then it sends in the order with some kind of timeout
-    # trader.block_until_no_pending_orders(timeout=120_seconds)  and then raises TimeoutError if the timeout is hit.
+    # Only long the base once the short went through, so we're never just long base
+    try:
+        short_order = trader.wait_for_order(short_res["order_data"]["order"]["id"])
+    except Exception:
+        _unwind(trader, short_res["order_data"]["order"])
+        raise
+    short_res["final_status"] = short_order["status"]
+    if short_order["status"] != ORDER_STATUS_FILLED:
+        # A canceled short may have partially filled, and no long hedges it
+        _compensate(trader, short_order)
+        raise OrderNotFilledError(
+            "Short of {} was {}".format(instr.dydx_market_id, short_order["status"])
+        )
 
-    # Long the base
+    # The short is open from here on, so it stays recorded as unhedged until the long
+    # fills, or both legs are closed again
     base_price = trader.get_price(base.dydx_market_id)
-    base_trade_size = trade_size_usd / base_price
-    trader.block_until_no_pending_orders()
-    long_res = trader.long(base.dydx_market_id, base_price, base_trade_size)
+    pos = models.Position.objects.create(
+        instrument=instr,
+        base_instrument=base,
+        position_size=pos_size_usd,
+        input_instr_price=instr_price,
+        input_base_price=base_price,
+        extra_data={"short": short_res, "execution": "sequential", "hedged": False},
+    )
+
+    # Long the base
+    long_res = None
+    try:
+        base_trade_size = trade_size_usd / base_price
+        long_res = trader.long(base.dydx_market_id, base_price, base_trade_size)
+        long_acked_at = time.perf_counter()
+        pos.extra_data["long"] = long_res
+
+        long_order = trader.wait_for_order(long_res["order_data"]["order"]["id"])
+        long_res["final_status"] = long_order["status"]
+        if long_order["status"] != ORDER_STATUS_FILLED:
+            raise LegFailedError(
+                "The long order of {}/{} was {}".format(
+                    instr.symbol, base.symbol, long_order["status"]
+                )
+            )
+    except Exception:
+        # If unwinding fails, the position stays recorded as unhedged
+        pos.save()
+        try:
+            if long_res is not None:
+                _unwind(trader, long_res["order_data"]["order"])
+        finally:
+            _compensate(trader, short_order)
+        pos.delete()
+        raise
+
+    pos.extra_data.update(
+        {
+            "hedged": True,
+            "leg_latency_seconds": long_acked_at - short_acked_at,
+        }
+    )
+    pos.save()
+    return pos
 
-    # sleep to let the order go through. this may be needed for the position id to increment
-    logger.debug("Sleeping {} seconds".format(sleep_time_seconds))
-    time.sleep(sleep_time_seconds)
 
-    extra_data = {
-        "short": short_res,
-        "long": long_res,
+def _submit(trader: DydxTrader, order_params: dict) -> tuple[dict, float]:
+    res = trader.submit_order(order_params)
+    return res, time.perf_counter()
+
+
+def _filled_size(order: dict) -> Decimal:
+    if order["status"] == ORDER_STATUS_FILLED:
+        return Decimal(order["size"])
+    # A canceled order may have been partially filled
+    return Decimal(order["size"]) - Decimal(order.get("remainingSize", order["size"]))
+
+
+def _compensate(trader: DydxTrader, order: dict) -> dict | None:
+    """
+    Submits the opposite of the filled part of order, and waits for it. It is an IOC
+    order, since dydx only accepts reduce only orders that don't rest on the book.
+    """
+    size = _filled_size(order)
+    if not size:
+        return None
+
+    market = order["market"]
+    price = float(trader.markets["markets"][market]["indexPrice"])
+    if order["side"] == ORDER_SIDE_SELL:
+        side, price = ORDER_SIDE_BUY, price * (1 + COMPENSATION_SLIPPAGE)
+    else:
+        side, price = ORDER_SIDE_SELL, price * (1 - COMPENSATION_SLIPPAGE)
+
+    logger.warning("Compensating {} {} of {}".format(order["side"], size, market))
+    res = trader.submit_order(
+        trader.prepare_order(
+            market,
+            side,
+            price,
+            float(size),
+            reduce_only=True,
+            time_in_force=TIME_IN_FORCE_IOC,
+        )
+    )
+    return trader.wait_for_order(res["order_data"]["order"]["id"])
+
+
+def _unwind(trader: DydxTrader, order: dict) -> None:
+    """Cancels order, and compensates whatever part of it filled"""
+    try:
+        trader.cancel_order(order["id"])
+    except Exception as e:
+        # It may have filled already
+        logger.warning("Error canceling order {}".format(order["id"]), exc_info=e)
+
+    order = trader.wait_for_order(order["id"])
+    try:
+        _compensate(trader, order)
+    except Exception as e:
+        logger.error(
+            "Error compensating order {}, the position is unhedged".format(order["id"]),
+            exc_info=e,
+        )
+        raise
+
+
+def open_position_concurrently(
+    instr: models.Instrument, base: models.Instrument
+) -> models.Position:
+    """
+    Opens the same position as open_position, but both orders are signed up front and
+    submitted at the same time, so the position is unhedged for as little time as
+    possible.
+
+    The position is recorded once both orders are acknowledged. If a leg is rejected
+    or doesn't fill, the filled part of the other one is closed with a compensating
+    order, the position is deleted, and LegFailedError is raised.
+    """
+    trade_size_usd = POSITION_SIZE_USD / 2.0
+    trader = get_trader()
+
+    position_id = trader.get_position_id()
+    instr_price = trader.get_price(instr.dydx_market_id)
+    base_price = trader.get_price(base.dydx_market_id)
+    legs = {
+        "short": trader.prepare_order(
+            instr.dydx_market_id,
+            ORDER_SIDE_SELL,
+            instr_price,
+            trade_size_usd / instr_price,
+            position_id,
+        ),
+        "long": trader.prepare_order(
+            base.dydx_market_id,
+            ORDER_SIDE_BUY,
+            base_price,
+            trade_size_usd / base_price,
+            position_id,
+        ),
     }
 
+    with ThreadPoolExecutor(max_workers=len(legs)) as executor:
+        futures = {
+            leg: executor.submit(_submit, trader, order_params)
+            for leg, order_params in legs.items()
+        }
+    results, acked_at, errors = {}, {}, {}
+    for leg, future in futures.items():
+        try:
+            results[leg], acked_at[leg] = future.result()
+        except Exception as e:
+            errors[leg] = e
+
+    if errors:
+        for res in results.values():
+            _unwind(trader, res["order_data"]["order"])
+        leg, error = next(iter(errors.items()))
+        raise LegFailedError(
+            "The {} order of {}/{} was rejected".format(leg, instr.symbol, base.symbol)
+        ) from error
+
+    leg_latency_seconds = abs(acked_at["short"] - acked_at["long"])
+    logger.info(
+        "Opened {}/{}".format(instr.symbol, base.symbol),
+        leg_latency_seconds=leg_latency_seconds,
+    )
     pos = models.Position.objects.create(
         instrument=instr,
         base_instrument=base,
-        position_size=pos_size_usd,
+        position_size=POSITION_SIZE_USD,
         input_instr_price=instr_price,
         input_base_price=base_price,
-        extra_data=extra_data,
+        extra_data={
+            **results,
+            "execution": "concurrent",
+            "leg_latency_seconds": leg_latency_seconds,
+        },
+    )
+
+    orders = trader.order_tracker.wait_all(
+        [res["order_data"]["order"]["id"] for res in results.values()]
     )
+    for res in results.values():
+        res["final_status"] = orders[res["order_data"]["order"]["id"]]["status"]
+    pos.extra_data.update(results)
     pos.save()
+
+    unfilled = [
+        leg
+        for leg, res in results.items()
+        if res["final_status"] != ORDER_STATUS_FILLED
+    ]
+    if unfilled:
+        for res in results.values():
+            _compensate(trader, orders[res["order_data"]["order"]["id"]])
+        pos.delete()
+        raise LegFailedError(
+            "The {} order of {}/{} didn't fill".format(
+                " and ".join(unfilled), instr.symbol, base.symbol
+            )
+        )
+
     return pos
 
 
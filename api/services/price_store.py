@@ -0,0 +1,216 @@
+import datetime as dt
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, NamedTuple
+
+import numpy as np
+import pandas as pd
+import structlog
+from django.conf import settings
+from django.utils import timezone
+
+from api import models
+
+logger = structlog.get_logger(__name__)
+
+# Writes commit a little after their updated_at, so refreshes read the candles written
+# this much before the previous refresh again
+REFRESH_OVERLAP = dt.timedelta(minutes=1)
+
+
+class PriceSeries(NamedTuple):
+    """The candles of one instrument and resolution, sorted by period_start"""
+
+    # Nanoseconds since the epoch, in UTC
+    period_starts: np.ndarray
+    period_ends: np.ndarray
+    closes: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.period_starts)
+
+
+EMPTY_SERIES = PriceSeries(
+    np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+)
+
+
+def to_ns(date: dt.datetime) -> int:
+    """Converts an aware datetime to nanoseconds since the epoch"""
+    return pd.Timestamp(date).value
+
+
+def _merge(series: PriceSeries, new: PriceSeries) -> PriceSeries:
+    """Merges new candles into series, replacing candles with the same period_start"""
+    if not len(new):
+        return series
+    if not len(series) or new.period_starts[0] > series.period_starts[-1]:
+        # New candles are all newer, which is what syncs produce
+        return PriceSeries(*(np.concatenate(pair) for pair in zip(series, new)))
+
+    period_starts = np.concatenate([new.period_starts, series.period_starts])
+    # np.unique keeps the first occurrence, which is the new candle
+    period_starts, index = np.unique(period_starts, return_index=True)
+    return PriceSeries(
+        period_starts,
+        np.concatenate([new.period_ends, series.period_ends])[index],
+        np.concatenate([new.closes, series.closes])[index],
+    )
+
+
+def to_series(rows: list[tuple[dt.datetime, dt.datetime, float]]) -> PriceSeries:
+    if not rows:
+        return EMPTY_SERIES
+
+    period_starts, period_ends, closes = zip(*rows)
+    series = PriceSeries(
+        pd.DatetimeIndex(period_starts).asi8,
+        pd.DatetimeIndex(period_ends).asi8,
+        np.array(closes, dtype=float),
+    )
+    order = np.argsort(series.period_starts, kind="stable")
+    return PriceSeries(*(array[order] for array in series))
+
+
+class PriceStore:
+    """
+    Process-wide cache of the candles of each (instrument, resolution) as NumPy arrays.
+
+    Series are loaded from the database on first use and kept up to date by
+    upsert_dydx_candles. Series older than max_age seconds are refreshed with the
+    candles written since they were last read, by updated_at, which picks up new,
+    older and updated candles from other processes. The least recently used series are
+    evicted once more than max_points candles are held.
+    """
+
+    def __init__(self, max_points: int, max_age: float) -> None:
+        self.max_points = max_points
+        self.max_age = max_age
+        self._series: OrderedDict[tuple[int, str], PriceSeries] = OrderedDict()
+        self._loaded_at: dict[tuple[int, str], float] = {}
+        # When each series was last read from the database
+        self._read_at: dict[tuple[int, str], dt.datetime] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def num_points(self) -> int:
+        return sum(len(series) for series in self._series.values())
+
+    def get(self, instrument_id: int, resolution: str = "1DAY") -> PriceSeries:
+        return self.get_many([instrument_id], resolution)[instrument_id]
+
+    def get_many(
+        self, instrument_ids: Iterable[int], resolution: str = "1DAY"
+    ) -> dict[int, PriceSeries]:
+        """Returns the series of many instruments, loading missing ones in one query"""
+        instrument_ids = list(dict.fromkeys(instrument_ids))
+        now = time.monotonic()
+
+        with self._lock:
+            missing = [i for i in instrument_ids if (i, resolution) not in self._series]
+            stale = [
+                i
+                for i in instrument_ids
+                if (i, resolution) in self._series
+                and now - self._loaded_at[(i, resolution)] > self.max_age
+            ]
+
+            if missing:
+                self._load(missing, resolution)
+            if stale:
+                self._refresh(stale, resolution)
+
+            result = {}
+            for instrument_id in instrument_ids:
+                key = (instrument_id, resolution)
+                self._series.move_to_end(key)
+                result[instrument_id] = self._series[key]
+
+            self._evict(keep=len(instrument_ids))
+            return result
+
+    def _load(self, instrument_ids: list[int], resolution: str) -> None:
+        read_at = timezone.now()
+        rows: dict[int, list] = {instrument_id: [] for instrument_id in instrument_ids}
+        for instrument_id, *row in (
+            models.DydxCandle.objects.filter(
+                instrument_id__in=instrument_ids, resolution=resolution
+            )
+            .values_list("instrument_id", "period_start", "period_end", "close")
+            .iterator(chunk_size=10_000)
+        ):
+            rows[instrument_id].append(row)
+
+        now = time.monotonic()
+        for instrument_id, instrument_rows in rows.items():
+            self._series[(instrument_id, resolution)] = to_series(instrument_rows)
+            self._loaded_at[(instrument_id, resolution)] = now
+            self._read_at[(instrument_id, resolution)] = read_at
+
+    def _refresh(self, instrument_ids: list[int], resolution: str) -> None:
+        """Merges the candles written since the series were last read"""
+        read_at = timezone.now()
+        since = (
+            min(self._read_at[(i, resolution)] for i in instrument_ids)
+            - REFRESH_OVERLAP
+        )
+        rows: dict[int, list] = {instrument_id: [] for instrument_id in instrument_ids}
+        for instrument_id, *row in models.DydxCandle.objects.filter(
+            instrument_id__in=instrument_ids,
+            resolution=resolution,
+            updated_at__gte=since,
+        ).values_list("instrument_id", "period_start", "period_end", "close"):
+            rows[instrument_id].append(row)
+
+        now = time.monotonic()
+        for instrument_id, instrument_rows in rows.items():
+            key = (instrument_id, resolution)
+            self._series[key] = _merge(self._series[key], to_series(instrument_rows))
+            self._loaded_at[key] = now
+            self._read_at[key] = read_at
+
+    def _evict(self, keep: int = 0) -> None:
+        """Drops least recently used series, except the `keep` most recently used ones"""
+        num_points = self.num_points
+        while num_points > self.max_points and len(self._series) > keep:
+            key, series = self._series.popitem(last=False)
+            del self._loaded_at[key]
+            del self._read_at[key]
+            num_points -= len(series)
+            logger.debug("Evicted price series", key=key)
+
+    def add_candles(self, candles: Iterable[models.DydxCandle]) -> None:
+        """Merges new or updated candles into the series that are already cached"""
+        rows: dict[tuple[int, str], list] = {}
+        for candle in candles:
+            key = (candle.instrument_id, candle.resolution)
+            rows.setdefault(key, []).append(
+                (candle.period_start, candle.period_end, float(candle.close))
+            )
+
+        with self._lock:
+            for key, new_rows in rows.items():
+                if key in self._series:
+                    self._series[key] = _merge(self._series[key], to_series(new_rows))
+            self._evict()
+
+    def invalidate(
+        self, instrument_id: int | None = None, resolution: str | None = None
+    ) -> None:
+        """Drops the matching series, or every series if no filter is given"""
+        with self._lock:
+            for key in list(self._series):
+                if instrument_id is not None and key[0] != instrument_id:
+                    continue
+                if resolution is not None and key[1] != resolution:
+                    continue
+                del self._series[key]
+                del self._loaded_at[key]
+                del self._read_at[key]
+
+
+price_store = PriceStore(
+    max_points=settings.PRICE_STORE_MAX_POINTS,
+    max_age=settings.PRICE_STORE_MAX_AGE_SECONDS,
+)
@@ -0,0 +1,211 @@
+"""
+Retention of the candle and history tables, configured by DYDX_CANDLE_RETENTION_DAYS,
+COINGECKO_OHLC_RETENTION_DAYS and SYNC_HISTORY_RETENTION_DAYS.
+
+Candles past their retention are first downsampled into the DYDX_CANDLE_ROLLUPS
+resolutions made from them, e.g. 1MIN into 1HOUR, so that the history stays available
+at a coarser resolution. Rows are deleted in chunks of RETENTION_DELETE_CHUNK_SIZE, each
+in its own transaction, so no delete holds its locks for long. When the candle table is
+partitioned (api.services.partitions), expired months are dropped instead.
+"""
+import datetime as dt
+
+import structlog
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min, QuerySet
+from django.utils import timezone
+
+from api import models
+from api.services import partitions
+from api.services.candle_cache import get_candle_cache
+from api.services.dydx_models import CANDLE_RESOLUTIONS
+from api.services.price_store import price_store
+from api.services.rollups import get_rollup_order, rollup_dydx_candles
+
+logger = structlog.get_logger(__name__)
+
+
+def delete_in_chunks(queryset: QuerySet, chunk_size: int) -> int:
+    """
+    Deletes the rows of queryset chunk_size at a time, each chunk in a short
+    transaction of its own.
+
+    Returns:
+        int: The number of rows deleted
+    """
+    num_deleted = 0
+    while True:
+        pks = list(queryset.values_list("pk", flat=True)[:chunk_size])
+        if not pks:
+            return num_deleted
+        with transaction.atomic():
+            num_deleted += queryset.model.objects.filter(pk__in=pks).delete()[0]
+
+
+def get_retention_cutoff(
+    resolution: str, keep_days: int, now: dt.datetime
+) -> dt.datetime:
+    """
+    The start of the candles of resolution to keep, moved back to the start of the
+    coarsest period it is rolled up into, so that no rolled up period loses only some
+    of its candles.
+    """
+    cutoff = now - dt.timedelta(days=keep_days)
+    targets = [
+        target
+        for target, source in settings.DYDX_CANDLE_ROLLUPS.items()
+        if source == resolution
+    ]
+    if targets:
+        seconds = max(CANDLE_RESOLUTIONS[target] for target in targets).total_seconds()
+        cutoff = dt.datetime.fromtimestamp(
+            cutoff.timestamp() - cutoff.timestamp() % seconds, dt.timezone.utc
+        )
+    return cutoff
+
+
+def prune_dydx_candles(
+    resolution: str,
+    keep_days: int,
+    now: dt.datetime | None = None,
+    chunk_size: int = settings.RETENTION_DELETE_CHUNK_SIZE,
+) -> int:
+    """
+    Downsamples the candles of resolution older than keep_days into the resolutions
+    rolled up from it, then deletes them.
+
+    The downsampled periods keep the candles that are left, even if some are missing,
+    and existing candles of the coarser resolution, e.g. synced from dydx, are kept
+    as they are.
+
+    Returns:
+        int: The number of candles deleted
+    """
+    now = now or timezone.now()
+    cutoff = get_retention_cutoff(resolution, keep_days, now)
+    targets = [
+        target
+        for target, source in get_rollup_order(settings.DYDX_CANDLE_ROLLUPS)
+        if source == resolution
+    ]
+
+    # One instrument at a time, so every query is a range of the unique index
+    instruments = models.Instrument.objects.filter(
+        id__in=models.DydxCandle.objects.filter(resolution=resolution).values(
+            "instrument_id"
+        )
+    )
+    expired = []
+    for instrument in instruments:
+        oldest = models.DydxCandle.objects.filter(
+            instrument=instrument, resolution=resolution, period_start__lt=cutoff
+        ).aggregate(oldest=Min("period_start"))["oldest"]
+        if oldest is None:
+            continue
+        for target in targets:
+            rollup_dydx_candles(
+                resolution,
+                target,
+                oldest,
+                cutoff,
+                [instrument],
+                complete_only=False,
+                update_existing=False,
+            )
+        expired.append(instrument)
+
+    num_deleted = partitions.drop_expired_partitions(resolution, cutoff)
+    for instrument in expired:
+        num_deleted += delete_in_chunks(
+            models.DydxCandle.objects.filter(
+                instrument=instrument, resolution=resolution, period_start__lt=cutoff
+            ).order_by("period_start"),
+            chunk_size,
+        )
+    price_store.invalidate(resolution=resolution)
+
+    candle_cache = get_candle_cache()
+    if candle_cache is not None and num_deleted:
+        # Refreshing doesn't see deleted candles, so they need a rebuild
+        candle_cache.rebuild(resolution)
+        for target in targets:
+            candle_cache.refresh(target)
+
+    logger.info(
+        "Pruned {} candles before {}".format(resolution, cutoff),
+        num_deleted=num_deleted,
+        downsampled_into=targets,
+    )
+    return num_deleted
+
+
+def prune_coingecko_ohlc(
+    keep_days: int,
+    now: dt.datetime | None = None,
+    chunk_size: int = settings.RETENTION_DELETE_CHUNK_SIZE,
+) -> int:
+    """Deletes the coingecko OHLC older than keep_days"""
+    cutoff = (now or timezone.now()) - dt.timedelta(days=keep_days)
+    num_deleted = 0
+    for instrument in models.Instrument.objects.all():
+        num_deleted += delete_in_chunks(
+            models.CoingeckoInstrumentOHLC.objects.filter(
+                instrument=instrument, date__lt=cutoff
+            ).order_by("date"),
+            chunk_size,
+        )
+    logger.info(
+        "Pruned coingecko OHLC before {}".format(cutoff), num_deleted=num_deleted
+    )
+    return num_deleted
+
+
+def prune_sync_history(
+    keep_days: int,
+    now: dt.datetime | None = None,
+    chunk_size: int = settings.RETENTION_DELETE_CHUNK_SIZE,
+) -> int:
+    """Deletes the sync history older than keep_days"""
+    cutoff = (now or timezone.now()) - dt.timedelta(days=keep_days)
+    num_deleted = delete_in_chunks(
+        models.SyncHistory.objects.filter(date__lt=cutoff).order_by("date"),
+        chunk_size,
+    )
+    logger.info("Pruned sync history before {}".format(cutoff), num_deleted=num_deleted)
+    return num_deleted
+
+
+def apply_retention(now: dt.datetime | None = None) -> dict[str, int]:
+    """
+    Applies every configured retention policy, the finest candle resolution first so
+    that its candles are downsampled before the coarser ones are pruned.
+
+    Returns:
+        dict[str, int]: The number of rows deleted by candle resolution, "coingecko_ohlc"
+            and "sync_history"
+    """
+    now = now or timezone.now()
+    num_deleted = {}
+    for resolution in sorted(
+        settings.DYDX_CANDLE_RETENTION_DAYS, key=CANDLE_RESOLUTIONS.__getitem__
+    ):
+        num_deleted[resolution] = prune_dydx_candles(
+            resolution, settings.DYDX_CANDLE_RETENTION_DAYS[resolution], now
+        )
+    if settings.COINGECKO_OHLC_RETENTION_DAYS:
+        num_deleted["coingecko_ohlc"] = prune_coingecko_ohlc(
+            settings.COINGECKO_OHLC_RETENTION_DAYS, now
+        )
+    if settings.SYNC_HISTORY_RETENTION_DAYS:
+        num_deleted["sync_history"] = prune_sync_history(
+            settings.SYNC_HISTORY_RETENTION_DAYS, now
+        )
+
+    models.SyncHistory.objects.create(
+        date=timezone.now(),
+        records_synced=sum(num_deleted.values()),
+        sync_type="retention",
+        extra_data={"deleted": num_deleted},
+    )
+    return num_deleted
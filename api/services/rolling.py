@@ -0,0 +1,351 @@
+import datetime as dt
+import math
+from collections import deque
+
+import numpy as np
+import structlog
+from django.db.models import Max
+from django.utils import timezone
+
+from api import models
+from api.services.dydx_models import CANDLE_RESOLUTIONS
+from api.services.price_store import (
+    EMPTY_SERIES,
+    REFRESH_OVERLAP,
+    PriceSeries,
+    to_ns,
+    to_series,
+)
+
+logger = structlog.get_logger(__name__)
+
+# The windows, in periods, that evaluate_trade looks at
+ROLLING_WINDOWS = (30, 4)
+
+_SUM_FIELDS = ["count", "sum_x", "sum_y", "sum_xx", "sum_yy", "sum_xy"]
+
+
+def _add(row: models.RollingCorrelation, x: float, y: float, sign: int) -> None:
+    row.count += sign
+    row.sum_x += sign * x
+    row.sum_y += sign * y
+    row.sum_xx += sign * x * x
+    row.sum_yy += sign * y * y
+    row.sum_xy += sign * x * y
+
+
+def _reset(row: models.RollingCorrelation) -> None:
+    for field in _SUM_FIELDS:
+        setattr(row, field, 0)
+    row.buffer = []
+    row.last_period_start = None
+    row.last_period_end = None
+
+
+def _correlation(row: models.RollingCorrelation) -> float | None:
+    n = row.count
+    var_x = n * row.sum_xx - row.sum_x * row.sum_x
+    var_y = n * row.sum_yy - row.sum_y * row.sum_y
+    if n < 2 or var_x <= 0 or var_y <= 0:
+        return None
+    corr = (n * row.sum_xy - row.sum_x * row.sum_y) / math.sqrt(var_x * var_y)
+    # Rounding can push perfectly correlated series slightly out of range
+    return max(-1.0, min(1.0, corr))
+
+
+def advance(
+    row: models.RollingCorrelation,
+    period_starts: np.ndarray,
+    period_ends: np.ndarray,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    period: dt.timedelta,
+) -> bool:
+    """
+    Feeds the candles after row.last_period_start into the running sums. Each new
+    candle is added, and candles that fall out of the window removed, in O(1).
+
+    The arrays are the candles both instruments have, sorted by period_start (in ns).
+    They only need to start after row.last_period_start, or for a row without candles
+    yet, to cover the last `window` periods.
+
+    Returns:
+        bool: Whether the row changed
+    """
+    if not len(period_starts):
+        return False
+
+    window_ns = row.window * _period_ns(period)
+    buffer = deque(row.buffer)
+
+    if row.last_period_start is None:
+        first = np.searchsorted(period_starts, period_starts[-1] - window_ns, "right")
+    else:
+        first = np.searchsorted(period_starts, to_ns(row.last_period_start), "right")
+    if first == len(period_starts):
+        return False
+
+    for i in range(first, len(period_starts)):
+        start, x, y = int(period_starts[i]), float(xs[i]), float(ys[i])
+        buffer.append([start, x, y])
+        _add(row, x, y, 1)
+        while buffer[0][0] <= start - window_ns:
+            _, old_x, old_y = buffer.popleft()
+            _add(row, old_x, old_y, -1)
+
+    row.buffer = list(buffer)
+    row.last_period_start = dt.datetime.fromtimestamp(
+        period_starts[-1] / 1e9, dt.timezone.utc
+    )
+    row.last_period_end = dt.datetime.fromtimestamp(
+        period_ends[-1] / 1e9, dt.timezone.utc
+    )
+    row.correlation = _correlation(row)
+    return True
+
+
+def _period_ns(period: dt.timedelta) -> int:
+    return int(period / dt.timedelta(microseconds=1)) * 1000
+
+
+def _window_changed(
+    row: models.RollingCorrelation,
+    changed: PriceSeries,
+    base_changed: PriceSeries,
+    period: dt.timedelta,
+) -> bool:
+    """
+    Whether candles written since the row was last updated differ from the ones in its
+    window, e.g. a gap was filled or a close was updated in place.
+
+    Args:
+        changed (PriceSeries): Candles of the instrument written since then
+        base_changed (PriceSeries): Candles of the base written since then
+    """
+    if row.last_period_start is None:
+        return False
+
+    last = to_ns(row.last_period_start)
+    window_start = last - row.window * _period_ns(period)
+    buffered = {start: (x, y) for start, x, y in row.buffer}
+    for series, column, other_id in [
+        (changed, 0, row.base_instrument_id),
+        (base_changed, 1, row.instrument_id),
+    ]:
+        in_window = (series.period_starts > window_start) & (
+            series.period_starts <= last
+        )
+        unbuffered = []
+        for start, close in zip(
+            series.period_starts[in_window].tolist(), series.closes[in_window].tolist()
+        ):
+            if start not in buffered:
+                unbuffered.append(start)
+            elif buffered[start][column] != close:
+                return True
+
+        # A candle only one of the instruments has isn't part of the window
+        if (
+            unbuffered
+            and models.DydxCandle.objects.filter(
+                instrument_id=other_id,
+                resolution=row.resolution,
+                period_start__in=[
+                    dt.datetime.fromtimestamp(start / 1e9, dt.timezone.utc)
+                    for start in unbuffered
+                ],
+            ).exists()
+        ):
+            return True
+    return False
+
+
+def _read_candles(
+    instrument_ids: list[int], resolution: str, **filters
+) -> dict[int, PriceSeries]:
+    """The candles of each instrument that match filters"""
+    rows: dict[int, list] = {instrument_id: [] for instrument_id in instrument_ids}
+    for instrument_id, *row in models.DydxCandle.objects.filter(
+        instrument_id__in=instrument_ids, resolution=resolution, **filters
+    ).values_list("instrument_id", "period_start", "period_end", "close"):
+        rows[instrument_id].append(row)
+    return {
+        instrument_id: to_series(instrument_rows)
+        for instrument_id, instrument_rows in rows.items()
+    }
+
+
+def _common_candles(
+    series: PriceSeries, base_series: PriceSeries
+) -> tuple[np.ndarray, ...]:
+    period_starts, i, j = np.intersect1d(
+        series.period_starts,
+        base_series.period_starts,
+        assume_unique=True,
+        return_indices=True,
+    )
+    return period_starts, series.period_ends[i], series.closes[i], base_series.closes[j]
+
+
+def update_rolling_correlations(
+    instruments: list[models.Instrument],
+    base: models.Instrument,
+    windows: tuple[int, ...] = ROLLING_WINDOWS,
+    resolution: str = "1DAY",
+) -> int:
+    """
+    Brings the rolling correlations of every instrument with base up to date with
+    the stored candles, creating missing ones.
+
+    Only the candles after each row's last candle are read, plus the ones inside its
+    window written since it was last updated, through the updated_at index. Rows whose
+    window changed, and new rows, are rebuilt from the candles of their window alone.
+    Candles deleted from inside a window aren't noticed until the row is deleted and
+    rebuilt.
+
+    Returns:
+        int: The number of rows that changed
+    """
+    period = CANDLE_RESOLUTIONS[resolution]
+    read_at = timezone.now()
+    rows = {
+        (row.instrument_id, row.window): row
+        for row in models.RollingCorrelation.objects.filter(
+            instrument__in=instruments,
+            base_instrument=base,
+            resolution=resolution,
+            window__in=windows,
+        )
+    }
+    for instrument in instruments:
+        for window in windows:
+            if (instrument.id, window) not in rows:
+                rows[(instrument.id, window)] = models.RollingCorrelation(
+                    instrument=instrument,
+                    base_instrument=base,
+                    resolution=resolution,
+                    window=window,
+                )
+
+    # Rows without candles, or that never recorded when they read them, are rebuilt
+    to_rebuild = {
+        key
+        for key, row in rows.items()
+        if row.last_period_start is None or row.candles_read_at is None
+    }
+    tracked = {key: row for key, row in rows.items() if key not in to_rebuild}
+    if tracked:
+        changed = _read_candles(
+            list({row.instrument_id for row in tracked.values()}) + [base.id],
+            resolution,
+            period_start__gt=min(
+                row.last_period_start - row.window * period for row in tracked.values()
+            ),
+            updated_at__gte=min(row.candles_read_at for row in tracked.values())
+            - REFRESH_OVERLAP,
+        )
+        for key, row in tracked.items():
+            if _window_changed(
+                row, changed[row.instrument_id], changed[base.id], period
+            ):
+                logger.info("Rebuilding rolling correlation", row=str(row))
+                to_rebuild.add(key)
+
+    # The candles to feed each row, as (instrument candles, base candles)
+    candles: dict[tuple[int, int], tuple[PriceSeries, PriceSeries]] = {}
+    incremental = [row for key, row in rows.items() if key not in to_rebuild]
+    if incremental:
+        new = _read_candles(
+            list({row.instrument_id for row in incremental}) + [base.id],
+            resolution,
+            period_start__gt=min(row.last_period_start for row in incremental),
+        )
+        for row in incremental:
+            candles[(row.instrument_id, row.window)] = (
+                new[row.instrument_id],
+                new[base.id],
+            )
+
+    rebuild_windows: dict[int, int] = {}
+    for instrument_id, window in to_rebuild:
+        rebuild_windows[instrument_id] = max(
+            window, rebuild_windows.get(instrument_id, 0)
+        )
+    latest = dict(
+        models.DydxCandle.objects.filter(
+            instrument_id__in=[*rebuild_windows, base.id], resolution=resolution
+        )
+        .values("instrument_id")
+        .annotate(latest=Max("period_start"))
+        .values_list("instrument_id", "latest")
+        if rebuild_windows
+        else []
+    )
+    for instrument_id, window in rebuild_windows.items():
+        window_candles = (EMPTY_SERIES, EMPTY_SERIES)
+        if instrument_id in latest and base.id in latest:
+            # Only the candles of the window, which ends at the last one both have
+            end = min(latest[instrument_id], latest[base.id])
+            read = _read_candles(
+                [instrument_id, base.id],
+                resolution,
+                period_start__gt=end - window * period,
+            )
+            window_candles = (read[instrument_id], read[base.id])
+        for key in to_rebuild:
+            if key[0] == instrument_id:
+                candles[key] = window_candles
+
+    changed_keys = set()
+    for key, row in rows.items():
+        if key in to_rebuild and row.last_period_start is not None:
+            _reset(row)
+            changed_keys.add(key)
+        if advance(row, *_common_candles(*candles[key]), period):
+            changed_keys.add(key)
+        if key in changed_keys:
+            row.candles_read_at = read_at
+
+    to_create = [rows[key] for key in changed_keys if rows[key].pk is None]
+    to_update = [rows[key] for key in changed_keys if rows[key].pk is not None]
+    models.RollingCorrelation.objects.bulk_create(to_create)
+    models.RollingCorrelation.objects.bulk_update(
+        to_update,
+        _SUM_FIELDS
+        + [
+            "buffer",
+            "last_period_start",
+            "last_period_end",
+            "correlation",
+            "candles_read_at",
+        ],
+    )
+    return len(to_create) + len(to_update)
+
+
+def get_rolling_correlations(
+    instruments: list[models.Instrument],
+    base: models.Instrument,
+    date: dt.datetime,
+    resolution: str = "1DAY",
+) -> dict[tuple[int, int], float]:
+    """
+    Reads the stored correlations that are current as of `date`, i.e. whose latest
+    candle is the last one to end before `date`.
+
+    Returns:
+        dict[tuple[int, int], float]: Correlation by (instrument id, window). It is NaN
+            when there weren't enough candles.
+    """
+    period = CANDLE_RESOLUTIONS[resolution]
+    rows = models.RollingCorrelation.objects.filter(
+        instrument__in=instruments,
+        base_instrument=base,
+        resolution=resolution,
+        last_period_end__lt=date,
+        last_period_end__gte=date - period,
+    ).values_list("instrument_id", "window", "correlation")
+    return {
+        (instrument_id, window): np.nan if correlation is None else correlation
+        for instrument_id, window, correlation in rows
+    }
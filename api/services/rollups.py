@@ -0,0 +1,162 @@
+import datetime as dt
+
+import structlog
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api import models
+from api.services.dydx_models import CANDLE_RESOLUTIONS
+from api.services.price_store import price_store
+
+logger = structlog.get_logger(__name__)
+
+
+ON_CONFLICT_UPDATE = """DO UPDATE SET
+            period_end = excluded.period_end,
+            open = excluded.open,
+            high = excluded.high,
+            low = excluded.low,
+            close = excluded.close,
+            updated_at = excluded.updated_at"""
+
+
+def _bucket_sql(seconds: int) -> str:
+    """SQL of the start of the period of `seconds` that period_start falls in"""
+    if connection.vendor == "postgresql":
+        return (
+            "to_timestamp(floor(extract(epoch from period_start) / {0}) * {0})".format(
+                seconds
+            )
+        )
+    if connection.vendor == "sqlite":
+        # Django stores datetimes as "YYYY-MM-DD HH:MM:SS" in UTC, like datetime()
+        return (
+            "datetime((CAST(strftime('%%s', period_start) AS INTEGER) / {0}) * {0}, "
+            "'unixepoch')".format(seconds)
+        )
+    raise NotImplementedError("Rollups don't support {}".format(connection.vendor))
+
+
+def get_rollup_order(rollups: dict[str, str]) -> list[tuple[str, str]]:
+    """
+    Orders (target, source) rollups so that every source is rolled up before it is
+    used as a source itself, i.e. from the finest target to the coarsest.
+    """
+    for target, source in rollups.items():
+        target_delta = CANDLE_RESOLUTIONS[target]
+        source_delta = CANDLE_RESOLUTIONS[source]
+        if target_delta <= source_delta or target_delta % source_delta:
+            raise ValueError(
+                "Can't roll {} candles up into {} candles".format(source, target)
+            )
+    return sorted(rollups.items(), key=lambda item: CANDLE_RESOLUTIONS[item[0]])
+
+
+def rollup_dydx_candles(
+    source_resolution: str,
+    target_resolution: str,
+    start: dt.datetime,
+    end: dt.datetime,
+    instruments: list[models.Instrument] | None = None,
+    complete_only: bool = True,
+    update_existing: bool = True,
+) -> int:
+    """
+    Derives the candles of a coarser resolution from stored finer ones, in one
+    INSERT ... SELECT that groups the source candles by target period, rather than by
+    fetching them from dydx.
+
+    By default, only target periods with every source candle present are written, and
+    existing candles are updated, so this can run again over the same periods after
+    each sync. Like the dydx candles, period_end is the period_end of the last source
+    candle.
+
+    Args:
+        start (dt.datetime): Rolls up the target periods starting from this one
+        end (dt.datetime): Source candles starting at or after end are left out
+        instruments (list[models.Instrument] | None): Defaults to every instrument
+        complete_only (bool): Whether target periods with missing source candles are
+            left out
+        update_existing (bool): Whether existing target candles are overwritten
+
+    Returns:
+        int: The number of target candles written
+    """
+    source_delta = CANDLE_RESOLUTIONS[source_resolution]
+    target_delta = CANDLE_RESOLUTIONS[target_resolution]
+    target_seconds = int(target_delta.total_seconds())
+    periods_per_bucket = target_delta // source_delta
+    # Start on a target period boundary, so the first bucket can be complete
+    start = dt.datetime.fromtimestamp(
+        start.timestamp() - start.timestamp() % target_seconds, dt.timezone.utc
+    )
+
+    table = models.DydxCandle._meta.db_table
+    params = [
+        source_resolution,
+        connection.ops.adapt_datetimefield_value(start),
+        connection.ops.adapt_datetimefield_value(end),
+    ]
+    instrument_filter = ""
+    if instruments is not None:
+        if not instruments:
+            return 0
+        instrument_filter = "AND instrument_id IN ({})".format(
+            ", ".join(["%s"] * len(instruments))
+        )
+        params += [instrument.id for instrument in instruments]
+    params += [
+        target_resolution,
+        connection.ops.adapt_datetimefield_value(timezone.now()),
+        periods_per_bucket if complete_only else 1,
+    ]
+
+    sql = """
+        INSERT INTO {table}
+            (instrument_id, resolution, period_start, period_end, open, high, low, close,
+                updated_at)
+        WITH source AS (
+            SELECT instrument_id, period_start, period_end, open, high, low, close,
+                {bucket} AS bucket
+            FROM {table}
+            WHERE resolution = %s AND period_start >= %s AND period_start < %s
+                {instrument_filter}
+        ),
+        buckets AS (
+            SELECT instrument_id, bucket, MIN(period_start) AS first_start,
+                MAX(period_start) AS last_start, MAX(high) AS high, MIN(low) AS low,
+                COUNT(*) AS num_candles
+            FROM source
+            GROUP BY instrument_id, bucket
+        )
+        SELECT b.instrument_id, %s, b.bucket, last.period_end, first.open, b.high,
+            b.low, last.close, %s
+        FROM buckets b
+        JOIN source first
+            ON first.instrument_id = b.instrument_id AND first.period_start = b.first_start
+        JOIN source last
+            ON last.instrument_id = b.instrument_id AND last.period_start = b.last_start
+        WHERE b.num_candles >= %s
+        ON CONFLICT (instrument_id, resolution, period_start) {on_conflict}
+    """.format(
+        bucket=_bucket_sql(target_seconds),
+        table=table,
+        instrument_filter=instrument_filter,
+        on_conflict=ON_CONFLICT_UPDATE if update_existing else "DO NOTHING",
+    )
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            num_written = cursor.rowcount
+        # The rows were written in SQL, so the cached series are dropped rather than
+        # merged
+        transaction.on_commit(
+            lambda: price_store.invalidate(resolution=target_resolution)
+        )
+
+    logger.info(
+        "Rolled up {} candles into {}".format(source_resolution, target_resolution),
+        num_written=num_written,
+    )
+    return num_written
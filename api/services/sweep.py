@@ -0,0 +1,108 @@
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+
+import pandas as pd
+import structlog
+
+from api.services.backtest import run_backtest
+from api.services.trade_evaluator import DEFAULT_STRATEGY, StrategyParams
+
+logger = structlog.get_logger(__name__)
+
+# The keys of BacktestResult.summary
+SUMMARY_COLUMNS = [
+    "num_trades",
+    "num_open",
+    "total_pnl",
+    "win_rate",
+    "max_drawdown",
+    "runtime_seconds",
+]
+
+# The prices of the running sweep. Workers are forked after they are set, so they all
+# read the parent's arrays instead of receiving a copy with every task.
+_closes: pd.DataFrame | None = None
+_base_closes: pd.Series | None = None
+
+
+def make_grid(**values: list) -> list[StrategyParams]:
+    """
+    Every combination of the given values, e.g. make_grid(min_corr=[0.4, 0.5]). The
+    fields that aren't given keep their default.
+    """
+    unknown = set(values) - set(StrategyParams._fields)
+    if unknown:
+        raise ValueError("Unknown strategy params: {}".format(", ".join(unknown)))
+
+    return [
+        DEFAULT_STRATEGY._replace(**dict(zip(values, combination)))
+        for combination in itertools.product(*values.values())
+    ]
+
+
+def _run(params: StrategyParams, backtest_kwargs: dict[str, Any]) -> dict[str, Any]:
+    result = run_backtest(_closes, _base_closes, params=params, **backtest_kwargs)
+    return {**params._asdict(), **result.summary()}
+
+
+def run_sweep(
+    closes: pd.DataFrame,
+    base_closes: pd.Series,
+    grid: list[StrategyParams],
+    max_workers: int | None = None,
+    rank_by: str = "total_pnl",
+    **backtest_kwargs,
+) -> pd.DataFrame:
+    """
+    Backtests every parameter set of the grid over a process pool.
+
+    The price matrix isn't pickled to the workers: they are forked once it is set, and
+    only read it.
+
+    Args:
+        closes (pd.DataFrame): See run_backtest
+        base_closes (pd.Series): See run_backtest
+        grid (list[StrategyParams]): The parameter sets, e.g. from make_grid
+        max_workers (int | None): Number of processes, defaults to the number of CPUs
+        rank_by (str): The summary column to rank by, highest first
+        backtest_kwargs: Passed to run_backtest
+
+    Returns:
+        pd.DataFrame: One row per parameter set, with its params and backtest summary,
+            indexed by rank starting at 1
+    """
+    global _closes, _base_closes
+
+    t0 = time.perf_counter()
+    max_workers = min(max_workers or os.cpu_count() or 1, len(grid)) or 1
+    _closes, _base_closes = closes, base_closes
+    try:
+        if max_workers == 1:
+            rows = [_run(params, backtest_kwargs) for params in grid]
+        else:
+            with ProcessPoolExecutor(
+                max_workers, mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                rows = list(
+                    executor.map(
+                        _run, grid, itertools.repeat(backtest_kwargs), chunksize=1
+                    )
+                )
+    finally:
+        _closes, _base_closes = None, None
+
+    results = pd.DataFrame(rows, columns=[*StrategyParams._fields, *SUMMARY_COLUMNS])
+    results = results.sort_values(rank_by, ascending=False, ignore_index=True)
+    results.index = pd.RangeIndex(1, len(results) + 1, name="rank")
+
+    logger.info(
+        "Ran sweep",
+        num_params=len(grid),
+        max_workers=max_workers,
+        runtime_seconds=time.perf_counter() - t0,
+    )
+    return results
@@ -1,17 +1,37 @@
 import datetime as dt
+import math
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
 
-import requests
 import structlog
+from django.conf import settings as django_settings
+from django.db import transaction
+from django.db.models import Max, Min
 from django.utils import timezone
 
 from api import models
 from api.services import trade_evaluator
-from api.services.dydx_models import DydxMarketsModel
-from api.services.dydx_trader import DydxTrader
+from api.services.candle_cache import get_candle_cache
+from api.services.coingecko import get_coingecko_client
+from api.services.dydx_models import (
+    CANDLE_RESOLUTIONS,
+    Candle,
+    CandlesModel,
+    DydxMarketsModel,
+)
+from api.services.dydx_trader import CANDLES_PAGE_LIMIT, get_trader
 from api.services.positions import open_position
+from api.services.price_store import price_store
+from api.services.rolling import update_rolling_correlations
+from api.services.rollups import get_rollup_order, rollup_dydx_candles
+from api.services.throttle import Limiter, get_rate_limiter
 
 logger = structlog.get_logger(__name__)
 
+# The instrument every traded instrument is paired with
+BASE_SYMBOL = "ETH"
+
 
 def do_trades() -> None:
     date = dt.datetime.now()
@@ -20,31 +40,299 @@ def do_trades() -> None:
     if settings.enable_trades is False:
         logger.warning("Trades are disabled, not opening position")
 
-    extra_data = {}
-    base = models.Instrument.objects.get(symbol="ETH")
-    for instrument in models.Instrument.objects.filter(enable_dydx_trades=True):
+    base = models.Instrument.objects.get(symbol=BASE_SYMBOL)
+    instruments = list(models.Instrument.objects.filter(enable_dydx_trades=True))
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Set up the trader while evaluating, so the first order goes out right away
+        if settings.enable_trades:
+            warm_up = executor.submit(lambda: get_trader().warm_up())
+        eval_trade_results = trade_evaluator.evaluate_trades(instruments, base, date)
+        if settings.enable_trades:
+            try:
+                warm_up.result()
+            except Exception as e:
+                logger.error("Error warming up the trader", exc_info=e)
+
+    sync_history = record_trade_evaluation(instruments, base, eval_trade_results)
+
+    for instrument in instruments:
         try:
-            eval_trade_result = trade_evaluator.evaluate_trade(instrument, base, date)
-            extra_data[instrument.symbol] = eval_trade_result
+            eval_trade_result = eval_trade_results[instrument.symbol]
 
             if settings.enable_trades and eval_trade_result["open_position"]:
                 open_position(instrument, base)
         except Exception as e:
             logger.error("Error processing {}".format(instrument), exc_info=e)
+            add_failed_instrument(sync_history, instrument)
+
+
+def record_trade_evaluation(
+    instruments: list[models.Instrument],
+    base: models.Instrument,
+    results: dict[str, dict],
+) -> models.SyncHistory:
+    """Records a trades run and its evaluation results"""
+    with transaction.atomic():
+        sync_history = models.SyncHistory.objects.create(
+            date=timezone.now(),
+            records_synced=len(instruments),
+            sync_type="trades",
+            extra_data={"failed_instruments": []},
+        )
+        save_evaluation_results(sync_history, instruments, base, results)
+    return sync_history
+
+
+def add_failed_instrument(
+    sync_history: models.SyncHistory, instrument: models.Instrument
+) -> None:
+    """Adds an instrument whose position failed to open to a trades run"""
+    # Positions can be opened concurrently, so the row is locked while it is updated
+    with transaction.atomic():
+        locked = models.SyncHistory.objects.select_for_update().get(id=sync_history.id)
+        locked.extra_data.setdefault("failed_instruments", []).append(instrument.symbol)
+        locked.save(update_fields=["extra_data"])
+    sync_history.extra_data = locked.extra_data
+
+
+def _to_float(value: float | None) -> float | None:
+    """None for missing and NaN values, which the evaluator reports for too few prices"""
+    if value is None or math.isnan(value):
+        return None
+    return value
+
+
+def save_evaluation_results(
+    sync_history: models.SyncHistory,
+    instruments: list[models.Instrument],
+    base: models.Instrument,
+    results: dict[str, dict],
+    resolution: str = trade_evaluator.DEFAULT_STRATEGY.resolution,
+) -> list[models.EvaluationResult]:
+    """
+    Writes the evaluate_trades results of a run, one row per instrument, in one bulk
+    insert.
 
-    sync_history = models.SyncHistory.objects.create(
-        date=timezone.now(),
-        sync_type="trades",
-        extra_data=extra_data,
+    Args:
+        results (dict[str, dict]): The evaluate_trade results by instrument symbol
+    """
+    evaluation_results = []
+    for instrument in instruments:
+        result = results.get(instrument.symbol)
+        if result is None:
+            continue
+        date = dt.datetime.fromisoformat(result["date"])
+        if timezone.is_naive(date):
+            date = timezone.make_aware(date)
+        evaluation_results.append(
+            models.EvaluationResult(
+                sync_history=sync_history,
+                instrument=instrument,
+                base_instrument=base,
+                date=date,
+                resolution=resolution,
+                corr_30d=_to_float(result.get("corr_30d")),
+                corr_4d=_to_float(result.get("corr_4d")),
+                base_diff_4d=_to_float(result.get("base_diff_4d")),
+                open_position=result["open_position"],
+                error=result.get("error", False),
+                reason=result.get("reason", ""),
+            )
+        )
+    return models.EvaluationResult.objects.bulk_create(evaluation_results)
+
+
+# Number of candle rows written per INSERT statement
+CANDLE_BATCH_SIZE = 500
+
+# Number of most recent periods that are checked for missing candles on every sync
+CANDLE_GAP_LOOKBACK_PERIODS = CANDLES_PAGE_LIMIT
+
+
+def parse_dydx_timestamp(timestamp: str) -> dt.datetime:
+    return timezone.make_aware(
+        dt.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ"),
+        dt.timezone.utc,
     )
-    sync_history.save()
 
 
-def sync_dydx_candles():
-    trader = DydxTrader()
+def format_dydx_timestamp(date: dt.datetime) -> str:
+    return (
+        date.astimezone(dt.timezone.utc)
+        .isoformat(timespec="milliseconds")
+        .replace("+00:00", "Z")
+    )
+
+
+def dydx_candle_from_api(
+    instrument: models.Instrument, candle: Candle
+) -> models.DydxCandle:
+    """Builds an unsaved DydxCandle from a candle returned by the dydx API"""
+    return models.DydxCandle(
+        instrument=instrument,
+        period_start=parse_dydx_timestamp(candle.startedAt),
+        period_end=parse_dydx_timestamp(candle.updatedAt),
+        resolution=candle.resolution,
+        open=candle.open,
+        high=candle.high,
+        low=candle.low,
+        close=candle.close,
+    )
+
+
+def get_candle_sync_starts(
+    instruments: list[models.Instrument], resolution: str, now: dt.datetime
+) -> dict[int, dt.datetime]:
+    """
+    Finds the period_start from which each instrument's candles need to be fetched.
+
+    This is the period after the latest stored candle (the high-water mark), unless a
+    candle is missing in the last CANDLE_GAP_LOOKBACK_PERIODS periods, in which case it
+    is the first missing period so that the gap gets refetched. Instruments without any
+    stored candles are left out.
 
+    Returns:
+        dict[int, dt.datetime]: Sync start by instrument id
+    """
+    delta = CANDLE_RESOLUTIONS[resolution]
+    window_start = now - CANDLE_GAP_LOOKBACK_PERIODS * delta
+
+    qs = models.DydxCandle.objects.filter(
+        instrument__in=instruments, resolution=resolution
+    )
+    bounds = qs.values("instrument_id").annotate(
+        earliest=Min("period_start"), latest=Max("period_start")
+    )
+
+    recent_starts = defaultdict(set)
+    for instrument_id, period_start in qs.filter(
+        period_start__gte=window_start
+    ).values_list("instrument_id", "period_start"):
+        recent_starts[instrument_id].add(period_start)
+
+    sync_starts = {}
+    for row in bounds:
+        latest = row["latest"]
+        sync_starts[row["instrument_id"]] = latest + delta
+
+        # Walk the periods of the lookback window on the same grid as the latest candle
+        period = latest - ((latest - window_start) // delta) * delta
+        period = max(period, row["earliest"])
+        while period < latest:
+            if period not in recent_starts[row["instrument_id"]]:
+                logger.info(
+                    "Found a gap in dydx candles",
+                    instrument_id=row["instrument_id"],
+                    period_start=period.isoformat(),
+                )
+                sync_starts[row["instrument_id"]] = period
+                break
+            period += delta
+
+    return sync_starts
+
+
+def upsert_dydx_candles(
+    candles: list[models.DydxCandle], batch_size: int = CANDLE_BATCH_SIZE
+) -> tuple[int, int]:
+    """
+    Idempotently writes candles, keyed on (instrument, resolution, period_start).
+
+    Existing rows have their prices refreshed instead of being duplicated, and cached
+    price series are updated once the transaction commits. The number
+    of queries is two per batch of each (instrument, resolution) group, rather than
+    several per candle.
+
+    Returns:
+        tuple[int, int]: The number of inserted and updated candles
+    """
+    groups: dict[tuple[int, str], dict[dt.datetime, models.DydxCandle]] = {}
+    for candle in candles:
+        key = (candle.instrument_id, candle.resolution)
+        # Later candles for the same period win, mirroring what the upsert would do
+        groups.setdefault(key, {})[candle.period_start] = candle
+
+    # Price store refreshes pick up the candles by when they were written
+    updated_at = timezone.now()
+    num_inserted = 0
+    num_updated = 0
+    for (instrument_id, resolution), by_start in groups.items():
+        rows = list(by_start.values())
+        for candle in rows:
+            candle.updated_at = updated_at
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i : i + batch_size]
+            num_existing = models.DydxCandle.objects.filter(
+                instrument_id=instrument_id,
+                resolution=resolution,
+                period_start__in=[candle.period_start for candle in batch],
+            ).count()
+
+            models.DydxCandle.objects.bulk_create(
+                batch,
+                update_conflicts=True,
+                unique_fields=["instrument", "resolution", "period_start"],
+                update_fields=[
+                    "period_end",
+                    "open",
+                    "high",
+                    "low",
+                    "close",
+                    "updated_at",
+                ],
+            )
+            transaction.on_commit(lambda batch=batch: price_store.add_candles(batch))
+            num_inserted += len(batch) - num_existing
+            num_updated += num_existing
+
+    return num_inserted, num_updated
+
+
+def fetch_dydx_candles(
+    get_candles: Callable[[str], CandlesModel],
+    markets: list[str],
+    max_workers: int | None = None,
+    rate_limiter: Limiter | None = None,
+) -> dict[str, CandlesModel]:
+    """
+    Fetches candles for many markets concurrently.
+
+    Args:
+        get_candles (Callable): Fetches the candles of one market, e.g. DydxTrader.get_candles
+        markets (list[str]): The dydx market ids to fetch
+        max_workers (int | None): Maximum number of requests in flight. Defaults to
+            settings.DYDX_CANDLE_FETCH_CONCURRENCY.
+        rate_limiter (Limiter | None): Acquired before every request, if given
+
+    Returns:
+        dict[str, CandlesModel]: Candles by market. Markets that failed to fetch are
+            logged and left out.
+    """
+    max_workers = max_workers or django_settings.DYDX_CANDLE_FETCH_CONCURRENCY
+
+    def fetch(market: str) -> CandlesModel | None:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            return get_candles(market)
+        except Exception as e:
+            logger.error("Error fetching candles for {}".format(market), exc_info=e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(fetch, markets)
+        return {
+            market: candles
+            for market, candles in zip(markets, results)
+            if candles is not None
+        }
+
+
+def get_dydx_instruments() -> list[models.Instrument]:
+    """The instruments with a dydx market"""
+    instruments = []
     for instrument in models.Instrument.objects.filter():
-        logger.info("Processing instrument {}".format(instrument))
         if not instrument.dydx_market_id:
             logger.info(
                 "Instrument {} doesn't have a dydx_market_id, Skipping dydx candle load.".format(
@@ -52,57 +340,152 @@ def sync_dydx_candles():
                 )
             )
             continue
+        instruments.append(instrument)
+    return instruments
 
-        candles = trader.get_candles(instrument.dydx_market_id)
 
-        for candle in candles.candles:
-            candle_started_at_dt = timezone.make_aware(
-                dt.datetime.strptime(candle.startedAt, "%Y-%m-%dT%H:%M:%S.%fZ"),
-                timezone.utc,
-            )
+def sync_dydx_candles(resolution: str = "1DAY"):
+    """
+    Syncs the completed candles of every instrument with a dydx market.
 
-            candle_ended_at_dt = timezone.make_aware(
-                dt.datetime.strptime(candle.updatedAt, "%Y-%m-%dT%H:%M:%S.%fZ"),
-                timezone.utc,
-            )
+    Only candles after each instrument's latest stored candle are requested, plus any
+    recent gaps. Instruments without stored candles get the most recent page.
+    """
+    num_inserted, num_updated, failed_markets = sync_dydx_candles_for(
+        get_dydx_instruments(), resolution
+    )
+    record_dydx_candle_sync(resolution, num_inserted, num_updated, failed_markets)
 
-            one_day_ago = timezone.make_aware(
-                dt.datetime.now() - dt.timedelta(days=1), timezone.utc
-            )
-            if candle_started_at_dt > one_day_ago:
+
+def sync_dydx_candles_for(
+    instruments: list[models.Instrument], resolution: str
+) -> tuple[int, int, list[str]]:
+    """
+    Fetches and stores the new candles of the instruments, like sync_dydx_candles,
+    without refreshing what is derived from them.
+
+    Returns:
+        tuple[int, int, list[str]]: The number of candles inserted and updated, and the
+            markets that failed to fetch
+    """
+    trader = get_trader()
+    delta = CANDLE_RESOLUTIONS[resolution]
+    now = timezone.now()
+
+    sync_starts = get_candle_sync_starts(instruments, resolution, now)
+    sync_start_by_market = {
+        instrument.dydx_market_id: sync_starts.get(instrument.id)
+        for instrument in instruments
+    }
+
+    def get_candles(market: str) -> CandlesModel:
+        start = sync_start_by_market[market]
+        if start is None:
+            return trader.get_candles(market, resolution)
+
+        if start + delta > now:
+            # The next candle hasn't completed yet, so there's nothing to fetch
+            return CandlesModel(candles=[])
+
+        return trader.get_candles(
+            market,
+            resolution,
+            from_iso=format_dydx_timestamp(start),
+            to_iso=format_dydx_timestamp(min(now, start + CANDLES_PAGE_LIMIT * delta)),
+            limit=CANDLES_PAGE_LIMIT,
+        )
+
+    # Network requests overlap, but all database writes happen here on one connection
+    candles_by_market = fetch_dydx_candles(
+        get_candles,
+        [instrument.dydx_market_id for instrument in instruments],
+        rate_limiter=get_rate_limiter(
+            django_settings.DYDX_API_HOST, django_settings.DYDX_REQUESTS_PER_SECOND
+        ),
+    )
+
+    candle_models = []
+    failed_markets = []
+    for instrument in instruments:
+        if instrument.dydx_market_id not in candles_by_market:
+            failed_markets.append(instrument.dydx_market_id)
+            continue
+
+        logger.info("Processing instrument {}".format(instrument))
+        for candle in candles_by_market[instrument.dydx_market_id].candles:
+            if parse_dydx_timestamp(candle.startedAt) + delta > now:
                 logger.info("Skipping candle because candle is too new")
                 continue
 
-            if models.DydxCandle.objects.filter(
-                instrument=instrument,
-                period_start=candle.startedAt,
-            ).first():
-                # candle already exists, continue
-                logger.info("Skipping candle because candle already exists")
-                continue
+            candle_models.append(dydx_candle_from_api(instrument, candle))
+
+    num_inserted, num_updated = upsert_dydx_candles(candle_models)
+    logger.info(
+        "Synced dydx candles", num_inserted=num_inserted, num_updated=num_updated
+    )
+    return num_inserted, num_updated, failed_markets
 
-            candle_model = models.DydxCandle.objects.create(
-                instrument=instrument,
-                period_start=candle_started_at_dt,
-                period_end=candle_ended_at_dt,
-                resolution=candle.resolution,
-                open=candle.open,
-                high=candle.high,
-                low=candle.low,
-                close=candle.close,
-            )
-            candle_model.save()
 
-    sync_history = models.SyncHistory.objects.create(
+def record_dydx_candle_sync(
+    resolution: str, num_inserted: int, num_updated: int, failed_markets: list[str]
+) -> models.SyncHistory:
+    """Refreshes what is derived from the synced candles, and records the sync"""
+    _refresh_derived_data(resolution)
+
+    return models.SyncHistory.objects.create(
         date=timezone.now(),
+        records_synced=num_inserted + num_updated,
         sync_type="dydx_candles",
-        extra_data={},
+        extra_data={
+            "inserted": num_inserted,
+            "updated": num_updated,
+            "failed_markets": failed_markets,
+        },
     )
-    sync_history.save()
+
+
+def _refresh_derived_data(resolution: str) -> None:
+    """Brings what is computed from the candles of resolution up to date with them"""
+    candle_cache = get_candle_cache()
+    if candle_cache is not None:
+        candle_cache.refresh(resolution)
+
+    base = models.Instrument.objects.filter(symbol=BASE_SYMBOL).first()
+    if base is not None and resolution == trade_evaluator.DEFAULT_STRATEGY.resolution:
+        update_rolling_correlations(
+            list(models.Instrument.objects.filter(enable_dydx_trades=True)),
+            base,
+            resolution=resolution,
+        )
+
+
+def rollup_recent_dydx_candles(now: dt.datetime | None = None) -> dict[str, int]:
+    """
+    Derives the DYDX_CANDLE_ROLLUPS resolutions from the candles that a sync can have
+    written, i.e. the last CANDLE_GAP_LOOKBACK_PERIODS periods of each source.
+
+    Returns:
+        dict[str, int]: The number of candles written by target resolution
+    """
+    now = now or timezone.now()
+    num_written = {}
+    for target, source in get_rollup_order(django_settings.DYDX_CANDLE_ROLLUPS):
+        start = now - CANDLE_GAP_LOOKBACK_PERIODS * CANDLE_RESOLUTIONS[source]
+        num_written[target] = rollup_dydx_candles(source, target, start, now)
+        _refresh_derived_data(target)
+    return num_written
+
+
+def sync_all_dydx_candles() -> None:
+    """Syncs every DYDX_CANDLE_RESOLUTIONS resolution, then the rollups"""
+    for resolution in django_settings.DYDX_CANDLE_RESOLUTIONS:
+        sync_dydx_candles(resolution)
+    rollup_recent_dydx_candles()
 
 
 def sync_dydx_instruments():
-    trader = DydxTrader()
+    trader = get_trader()
+    trader.refresh()
     markets = DydxMarketsModel(markets=trader.markets["markets"])
 
     for _, market_data in markets.markets.items():
@@ -123,48 +506,116 @@ def sync_dydx_instruments():
         logger.info("Created instrument {}".format(instrument.symbol))
 
 
-def sync_coingecko_ohlc(instrument: models.Instrument) -> int:
-    """
-    This may be deprecated soon.
-
-    This sync data from coingecko into the Coingecko OHLC table.
-    """
-    url = f"https://api.coingecko.com/api/v3/coins/{instrument.coingecko_id}/ohlc/"
+def coingecko_ohlc_from_api(
+    instrument: models.Instrument, entry: list[float]
+) -> models.CoingeckoInstrumentOHLC:
+    return models.CoingeckoInstrumentOHLC(
+        instrument=instrument,
+        # The timestamp is in milliseconds
+        date=dt.datetime.fromtimestamp(entry[0] // 1000, dt.timezone.utc),
+        open=entry[1],
+        high=entry[2],
+        low=entry[3],
+        close=entry[4],
+    )
 
-    query_params = {"vs_currency": "usd", "days": "30"}
 
-    resp = requests.get(url, params=query_params)
-    if not resp.ok:
-        logger.error(f"Error querying coingecko: {resp.text}")
-        raise RuntimeError("Error querying coingecko: {}".format(resp.status_code))
+def upsert_coingecko_ohlc(
+    ohlc: list[models.CoingeckoInstrumentOHLC],
+    batch_size: int = CANDLE_BATCH_SIZE,
+) -> tuple[int, int]:
+    """
+    Inserts or updates OHLC rows in batches, keyed on (instrument, date).
 
-    data = resp.json()
-    num_records_created = 0
+    Returns:
+        tuple[int, int]: The number of rows inserted and updated
+    """
+    groups: dict[int, dict[dt.datetime, models.CoingeckoInstrumentOHLC]] = {}
+    for row in ohlc:
+        groups.setdefault(row.instrument_id, {})[row.date] = row
+
+    num_inserted = 0
+    num_updated = 0
+    for instrument_id, by_date in groups.items():
+        rows = list(by_date.values())
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i : i + batch_size]
+            num_existing = models.CoingeckoInstrumentOHLC.objects.filter(
+                instrument_id=instrument_id, date__in=[row.date for row in batch]
+            ).count()
+            models.CoingeckoInstrumentOHLC.objects.bulk_create(
+                batch,
+                update_conflicts=True,
+                unique_fields=["instrument", "date"],
+                update_fields=["open", "high", "low", "close"],
+            )
+            num_inserted += len(batch) - num_existing
+            num_updated += num_existing
+    return num_inserted, num_updated
 
-    # Always skip the newest value because it might be fully defined yet (i.e., in the middle of the interval)
-    for entry in data[:-1]:
-        # entry[0] is the timestamp in milliseconds, so divide by 1000 to get seconds
-        date = dt.datetime.fromtimestamp(entry[0] // 1000)
-        date = timezone.make_aware(date)
 
-        open = entry[1]
-        high = entry[2]
-        low = entry[3]
-        close = entry[4]
+def sync_coingecko_ohlc(
+    instruments: list[models.Instrument],
+    sync_history: models.SyncHistory | None = None,
+    max_workers: int | None = None,
+) -> models.SyncHistory:
+    """
+    Syncs the last 30 days of coingecko OHLC of the instruments into the Coingecko OHLC
+    table. The instruments are fetched concurrently through the shared coingecko
+    client, and each one is written as soon as it arrives, with its progress saved in
+    the extra_data of sync_history.
+
+    Args:
+        sync_history (models.SyncHistory | None): Where the progress goes, e.g. created
+            when the sync was queued. Defaults to a new one.
+        max_workers (int | None): Defaults to settings.COINGECKO_FETCH_CONCURRENCY
+
+    Returns:
+        models.SyncHistory: sync_history, with the rows synced and failed instruments
+    """
+    if sync_history is None:
+        sync_history = models.SyncHistory.objects.create(
+            date=timezone.now(), sync_type="coingecko_ohlc"
+        )
+    sync_history.extra_data = {
+        "total": len(instruments),
+        "done": 0,
+        "inserted": 0,
+        "updated": 0,
+        "failed_instruments": [],
+    }
+    sync_history.save()
 
-        # Check if an instrument already exists
-        if not models.CoingeckoInstrumentOHLC.objects.filter(
-            instrument=instrument, date=date
-        ).exists():
-            num_records_created += 1
-            instrument_ohlc = models.CoingeckoInstrumentOHLC.objects.create(
-                instrument=instrument,
-                date=date,
-                open=open,
-                high=high,
-                low=low,
-                close=close,
-            )
-            instrument_ohlc.save()
+    client = get_coingecko_client()
+    max_workers = max_workers or django_settings.COINGECKO_FETCH_CONCURRENCY
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(client.get_ohlc, instrument.coingecko_id): instrument
+            for instrument in instruments
+        }
+        # Network requests overlap, but all database writes happen here
+        for future in as_completed(futures):
+            instrument = futures[future]
+            progress = sync_history.extra_data
+            try:
+                # Always skip the newest value because it might not be fully defined
+                # yet (i.e., in the middle of the interval)
+                num_inserted, num_updated = upsert_coingecko_ohlc(
+                    [
+                        coingecko_ohlc_from_api(instrument, entry)
+                        for entry in future.result()[:-1]
+                    ]
+                )
+                progress["inserted"] += num_inserted
+                progress["updated"] += num_updated
+            except Exception as e:
+                logger.error(
+                    "Error syncing coingecko OHLC of {}".format(instrument), exc_info=e
+                )
+                progress["failed_instruments"].append(instrument.symbol)
+            progress["done"] += 1
+            sync_history.records_synced = progress["inserted"] + progress["updated"]
+            sync_history.save(update_fields=["records_synced", "extra_data"])
 
-    return num_records_created
+    logger.info("Synced coingecko OHLC", **sync_history.extra_data)
+    return sync_history
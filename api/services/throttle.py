@@ -0,0 +1,110 @@
+import math
+import threading
+import time
+from typing import Protocol
+
+from django.core.cache import cache
+
+# Django cache key of the number of calls to a host in one window
+CACHE_KEY = "rate_limit:{}:{}"
+
+
+class Limiter(Protocol):
+    """What the API clients acquire before every request"""
+
+    def acquire(self) -> None:
+        """Blocks until a call is allowed"""
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces out calls so that at most `rate` calls start per
+    second, with bursts of up to `burst` calls.
+
+    One limiter should be shared by every caller that talks to the same host.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Blocks until a call is allowed"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait_seconds = (1 - self._tokens) / self.rate
+
+            time.sleep(wait_seconds)
+
+
+class SharedRateLimiter:
+    """
+    Limiter shared by every process that uses the same Django cache, e.g. the celery
+    workers, so that together they start at most `rate` calls per second on average.
+
+    Calls are counted in fixed windows of burst / rate seconds, which allow `burst`
+    calls each. Unlike RateLimiter's token bucket, calls at the end of one window and
+    the start of the next aren't spaced out, so up to 2 * burst calls can start within
+    one window's length across a boundary.
+
+    With a cache backend that isn't shared, like the default local memory one, it only
+    limits its own process.
+    """
+
+    def __init__(self, key: str, rate: float, burst: int = 1) -> None:
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.window_seconds = burst / rate
+
+    def acquire(self) -> None:
+        """Blocks until a call is allowed"""
+        while True:
+            now = time.time()
+            window = int(now // self.window_seconds)
+            key = CACHE_KEY.format(self.key, window)
+            # Expires after its window, so no cleanup is needed
+            cache.add(key, 0, timeout=math.ceil(self.window_seconds) + 1)
+            try:
+                num_calls = cache.incr(key)
+            except ValueError:
+                # Expired in between
+                continue
+
+            if num_calls <= self.burst:
+                return
+            time.sleep((window + 1) * self.window_seconds - now)
+
+
+_limiters: dict[str, SharedRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(host: str, rate: float, burst: int = 1) -> SharedRateLimiter:
+    """
+    Returns the limiter for `host`, shared with the other processes through the Django
+    cache, creating it on first use
+    """
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = SharedRateLimiter(host, rate, burst)
+        return _limiters[host]
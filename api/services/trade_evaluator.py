@@ -1,64 +1,217 @@
 import datetime as dt
-from decimal import Decimal
-from typing import Any
+from typing import Any, NamedTuple
 
+import numpy as np
 import pandas as pd
 import structlog
+from django.conf import settings
 from django.utils import timezone
 
 from api import models
+from api.services.dydx_models import CANDLE_RESOLUTIONS
+from api.services.live_prices import get_live_price
+from api.services.price_store import PriceSeries, price_store, to_ns
+from api.services.rolling import get_rolling_correlations
 
 logger = structlog.get_logger(__name__)
 
 
-def fetch_close(instrument: models.Instrument, in_date: dt.date) -> Decimal:
-    """Fetches the closing price of an instrument at a particular date"""
+class StrategyParams(NamedTuple):
+    """
+    The thresholds of the evaluate_trade rules, and their windows in periods of
+    resolution, e.g. days for 1DAY candles
+    """
 
+    corr_window: int = 30
+    min_corr: float = 0.5
+    inverse_corr_window: int = 4
+    max_inverse_corr: float = -0.25
+    base_return_window: int = 4
+    resolution: str = "1DAY"
+
+    def window_length(self, window: int) -> dt.timedelta:
+        return window * CANDLE_RESOLUTIONS[self.resolution]
+
+    def describe_window(self, window: int, plural: bool = False) -> str:
+        """e.g. "30 day", or "30 1HOUR period" for other resolutions"""
+        unit = "day" if self.resolution == "1DAY" else self.resolution + " period"
+        return "{} {}{}".format(window, unit, "s" if plural else "")
+
+
+DEFAULT_STRATEGY = StrategyParams()
+
+
+def _make_aware(date: dt.datetime) -> dt.datetime:
     try:
-        date = timezone.make_aware(in_date)
+        return timezone.make_aware(date)
     except ValueError:
-        date = in_date
+        return date
 
-    qs = models.DydxCandle.objects.filter(instrument=instrument)
-    greater = qs.filter(period_end__gte=date).order_by("period_end").first()
-    less = qs.filter(period_end__lte=date).order_by("-period_end").first()
 
-    if greater and less:
-        closest_record = (
-            greater
-            if abs(greater.period_end - date) < abs(less.period_end - date)
-            else less
-        )
-    else:
-        closest_record = greater or less
-
-    if closest_record is None:
+def _nearest_closes(series: PriceSeries, dates: np.ndarray) -> np.ndarray:
+    """The closes of the candles whose period_end is closest to each of dates (in ns)"""
+    if not len(series):
         raise ValueError("Record not found")
 
-    return closest_record.close
+    i = np.searchsorted(series.period_ends, dates)
+    before = np.clip(i - 1, 0, len(series) - 1)
+    after = np.clip(i, 0, len(series) - 1)
+    # On a tie, the earlier candle wins
+    use_after = np.abs(series.period_ends[after] - dates) < np.abs(
+        series.period_ends[before] - dates
+    )
+    return np.where(use_after, series.closes[after], series.closes[before])
+
+
+def _live_close(instrument: models.Instrument, date: dt.datetime) -> float | None:
+    """The live price of the instrument if date is now, see api.services.live_prices"""
+    max_age = settings.LIVE_PRICE_MAX_AGE_SECONDS
+    if not instrument.dydx_market_id or abs(timezone.now() - date) > dt.timedelta(
+        seconds=max_age
+    ):
+        return None
+    return get_live_price(instrument.dydx_market_id, max_age)
+
+
+def fetch_close(
+    instrument: models.Instrument, in_date: dt.date, resolution: str = "1DAY"
+) -> float:
+    """
+    Fetches the closing price of an instrument at a particular date. The price right
+    now is the live price, when the market data worker streams one.
+    """
+    date = _make_aware(in_date)
+    live_close = _live_close(instrument, date)
+    if live_close is not None:
+        return live_close
+    series = price_store.get(instrument.id, resolution)
+    return float(_nearest_closes(series, np.array([to_ns(date)]))[0])
+
+
+def fetch_closes(
+    pairs: list[tuple[models.Instrument, dt.datetime]], resolution: str = "1DAY"
+) -> list[float]:
+    """
+    Batch version of fetch_close, resolving many (instrument, date) pairs at once.
+
+    Returns:
+        list[float]: The closes, in the order of pairs
+    """
+    series_by_instrument = price_store.get_many(
+        [instrument.id for instrument, _ in pairs], resolution
+    )
+
+    indices_by_instrument: dict[int, list[int]] = {}
+    for i, (instrument, _) in enumerate(pairs):
+        indices_by_instrument.setdefault(instrument.id, []).append(i)
+
+    closes = np.empty(len(pairs))
+    for instrument_id, indices in indices_by_instrument.items():
+        dates = np.array([to_ns(_make_aware(pairs[i][1])) for i in indices])
+        closes[indices] = _nearest_closes(series_by_instrument[instrument_id], dates)
+
+    for i, (instrument, date) in enumerate(pairs):
+        live_close = _live_close(instrument, _make_aware(date))
+        if live_close is not None:
+            closes[i] = live_close
+
+    return closes.tolist()
 
 
 def fetch_candles(
-    instrument: models.Instrument, start: dt.datetime, end: dt.datetime
+    instrument: models.Instrument,
+    start: dt.datetime,
+    end: dt.datetime,
+    resolution: str = "1DAY",
 ) -> models.DydxCandle:
     """start is inclusive, end is exclusive"""
-    # Assume one candle per day
     qs = models.DydxCandle.objects.filter(
-        instrument=instrument, period_end__gte=start, period_end__lt=end
+        instrument=instrument,
+        resolution=resolution,
+        period_end__gte=start,
+        period_end__lt=end,
     ).order_by("period_end")
     return qs
 
 
+def _window(series: PriceSeries, start: dt.datetime, end: dt.datetime) -> np.ndarray:
+    """Mask of the candles with period_end in [start, end), like fetch_candles"""
+    return (series.period_ends >= to_ns(_make_aware(start))) & (
+        series.period_ends < to_ns(_make_aware(end))
+    )
+
+
+def load_close_matrix(
+    instruments: list[models.Instrument],
+    start: dt.datetime,
+    end: dt.datetime,
+    resolution: str = "1DAY",
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Loads the candles of many instruments at once from the price store.
+
+    Like fetch_candles, start is inclusive and end is exclusive on period_end. Rows are
+    aligned on period_start, columns are instrument ids, and missing candles are NaN/NaT.
+
+    Returns:
+        tuple[pd.DataFrame, pd.DataFrame]: The closes and the period_ends
+    """
+    instrument_ids = [instrument.id for instrument in instruments]
+    series_by_instrument = price_store.get_many(instrument_ids, resolution)
+
+    closes = []
+    period_ends = []
+    for instrument_id in instrument_ids:
+        series = series_by_instrument[instrument_id]
+        mask = _window(series, start, end)
+        index = pd.DatetimeIndex(
+            pd.to_datetime(series.period_starts[mask], utc=True), name="period_start"
+        )
+        closes.append(pd.Series(series.closes[mask], index=index))
+        period_ends.append(
+            pd.Series(pd.to_datetime(series.period_ends[mask], utc=True), index=index)
+        )
+
+    closes = pd.concat(closes, axis=1, keys=instrument_ids).astype(float)
+    period_ends = pd.concat(period_ends, axis=1, keys=instrument_ids).astype(
+        "datetime64[ns, UTC]"
+    )
+    return closes, period_ends
+
+
 def fetch_prices_as_dataframe(
-    instruments: list[models.Instrument], start: dt.datetime, end: dt.datetime
+    instruments: list[models.Instrument],
+    start: dt.datetime,
+    end: dt.datetime,
+    how: str = "outer",
+    fill: str | None = None,
+    resolution: str = "1DAY",
 ) -> pd.DataFrame:
-    df = pd.DataFrame()
-    for instr in instruments:
-        candles = fetch_candles(instr, start, end)
-        closes = [candle.close for candle in candles]
-        df[instr.symbol] = closes
+    """
+    Fetches the closes of the candles with period_end in [start, end).
+
+    There is one column per instrument symbol and one row per candle period, indexed
+    by period_start. period_end can't be used to line candles up because it is the
+    time of the market's last update, which differs between markets.
+
+    Args:
+        how (str): "outer" keeps the periods where any instrument has a candle, "inner"
+            only the periods where all of them do
+        fill (str | None): "ffill" fills missing closes with the previous close, None
+            leaves them NaN
+    """
+    if how not in ("outer", "inner"):
+        raise ValueError("Unknown how: {}".format(how))
+    if fill not in (None, "ffill"):
+        raise ValueError("Unknown fill: {}".format(fill))
 
-    df = df.astype(float)
+    df, _ = load_close_matrix(instruments, start, end, resolution)
+    df.columns = [instr.symbol for instr in instruments]
+
+    if how == "inner":
+        df = df.dropna()
+    if fill == "ffill":
+        df = df.ffill()
     return df
 
 
@@ -67,13 +220,17 @@ def compute_instrument_correlation(
     instr2: models.Instrument,
     start: dt.datetime,
     end: dt.datetime,
+    resolution: str = "1DAY",
 ) -> float:
-    df = fetch_prices_as_dataframe([instr1, instr2], start, end)
+    df = fetch_prices_as_dataframe([instr1, instr2], start, end, resolution=resolution)
     return df.corr().iloc[0, 1]
 
 
 def evaluate_trade(
-    instr: models.Instrument, base: models.Instrument, date: dt.datetime
+    instr: models.Instrument,
+    base: models.Instrument,
+    date: dt.datetime,
+    params: StrategyParams = DEFAULT_STRATEGY,
 ) -> dict[Any]:
     # Collect a bunch of data as we're going for returning
     ret = {
@@ -92,31 +249,73 @@ def evaluate_trade(
             ret["reason"] = "Already have a position"
             return ret
 
-        # 2. Check if instr is correlated with base over the last 30 days
-        corr_30d = compute_instrument_correlation(
-            instr, base, date - dt.timedelta(days=30), date
+        # Use the incrementally maintained correlations when they are current
+        rolling = get_rolling_correlations(
+            [instr], base, _make_aware(date), params.resolution
         )
+
+        # 2. Check if instr is correlated with base over the last 30 days
+        corr_30d = rolling.get((instr.id, params.corr_window))
+        if corr_30d is None:
+            corr_30d = compute_instrument_correlation(
+                instr,
+                base,
+                date - params.window_length(params.corr_window),
+                date,
+                params.resolution,
+            )
         ret["corr_30d"] = corr_30d
-        if corr_30d < 0.5:
-            ret["reason"] = "30 day correlation is too low"
+        if np.isnan(corr_30d):
+            raise ValueError(
+                "Not enough prices to compute the {} correlation".format(
+                    params.describe_window(params.corr_window)
+                )
+            )
+
+        if corr_30d < params.min_corr:
+            ret["reason"] = "{} correlation is too low".format(
+                params.describe_window(params.corr_window)
+            )
             return ret
 
         # 3. Check if instr is inversely correlated with base over the last 4 days
-        corr_4d = compute_instrument_correlation(
-            instr, base, date - dt.timedelta(days=4), date
-        )
+        corr_4d = rolling.get((instr.id, params.inverse_corr_window))
+        if corr_4d is None:
+            corr_4d = compute_instrument_correlation(
+                instr,
+                base,
+                date - params.window_length(params.inverse_corr_window),
+                date,
+                params.resolution,
+            )
         ret["corr_4d"] = corr_4d
-        if corr_4d > -0.25:
-            ret["reason"] = "4 day correlation is too high"
+        if np.isnan(corr_4d):
+            raise ValueError(
+                "Not enough prices to compute the {} correlation".format(
+                    params.describe_window(params.inverse_corr_window)
+                )
+            )
+
+        if corr_4d > params.max_inverse_corr:
+            ret["reason"] = "{} correlation is too high".format(
+                params.describe_window(params.inverse_corr_window)
+            )
             return ret
 
         # 4. Check if base is up over the last 4 days
-        base_4d = fetch_close(base, date - dt.timedelta(days=4))
-        base_now = fetch_close(base, date)
+        base_4d, base_now = fetch_closes(
+            [
+                (base, date - params.window_length(params.base_return_window)),
+                (base, date),
+            ],
+            params.resolution,
+        )
         base_diff_4d = float((base_now - base_4d) / base_4d)
         ret["base_diff_4d"] = base_diff_4d
         if base_diff_4d < 0:
-            ret["reason"] = "Base is down over the last 4 days"
+            ret["reason"] = "Base is down over the last {}".format(
+                params.describe_window(params.base_return_window, plural=True)
+            )
             return ret
 
         # All the criteria passed
@@ -127,3 +326,170 @@ def evaluate_trade(
         ret["error"] = True
         ret["open_position"] = False
         return ret
+
+
+def pairwise_correlation(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Pearson correlation of every column of x with y.
+
+    Like DataFrame.corr, each correlation only uses the rows where both values are
+    present, and is NaN with fewer than two such rows or zero variance.
+    """
+    y = np.broadcast_to(y[:, None], x.shape)
+    mask = ~np.isnan(x) & ~np.isnan(y)
+    n = mask.sum(axis=0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_x = np.where(mask, x, 0).sum(axis=0) / n
+        mean_y = np.where(mask, y, 0).sum(axis=0) / n
+        dx = np.where(mask, x - mean_x, 0)
+        dy = np.where(mask, y - mean_y, 0)
+        corr = (dx * dy).sum(axis=0) / np.sqrt(
+            (dx * dx).sum(axis=0) * (dy * dy).sum(axis=0)
+        )
+
+    corr[n < 2] = np.nan
+    return corr
+
+
+def _compute_correlations(
+    instruments: list[models.Instrument],
+    base: models.Instrument,
+    date: dt.datetime,
+    params: StrategyParams = DEFAULT_STRATEGY,
+) -> tuple[np.ndarray, np.ndarray]:
+    """The correlations of every instrument with base over both windows, from the closes"""
+    longest_window = max(params.corr_window, params.inverse_corr_window)
+    closes, period_ends = load_close_matrix(
+        [*instruments, base],
+        date - params.window_length(longest_window),
+        date,
+        params.resolution,
+    )
+    # Base is the last column, even if it is also one of the instruments
+    base_closes = closes.iloc[:, -1].to_numpy()
+    instr_closes = closes.iloc[:, :-1].to_numpy()
+
+    corrs = []
+    for window in (params.corr_window, params.inverse_corr_window):
+        # Each window is the tail of the longest one
+        in_window = (period_ends >= date - params.window_length(window)).to_numpy()
+        corrs.append(
+            pairwise_correlation(
+                np.where(in_window[:, :-1], instr_closes, np.nan),
+                np.where(in_window[:, -1], base_closes, np.nan),
+            )
+        )
+    return corrs[0], corrs[1]
+
+
+def evaluate_trades(
+    instruments: list[models.Instrument],
+    base: models.Instrument,
+    date: dt.datetime,
+    params: StrategyParams = DEFAULT_STRATEGY,
+) -> dict[str, dict[str, Any]]:
+    """
+    Evaluates the trade of every instrument against base, like evaluate_trade, but
+    with a constant number of queries.
+
+    The stored rolling correlations are used when they are current. Otherwise the
+    closes of all instruments and base are loaded once and all correlations are
+    computed in one vectorized pass.
+
+    Returns:
+        dict[str, dict[str, Any]]: The evaluate_trade result by instrument symbol
+    """
+    results = {
+        instr.symbol: {
+            "instr": instr.symbol,
+            "base": base.symbol,
+            "date": date.isoformat(),
+            "open_position": False,
+            "error": False,
+        }
+        for instr in instruments
+    }
+    if not instruments:
+        return results
+
+    date = _make_aware(date)
+
+    instruments_with_position = set(
+        models.Position.objects.filter(
+            instrument__in=instruments, base_instrument=base
+        ).values_list("instrument_id", flat=True)
+    )
+
+    rolling = get_rolling_correlations(instruments, base, date, params.resolution)
+    windows = (params.corr_window, params.inverse_corr_window)
+    if all(
+        (instr.id, window) in rolling for instr in instruments for window in windows
+    ):
+        # The incrementally maintained correlations are current, so no prices are needed
+        corrs_30d, corrs_4d = (
+            np.array([rolling[(instr.id, window)] for instr in instruments])
+            for window in windows
+        )
+    else:
+        corrs_30d, corrs_4d = _compute_correlations(instruments, base, date, params)
+
+    try:
+        base_4d, base_now = fetch_closes(
+            [
+                (base, date - params.window_length(params.base_return_window)),
+                (base, date),
+            ],
+            params.resolution,
+        )
+        base_diff_4d = float((base_now - base_4d) / base_4d)
+    except Exception as e:
+        logger.error("Error fetching base closes of {}".format(base), exc_info=e)
+        base_diff_4d = None
+
+    for i, instr in enumerate(instruments):
+        ret = results[instr.symbol]
+
+        if instr.id in instruments_with_position:
+            ret["reason"] = "Already have a position"
+            continue
+
+        ret["corr_30d"] = float(corrs_30d[i])
+        if np.isnan(corrs_30d[i]):
+            logger.error("Not enough prices to evaluate trade of {}".format(instr))
+            ret["error"] = True
+            continue
+
+        if corrs_30d[i] < params.min_corr:
+            ret["reason"] = "{} correlation is too low".format(
+                params.describe_window(params.corr_window)
+            )
+            continue
+
+        ret["corr_4d"] = float(corrs_4d[i])
+        if np.isnan(corrs_4d[i]):
+            logger.error("Not enough prices to evaluate trade of {}".format(instr))
+            ret["error"] = True
+            continue
+
+        if corrs_4d[i] > params.max_inverse_corr:
+            ret["reason"] = "{} correlation is too high".format(
+                params.describe_window(params.inverse_corr_window)
+            )
+            continue
+
+        if base_diff_4d is None:
+            ret["error"] = True
+            continue
+
+        ret["base_diff_4d"] = base_diff_4d
+        if base_diff_4d < 0:
+            ret["reason"] = "Base is down over the last {}".format(
+                params.describe_window(params.base_return_window, plural=True)
+            )
+            continue
+
+        # All the criteria passed
+        ret["open_position"] = True
+
+    return results
@@ -0,0 +1,180 @@
+"""
+Celery tasks, including the trading pipeline that celery beat runs on
+TRADING_PIPELINE_CRON:
+
+    group(sync the candles of each instrument and resolution)
+    -> finish_candle_sync_task: rollups, derived data and sync history
+    -> evaluate_trades_task: evaluation results
+    -> group(open_position_task for each instrument to trade)
+
+The syncs run in parallel on the workers, so the pipeline takes as long as the slowest
+market rather than the sum of all of them. Each stage has a time limit, and the syncs and
+the evaluation are retried with a backoff.
+"""
+import datetime as dt
+
+import structlog
+from celery import chord, group, shared_task
+from django.conf import settings
+
+from api import models
+from api.services import trade_evaluator
+from api.services.positions import open_position
+from api.services.retention import apply_retention
+from api.services.sync import (
+    BASE_SYMBOL,
+    add_failed_instrument,
+    get_dydx_instruments,
+    record_dydx_candle_sync,
+    record_trade_evaluation,
+    rollup_recent_dydx_candles,
+    sync_coingecko_ohlc,
+    sync_dydx_candles_for,
+)
+
+logger = structlog.get_logger(__name__)
+
+# Seconds between the soft time limit, which raises in the task, and the hard one,
+# which kills the worker process
+TIME_LIMIT_GRACE_SECONDS = 30
+
+
+@shared_task
+def sync_coingecko_ohlc_task(instrument_ids: list[int], sync_history_id: int) -> int:
+    """Runs sync_coingecko_ohlc in a worker, reporting to the given sync history"""
+    sync_history = models.SyncHistory.objects.get(id=sync_history_id)
+    instruments = list(models.Instrument.objects.filter(id__in=instrument_ids))
+    return sync_coingecko_ohlc(instruments, sync_history).records_synced
+
+
+@shared_task
+def apply_retention_task() -> dict[str, int]:
+    return apply_retention()
+
+
+@shared_task(
+    bind=True,
+    max_retries=settings.PIPELINE_MAX_RETRIES,
+    soft_time_limit=settings.PIPELINE_SYNC_TIME_LIMIT_SECONDS,
+    time_limit=settings.PIPELINE_SYNC_TIME_LIMIT_SECONDS + TIME_LIMIT_GRACE_SECONDS,
+)
+def sync_instrument_candles_task(self, instrument_id: int, resolution: str) -> dict:
+    """
+    Syncs the candles of one instrument. Once the retries run out, the market is
+    reported as failed rather than raised, so the other markets still get evaluated.
+    """
+    instrument = models.Instrument.objects.get(id=instrument_id)
+    try:
+        num_inserted, num_updated, failed_markets = sync_dydx_candles_for(
+            [instrument], resolution
+        )
+        if failed_markets:
+            raise RuntimeError("Error fetching the candles of {}".format(instrument))
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=2**self.request.retries)
+        logger.error("Error syncing the candles of {}".format(instrument), exc_info=e)
+        return {
+            "resolution": resolution,
+            "inserted": 0,
+            "updated": 0,
+            "failed_markets": [instrument.dydx_market_id],
+        }
+    return {
+        "resolution": resolution,
+        "inserted": num_inserted,
+        "updated": num_updated,
+        "failed_markets": [],
+    }
+
+
+@shared_task(
+    soft_time_limit=settings.PIPELINE_EVALUATE_TIME_LIMIT_SECONDS,
+    time_limit=settings.PIPELINE_EVALUATE_TIME_LIMIT_SECONDS + TIME_LIMIT_GRACE_SECONDS,
+)
+def finish_candle_sync_task(results: list[dict]) -> None:
+    """Records the syncs of each resolution and derives the rollups from them"""
+    for resolution in settings.DYDX_CANDLE_RESOLUTIONS:
+        synced = [result for result in results if result["resolution"] == resolution]
+        record_dydx_candle_sync(
+            resolution,
+            sum(result["inserted"] for result in synced),
+            sum(result["updated"] for result in synced),
+            [market for result in synced for market in result["failed_markets"]],
+        )
+    rollup_recent_dydx_candles()
+
+
+@shared_task(
+    bind=True,
+    max_retries=settings.PIPELINE_MAX_RETRIES,
+    soft_time_limit=settings.PIPELINE_EVALUATE_TIME_LIMIT_SECONDS,
+    time_limit=settings.PIPELINE_EVALUATE_TIME_LIMIT_SECONDS + TIME_LIMIT_GRACE_SECONDS,
+)
+def evaluate_trades_task(self) -> list[int]:
+    """
+    Evaluates every tradeable instrument, like do_trades, and queues an order task for
+    each position to open.
+
+    Returns:
+        list[int]: The ids of the instruments whose positions were queued
+    """
+    try:
+        trading_settings = models.Settings.objects.get(id=1)
+        base = models.Instrument.objects.get(symbol=BASE_SYMBOL)
+        instruments = list(models.Instrument.objects.filter(enable_dydx_trades=True))
+        results = trade_evaluator.evaluate_trades(instruments, base, dt.datetime.now())
+        sync_history = record_trade_evaluation(instruments, base, results)
+    except Exception as e:
+        raise self.retry(exc=e, countdown=2**self.request.retries)
+
+    if not trading_settings.enable_trades:
+        logger.warning("Trades are disabled, not opening position")
+        return []
+
+    to_open = [
+        instrument.id
+        for instrument in instruments
+        if results[instrument.symbol]["open_position"]
+    ]
+    if to_open:
+        group(
+            open_position_task.s(instrument_id, base.id, sync_history.id)
+            for instrument_id in to_open
+        ).apply_async()
+    return to_open
+
+
+@shared_task(
+    soft_time_limit=settings.PIPELINE_ORDER_TIME_LIMIT_SECONDS,
+    time_limit=settings.PIPELINE_ORDER_TIME_LIMIT_SECONDS + TIME_LIMIT_GRACE_SECONDS,
+)
+def open_position_task(instrument_id: int, base_id: int, sync_history_id: int) -> int:
+    """
+    Opens the position of one instrument. It isn't retried, since a leg may already
+    have been placed.
+
+    Returns:
+        int: The id of the position
+    """
+    instrument = models.Instrument.objects.get(id=instrument_id)
+    base = models.Instrument.objects.get(id=base_id)
+    try:
+        return open_position(instrument, base).id
+    except Exception:
+        add_failed_instrument(
+            models.SyncHistory.objects.get(id=sync_history_id), instrument
+        )
+        raise
+
+
+@shared_task
+def run_trading_pipeline() -> None:
+    """Queues the candle syncs, then the evaluation and the orders"""
+    instruments = get_dydx_instruments()
+    syncs = group(
+        sync_instrument_candles_task.s(instrument.id, resolution)
+        for resolution in settings.DYDX_CANDLE_RESOLUTIONS
+        for instrument in instruments
+    )
+    chord(syncs, finish_candle_sync_task.s() | evaluate_trades_task.si()).apply_async()
@@ -1,20 +1,83 @@
+import asyncio
 import datetime as dt
+import io
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
 
+import numpy as np
+import pandas as pd
 import pytest
+from django.core.cache import cache
 from django.core.management import call_command
+from django.db import connection
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from dydx3 import Client as DydxClient
+from dydx3.errors import DydxApiError
+from eth_account import Account
 
 from accounts.models import User
-from api.models import DydxCandle, Instrument
+from api import tasks
+from api.management.commands import backfill_dydx_candles
+from api.models import (
+    CoingeckoInstrumentOHLC,
+    DydxCandle,
+    DydxCandleBackfill,
+    EvaluationResult,
+    Instrument,
+    Position,
+    RollingCorrelation,
+    Settings,
+    SyncHistory,
+)
+from api.services import dydx_trader, positions, retention, sync, trade_evaluator
+from api.services.backtest import (
+    compute_signals,
+    load_backtest_prices,
+    rolling_correlation,
+    run_backtest,
+)
+from api.services.candle_cache import CandleCache
+from api.services.dydx_models import CandlesModel
+from api.services.fake_dydx import FakeDydxExchange, FakeDydxWebsocket
+from api.services.live_prices import LivePriceCache, get_live_price, live_prices
+from api.services.market_cache import MarketCache, round_to_increment
+from api.services.market_data import MarketDataWorker
+from api.services.orders import OrderTracker
+from api.services.price_store import PriceStore, price_store, to_ns
+from api.services.rolling import update_rolling_correlations
+from api.services.rollups import get_rollup_order, rollup_dydx_candles
+from api.services.sweep import make_grid, run_sweep
+from api.services.throttle import RateLimiter, SharedRateLimiter
 from api.services.trade_evaluator import (
+    StrategyParams,
     compute_instrument_correlation,
     evaluate_trade,
+    evaluate_trades,
+    fetch_candles,
+    fetch_close,
+    fetch_closes,
     fetch_prices_as_dataframe,
 )
+from config import celery_app
 
 # Create your tests here.
 
 
+@pytest.fixture(autouse=True)
+def clear_price_store():
+    # The stores are process-wide and would outlive each test's database transaction
+    price_store.invalidate()
+    live_prices.clear()
+    cache.clear()
+
+
 @pytest.fixture
 def load_data(db):
     call_command("loaddata", "fixtures/instruments.json")
@@ -41,13 +104,35 @@ def test_fetch_prices_as_dataframe(load_data):
     end = dt.datetime(2023, 6, 12)
     prices_df = fetch_prices_as_dataframe(instruments, start, end)
 
+    day_1 = pd.Timestamp("2023-06-10", tz="UTC")
+    day_2 = pd.Timestamp("2023-06-11", tz="UTC")
     expected_dict = {
-        "ETH": {0: 1752.3, 1: 1753.3},
-        "DOGE": {0: 0.0617, 1: 0.0616},
+        "ETH": {day_1: 1752.3, day_2: 1753.3},
+        "DOGE": {day_1: 0.0617, day_2: 0.0616},
     }
     assert prices_df.to_dict() == expected_dict
 
 
+def test_fetch_prices_as_dataframe_aligns_dates(load_data):
+    instruments = [Instrument.objects.get(symbol=s) for s in ["ETH", "DOGE"]]
+    start = dt.datetime(2023, 6, 9)
+    end = dt.datetime(2023, 6, 12)
+    day_2 = pd.Timestamp("2023-06-10", tz="UTC")
+    DydxCandle.objects.filter(instrument=instruments[1], period_start=day_2).delete()
+    price_store.invalidate()
+
+    outer = fetch_prices_as_dataframe(instruments, start, end)
+    assert len(outer) == 3
+    assert np.isnan(outer.loc[day_2, "DOGE"])
+    assert outer.loc[day_2, "ETH"] == 1752.3
+
+    inner = fetch_prices_as_dataframe(instruments, start, end, how="inner")
+    assert list(inner.index) == [outer.index[0], outer.index[2]]
+
+    filled = fetch_prices_as_dataframe(instruments, start, end, fill="ffill")
+    assert filled.loc[day_2, "DOGE"] == outer["DOGE"].iloc[0]
+
+
 def test_instrument_correlation(load_data):
     doge = Instrument.objects.get(symbol="DOGE")
     eth = Instrument.objects.get(symbol="ETH")
@@ -72,3 +157,1956 @@ def test_evaluate_trade(load_data):
         "reason": "30 day correlation is too low",
     }
     assert res == expected
+
+
+def _make_candles(instrument, n, close=1):
+    start = dt.datetime(2020, 1, 1, tzinfo=dt.timezone.utc)
+    return [
+        DydxCandle(
+            instrument=instrument,
+            period_start=start + dt.timedelta(days=i),
+            period_end=start + dt.timedelta(days=i + 1),
+            resolution="1DAY",
+            open=close,
+            high=close,
+            low=close,
+            close=close,
+        )
+        for i in range(n)
+    ]
+
+
+def test_upsert_dydx_candles_is_idempotent(load_data):
+    doge = Instrument.objects.get(symbol="DOGE")
+    num_candles = DydxCandle.objects.count()
+
+    assert sync.upsert_dydx_candles(_make_candles(doge, 5)) == (5, 0)
+    assert sync.upsert_dydx_candles(_make_candles(doge, 7, close=2)) == (2, 5)
+
+    assert DydxCandle.objects.count() == num_candles + 7
+    new_candles = DydxCandle.objects.filter(instrument=doge, period_start__year=2020)
+    assert {float(candle.close) for candle in new_candles} == {2}
+
+
+def test_upsert_dydx_candles_query_count(load_data, django_assert_num_queries):
+    doge = Instrument.objects.get(symbol="DOGE")
+
+    # One existence query and one insert, regardless of the number of candles
+    with django_assert_num_queries(2):
+        sync.upsert_dydx_candles(_make_candles(doge, 10), batch_size=100)
+    with django_assert_num_queries(2):
+        sync.upsert_dydx_candles(_make_candles(doge, 50), batch_size=100)
+
+
+def test_sync_dydx_candles(load_data, monkeypatch):
+    requests = {}
+
+    class FakeTrader:
+        def get_candles(self, market, resolution="1DAY", **kwargs):
+            requests[market] = kwargs
+            return CandlesModel(
+                candles=[
+                    {
+                        "startedAt": "2020-01-0{}T00:00:00.000Z".format(day),
+                        "updatedAt": "2020-01-0{}T23:59:00.000Z".format(day),
+                        "market": market,
+                        "resolution": "1DAY",
+                        "low": "1",
+                        "high": "1",
+                        "open": "1",
+                        "close": "1",
+                        "baseTokenVolume": "0",
+                        "trades": "0",
+                        "usdVolume": "0",
+                        "startingOpenInterest": "0",
+                    }
+                    for day in [1, 2]
+                ]
+            )
+
+    monkeypatch.setattr(sync, "get_trader", FakeTrader)
+    num_markets = Instrument.objects.exclude(dydx_market_id="").count()
+
+    sync.sync_dydx_candles()
+    history = SyncHistory.objects.get(sync_type="dydx_candles")
+    assert history.records_synced == 2 * num_markets
+    assert history.extra_data == {
+        "inserted": 2 * num_markets,
+        "updated": 0,
+        "failed_markets": [],
+    }
+
+    # Markets with stored candles only ask for candles after the latest one
+    assert requests["ETH-USD"]["from_iso"] == "2023-06-18T00:00:00.000Z"
+    assert requests["DOGE-USD"]["from_iso"] == "2023-06-18T00:00:00.000Z"
+
+
+def test_get_candle_sync_starts(load_data):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    now = dt.datetime(2023, 6, 20, tzinfo=dt.timezone.utc)
+
+    starts = sync.get_candle_sync_starts([doge, eth], "1DAY", now)
+    assert starts == {
+        doge.id: dt.datetime(2023, 6, 18, tzinfo=dt.timezone.utc),
+        eth.id: dt.datetime(2023, 6, 18, tzinfo=dt.timezone.utc),
+    }
+
+    # A missing candle in the lookback window gets refetched
+    DydxCandle.objects.filter(
+        instrument=doge, period_start=dt.datetime(2023, 6, 1, tzinfo=dt.timezone.utc)
+    ).delete()
+    starts = sync.get_candle_sync_starts([doge, eth], "1DAY", now)
+    assert starts[doge.id] == dt.datetime(2023, 6, 1, tzinfo=dt.timezone.utc)
+    assert starts[eth.id] == dt.datetime(2023, 6, 18, tzinfo=dt.timezone.utc)
+
+
+@pytest.fixture
+def fake_candles_server():
+    """Serves /v3/candles/<market> locally, taking `latency` seconds per request"""
+    state = {"latency": 0.2, "in_flight": 0, "max_in_flight": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                state["in_flight"] += 1
+                state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+            time.sleep(state["latency"])
+            with lock:
+                state["in_flight"] -= 1
+
+            market = urlparse(self.path).path.split("/")[-1]
+            if market == "BROKEN-USD":
+                self.send_response(500)
+                self.end_headers()
+                return
+
+            body = json.dumps({"candles": []}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state["host"] = "http://127.0.0.1:{}".format(server.server_port)
+    yield state
+    server.shutdown()
+
+
+def test_fetch_dydx_candles_concurrently(fake_candles_server):
+    client = DydxClient(host=fake_candles_server["host"])
+
+    def get_candles(market):
+        return CandlesModel(**client.public.get_candles(market=market).data)
+
+    markets = ["M{}-USD".format(i) for i in range(8)] + ["BROKEN-USD"]
+
+    t0 = time.perf_counter()
+    candles = sync.fetch_dydx_candles(get_candles, markets, max_workers=3)
+    elapsed = time.perf_counter() - t0
+
+    assert set(candles) == set(markets) - {"BROKEN-USD"}
+    assert fake_candles_server["max_in_flight"] <= 3
+    # 9 requests at 0.2s each take 1.8s serially, and 0.6s three at a time
+    assert elapsed < 1.2
+
+
+@pytest.fixture
+def fake_coingecko(settings):
+    """
+    Serves /coins/<id>/ohlc locally with keep-alive connections. Coins in `throttled`
+    get a 429 with Retry-After the first time, and unknown coins a 404.
+    """
+    start = dt.datetime(2023, 6, 1, tzinfo=dt.timezone.utc)
+    state = {
+        "ohlc": [
+            [int((start + i * dt.timedelta(hours=4)).timestamp() * 1000), 1, 2, 0.5, i]
+            for i in range(10)
+        ],
+        "coins": {"ripple", "binancecoin", "bitcoin", "ethereum"},
+        "throttled": {"bitcoin"},
+        "requests": 0,
+        "connections": set(),
+    }
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            coin = urlparse(self.path).path.split("/")[-2]
+            with lock:
+                state["requests"] += 1
+                state["connections"].add(self.client_address)
+                throttled = coin in state["throttled"]
+                state["throttled"].discard(coin)
+
+            if throttled:
+                status, body, headers = 429, b"{}", {"Retry-After": "0.2"}
+            elif coin not in state["coins"]:
+                status, body, headers = 404, b"{}", {}
+            else:
+                status, body, headers = 200, json.dumps(state["ohlc"]).encode(), {}
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    settings.COINGECKO_API_URL = "http://127.0.0.1:{}".format(server.server_port)
+    settings.COINGECKO_REQUESTS_PER_SECOND = 100
+    yield state
+    server.shutdown()
+
+
+def test_sync_coingecko_ohlc(load_data, fake_coingecko):
+    instruments = list(Instrument.objects.exclude(coingecko_id=""))
+
+    t0 = time.perf_counter()
+    history = sync.sync_coingecko_ohlc(instruments, max_workers=2)
+    elapsed = time.perf_counter() - t0
+
+    # The newest, unfinished candle is skipped
+    num_synced = 9 * (len(instruments) - 1)
+    assert history.sync_type == "coingecko_ohlc"
+    assert history.records_synced == num_synced
+    assert history.extra_data == {
+        "total": len(instruments),
+        "done": len(instruments),
+        "inserted": num_synced,
+        "updated": 0,
+        "failed_instruments": ["KAP"],
+    }
+    btc = Instrument.objects.get(symbol="BTC")
+    assert CoingeckoInstrumentOHLC.objects.filter(instrument=btc).count() == 9
+    # bitcoin was retried after its Retry-After, and the connections were reused
+    assert fake_coingecko["requests"] == len(instruments) + 1
+    assert elapsed >= 0.2
+    assert len(fake_coingecko["connections"]) <= 2
+
+    fake_coingecko["ohlc"][0][4] = 100
+    history = sync.sync_coingecko_ohlc(instruments)
+    assert history.extra_data["inserted"] == 0
+    assert history.extra_data["updated"] == num_synced
+    first = CoingeckoInstrumentOHLC.objects.filter(instrument=btc).earliest("date")
+    assert first.close == 100
+
+
+def test_retrieve_ohlc_admin_action(client, fake_coingecko, monkeypatch):
+    monkeypatch.setattr(celery_app.conf, "task_always_eager", True)
+    instrument_ids = list(
+        Instrument.objects.filter(symbol__in=["BTC", "DOGE"]).values_list(
+            "id", flat=True
+        )
+    )
+
+    response = client.post(
+        "/admin/api/instrument/",
+        {"action": "retrieve_ohlc", "_selected_action": instrument_ids},
+        follow=True,
+    )
+
+    assert response.status_code == 200
+    history = SyncHistory.objects.get(sync_type="coingecko_ohlc")
+    # DOGE has no coingecko id
+    assert history.extra_data["total"] == 1
+    assert history.extra_data["done"] == 1
+    assert history.records_synced == 9
+    assert "/admin/api/synchistory/{}/change/".format(history.id) in (
+        response.content.decode()
+    )
+
+
+def test_fetch_dydx_candles_rate_limited(fake_candles_server):
+    fake_candles_server["latency"] = 0
+    client = DydxClient(host=fake_candles_server["host"])
+
+    def get_candles(market):
+        return CandlesModel(**client.public.get_candles(market=market).data)
+
+    markets = ["M{}-USD".format(i) for i in range(5)]
+
+    t0 = time.perf_counter()
+    sync.fetch_dydx_candles(
+        get_candles, markets, max_workers=5, rate_limiter=RateLimiter(rate=10)
+    )
+    # The first request goes out immediately, then one every 0.1s
+    assert time.perf_counter() - t0 >= 0.4
+
+
+def test_shared_rate_limiter():
+    # Each limiter stands for a worker process, sharing the rate through the cache
+    limiters = [SharedRateLimiter("https://api.example.com", rate=10) for _ in range(3)]
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(limiters)) as executor:
+        for _ in range(2):
+            list(executor.map(SharedRateLimiter.acquire, limiters))
+    # Six calls in six windows of 0.1s, the first of which may be nearly over
+    assert time.perf_counter() - t0 >= 0.4
+
+
+class FakeHistoryTrader:
+    """Serves daily candles for every day of 2020, newest first like the dydx API"""
+
+    def __init__(self, fail_after_calls=None):
+        self.calls = []
+        self.fail_after_calls = fail_after_calls
+
+    def get_candles(self, market, resolution="1DAY", to_iso=None, limit=100, **kwargs):
+        if (
+            self.fail_after_calls is not None
+            and len(self.calls) >= self.fail_after_calls
+        ):
+            raise ConnectionError("Connection lost")
+        self.calls.append(to_iso)
+
+        end = sync.parse_dydx_timestamp(to_iso) if to_iso else None
+        days = [
+            dt.datetime(2020, 1, 1, tzinfo=dt.timezone.utc) + dt.timedelta(days=i)
+            for i in range(366)
+        ]
+        days = [day for day in reversed(days) if end is None or day <= end][:limit]
+        return CandlesModel(
+            candles=[
+                {
+                    "startedAt": sync.format_dydx_timestamp(day),
+                    "updatedAt": sync.format_dydx_timestamp(day + dt.timedelta(days=1)),
+                    "market": market,
+                    "resolution": resolution,
+                    "low": "1",
+                    "high": "1",
+                    "open": "1",
+                    "close": "1",
+                    "baseTokenVolume": "0",
+                    "trades": "0",
+                    "usdVolume": "0",
+                    "startingOpenInterest": "0",
+                }
+                for day in days
+            ]
+        )
+
+
+def test_backfill_dydx_candles_resumes(load_data, monkeypatch):
+    doge = Instrument.objects.get(symbol="DOGE")
+    backfilled = DydxCandle.objects.filter(instrument=doge, period_start__year=2020)
+
+    # The connection drops after 3 pages, after the first two pages were written. The
+    # second page repeats the oldest candle of the first one, so only 199 are new.
+    trader = FakeHistoryTrader(fail_after_calls=3)
+    monkeypatch.setattr(backfill_dydx_candles, "get_trader", lambda: trader)
+    with pytest.raises(ConnectionError):
+        call_command(
+            "backfill_dydx_candles",
+            "--symbols=DOGE",
+            "--since=2020-01-01",
+            "--batch-size=150",
+        )
+    checkpoint = DydxCandleBackfill.objects.get(instrument=doge, resolution="1DAY")
+    assert not checkpoint.completed
+    assert checkpoint.records_synced == backfilled.count() == 199
+    cursor = checkpoint.cursor
+
+    trader = FakeHistoryTrader()
+    monkeypatch.setattr(backfill_dydx_candles, "get_trader", lambda: trader)
+    call_command(
+        "backfill_dydx_candles",
+        "--symbols=DOGE",
+        "--since=2020-01-01",
+        "--batch-size=150",
+    )
+    checkpoint.refresh_from_db()
+    assert checkpoint.completed
+    assert backfilled.count() == 366
+    # The resumed run starts paging from the checkpoint
+    assert trader.calls[0] == sync.format_dydx_timestamp(cursor)
+    assert SyncHistory.objects.get(sync_type="dydx_backfill").records_synced == 167
+
+
+@pytest.mark.parametrize("date", [dt.datetime(2023, 6, 12), dt.datetime(2023, 4, 20)])
+def test_evaluate_trades_matches_evaluate_trade(load_data, date):
+    instruments = list(Instrument.objects.all())
+    eth = Instrument.objects.get(symbol="ETH")
+
+    results = evaluate_trades(instruments, eth, date)
+
+    assert set(results) == {instr.symbol for instr in instruments}
+    for instr in instruments:
+        expected = evaluate_trade(instr, eth, date)
+        assert results[instr.symbol] == pytest.approx(expected, nan_ok=True)
+
+
+def test_evaluate_trades_query_count(load_data, django_assert_max_num_queries):
+    eth = Instrument.objects.get(symbol="ETH")
+    date = dt.datetime(2023, 6, 12)
+
+    instruments = list(Instrument.objects.all())
+    with django_assert_max_num_queries(6) as ctx:
+        evaluate_trades(instruments, eth, date)
+    num_queries = len(ctx.captured_queries)
+
+    for i in range(10):
+        Instrument.objects.create(symbol="NEW{}".format(i), dydx_market_id="NEW-USD")
+    instruments = list(Instrument.objects.all())
+    with django_assert_max_num_queries(num_queries):
+        evaluate_trades(instruments, eth, date)
+
+
+def test_do_trades_saves_evaluation_results(
+    client, monkeypatch, django_assert_max_num_queries
+):
+    Settings.objects.create(id=1, enable_trades=False)
+    date = dt.datetime(2023, 6, 12)
+    monkeypatch.setattr(
+        trade_evaluator,
+        "evaluate_trades",
+        lambda instruments, base, _: evaluate_trades(instruments, base, date),
+    )
+    Instrument.objects.update(enable_dydx_trades=True)
+    instruments = list(Instrument.objects.all())
+    eth = Instrument.objects.get(symbol="ETH")
+    expected = evaluate_trades(instruments, eth, date)
+
+    sync.do_trades()
+
+    history = SyncHistory.objects.get(sync_type="trades")
+    assert history.records_synced == len(instruments)
+    results = EvaluationResult.objects.filter(sync_history=history)
+    assert results.count() == len(instruments)
+    doge = results.get(instrument__symbol="DOGE")
+    assert doge.base_instrument == eth
+    assert doge.date == timezone.make_aware(date)
+    assert doge.corr_30d == pytest.approx(expected["DOGE"]["corr_30d"])
+    assert doge.reason == expected["DOGE"]["reason"]
+    assert not doge.open_position
+
+    # One bulk insert per run
+    with django_assert_max_num_queries(2):
+        sync.save_evaluation_results(
+            SyncHistory.objects.create(date=timezone.now(), sync_type="trades"),
+            instruments,
+            eth,
+            expected,
+        )
+
+    response = client.get(
+        "/api/evaluation-results/", {"instrument__symbol": "DOGE", "limit": 1}
+    )
+    assert response.status_code == 200
+    assert response.json()["count"] == 2
+    [latest] = response.json()["results"]
+    assert latest["instrument"] == "DOGE"
+    assert latest["base_instrument"] == "ETH"
+    assert latest["reason"] == doge.reason
+
+
+def test_trading_pipeline(load_data, monkeypatch, settings):
+    monkeypatch.setattr(celery_app.conf, "task_always_eager", True)
+    settings.DYDX_CANDLE_RESOLUTIONS = ["1DAY"]
+    Settings.objects.create(id=1, enable_trades=True)
+    Instrument.objects.filter(symbol__in=["DOGE", "BTC"]).update(
+        enable_dydx_trades=True
+    )
+    requests = []
+
+    class FakeTrader:
+        def get_candles(self, market, resolution="1DAY", **kwargs):
+            requests.append(market)
+            if market == "DOGE-USD":
+                raise RuntimeError("Down")
+            return CandlesModel(candles=[])
+
+    monkeypatch.setattr(sync, "get_trader", FakeTrader)
+    date = dt.datetime(2023, 6, 12)
+    evaluate = evaluate_trades
+
+    def evaluate_trades_at(instruments, base, _):
+        results = evaluate(instruments, base, date)
+        results["DOGE"]["open_position"] = True
+        return results
+
+    monkeypatch.setattr(trade_evaluator, "evaluate_trades", evaluate_trades_at)
+    opened = []
+
+    def open_position(instrument, base):
+        opened.append(instrument.symbol)
+        if instrument.symbol == "BTC":
+            raise RuntimeError("Not filled")
+        return Position.objects.create(
+            instrument=instrument,
+            base_instrument=base,
+            position_size=100,
+            input_instr_price=1,
+            input_base_price=1,
+        )
+
+    monkeypatch.setattr(tasks, "open_position", open_position)
+
+    tasks.run_trading_pipeline.delay()
+
+    num_markets = Instrument.objects.exclude(dydx_market_id="").count()
+    # DOGE is retried, and then reported as failed without holding up the evaluation
+    assert len(requests) == num_markets + settings.PIPELINE_MAX_RETRIES
+    candle_sync = SyncHistory.objects.get(sync_type="dydx_candles")
+    assert candle_sync.extra_data["failed_markets"] == ["DOGE-USD"]
+    trades = SyncHistory.objects.get(sync_type="trades")
+    assert EvaluationResult.objects.filter(sync_history=trades).count() == 2
+    assert opened == ["DOGE"]
+    assert Position.objects.get().instrument.symbol == "DOGE"
+
+    # A failed order is recorded on its run
+    result = tasks.open_position_task.delay(
+        Instrument.objects.get(symbol="BTC").id,
+        Instrument.objects.get(symbol="ETH").id,
+        trades.id,
+    )
+    assert result.failed()
+    trades.refresh_from_db()
+    assert trades.extra_data["failed_instruments"] == ["BTC"]
+
+
+def test_fetch_close(load_data, django_assert_num_queries):
+    doge = Instrument.objects.get(symbol="DOGE")
+
+    with django_assert_num_queries(1):
+        close = fetch_close(doge, dt.datetime(2023, 6, 11))
+    # The candle of 2023-06-10 ends right before midnight
+    candle = DydxCandle.objects.get(
+        instrument=doge, period_start=dt.datetime(2023, 6, 10, tzinfo=dt.timezone.utc)
+    )
+    assert close == float(candle.close)
+
+    # Outside of the range of candles, the first or last candle is the closest
+    first_candle = DydxCandle.objects.filter(instrument=doge).order_by("period_end")[0]
+    with django_assert_num_queries(0):
+        assert fetch_close(doge, dt.datetime(2020, 1, 1)) == float(first_candle.close)
+
+    with pytest.raises(ValueError):
+        fetch_close(Instrument.objects.get(symbol="BTC"), dt.datetime(2023, 6, 11))
+
+
+def test_fetch_closes(load_data, django_assert_num_queries):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    pairs = [
+        (instrument, dt.datetime(2023, 5, 1) + dt.timedelta(hours=7 * i))
+        for i in range(100)
+        for instrument in [doge, eth]
+    ]
+
+    with django_assert_num_queries(1):
+        closes = fetch_closes(pairs)
+    assert closes == [fetch_close(instrument, date) for instrument, date in pairs]
+
+
+def test_price_store(
+    load_data,
+    django_assert_num_queries,
+    django_capture_on_commit_callbacks,
+    monkeypatch,
+):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+
+    with django_assert_num_queries(1):
+        series = price_store.get_many([doge.id, eth.id])
+    assert len(series[doge.id]) == len(series[eth.id]) == 99
+    with django_assert_num_queries(0):
+        price_store.get(doge.id)
+
+    # Upserted candles are merged into cached series once they are committed
+    candles = _make_candles(doge, 3, close=2)
+    candles[-1].period_start = dt.datetime(2023, 6, 17, tzinfo=dt.timezone.utc)
+    with django_capture_on_commit_callbacks(execute=True):
+        sync.upsert_dydx_candles(candles)
+    with django_assert_num_queries(0):
+        updated = price_store.get(doge.id)
+    assert len(updated) == 101
+    assert updated.closes[-1] == 2
+    assert np.all(np.diff(updated.period_starts) > 0)
+
+    # Stale series pick up candles written behind the store's back
+    monkeypatch.setattr(price_store, "max_age", 0)
+    DydxCandle.objects.create(
+        instrument=doge,
+        period_start=dt.datetime(2023, 6, 18, tzinfo=dt.timezone.utc),
+        period_end=dt.datetime(2023, 6, 19, tzinfo=dt.timezone.utc),
+        resolution="1DAY",
+        open=3,
+        high=3,
+        low=3,
+        close=3,
+    )
+    assert price_store.get(doge.id).closes[-1] == 3
+
+    # And candles before the latest one, e.g. from backfills or gap refetches
+    DydxCandle.objects.filter(
+        instrument=doge, period_start=dt.datetime(2023, 6, 10, tzinfo=dt.timezone.utc)
+    ).update(close=4, updated_at=timezone.now())
+    refreshed = price_store.get(doge.id)
+    assert len(refreshed) == 102
+    row = np.searchsorted(
+        refreshed.period_starts,
+        to_ns(dt.datetime(2023, 6, 10, tzinfo=dt.timezone.utc)),
+    )
+    assert refreshed.closes[row] == 4
+
+
+def test_price_store_eviction(load_data):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    store = PriceStore(max_points=150, max_age=60)
+
+    store.get(doge.id)
+    store.get(eth.id)
+    # Only the most recently used series fits
+    assert list(store._series) == [(eth.id, "1DAY")]
+
+
+def test_update_rolling_correlations(
+    load_data, django_capture_on_commit_callbacks, django_assert_num_queries
+):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    # Right after the last candle of the fixtures ended
+    date = dt.datetime(2023, 6, 18, 1)
+    # Written well before the rolling correlations are first updated
+    DydxCandle.objects.update(updated_at=timezone.now() - dt.timedelta(hours=1))
+    # A gap inside the 30 period window only
+    gap = DydxCandle.objects.get(
+        instrument=doge, period_start=dt.datetime(2023, 6, 10, tzinfo=dt.timezone.utc)
+    )
+    gap.delete()
+
+    assert update_rolling_correlations([doge], eth) == 2
+    for window in [30, 4]:
+        row = RollingCorrelation.objects.get(instrument=doge, window=window)
+        assert len(row.buffer) == row.count == (29 if window == 30 else window)
+        assert row.correlation == pytest.approx(
+            compute_instrument_correlation(
+                doge, eth, date - dt.timedelta(days=window), date
+            )
+        )
+    # Nothing changes without new candles. The rows, the candles written inside their
+    # windows, and the candles after them are read, rather than whole series.
+    with django_assert_num_queries(3):
+        assert update_rolling_correlations([doge], eth) == 0
+
+    # A new candle moves the window forward by one period
+    new_candles = []
+    for instrument, close in [(doge, 0.07), (eth, 1800)]:
+        candle = _make_candles(instrument, 1, close=close)[0]
+        candle.period_start = dt.datetime(2023, 6, 18, tzinfo=dt.timezone.utc)
+        candle.period_end = dt.datetime(2023, 6, 18, 23, 59, tzinfo=dt.timezone.utc)
+        new_candles.append(candle)
+    with django_capture_on_commit_callbacks(execute=True):
+        sync.upsert_dydx_candles(new_candles)
+
+    assert update_rolling_correlations([doge], eth) == 2
+    date += dt.timedelta(days=1)
+    row = RollingCorrelation.objects.get(instrument=doge, window=30)
+    assert row.last_period_start == new_candles[0].period_start
+    assert row.count == 29
+    assert row.correlation == pytest.approx(
+        compute_instrument_correlation(doge, eth, date - dt.timedelta(days=30), date)
+    )
+
+    # Filling the gap rebuilds the window that contains it
+    gap.id = None
+    with django_capture_on_commit_callbacks(execute=True):
+        sync.upsert_dydx_candles([gap])
+    assert update_rolling_correlations([doge], eth) == 1
+    row = RollingCorrelation.objects.get(instrument=doge, window=30)
+    assert row.count == 30
+    assert row.correlation == pytest.approx(
+        compute_instrument_correlation(doge, eth, date - dt.timedelta(days=30), date)
+    )
+
+    # So does a close updated in place, which leaves the number of candles as it is
+    candle = DydxCandle.objects.get(
+        instrument=doge, period_start=dt.datetime(2023, 6, 15, tzinfo=dt.timezone.utc)
+    )
+    candle.close = candle.high = 0.09
+    with django_capture_on_commit_callbacks(execute=True):
+        sync.upsert_dydx_candles([candle])
+    assert update_rolling_correlations([doge], eth) == 2
+    for window in [30, 4]:
+        row = RollingCorrelation.objects.get(instrument=doge, window=window)
+        assert row.correlation == pytest.approx(
+            compute_instrument_correlation(
+                doge, eth, date - dt.timedelta(days=window), date
+            )
+        )
+
+
+def test_evaluate_trades_uses_rolling_correlations(load_data, monkeypatch):
+    instruments = list(Instrument.objects.filter(symbol__in=["DOGE", "ETH"]))
+    eth = Instrument.objects.get(symbol="ETH")
+    date = dt.datetime(2023, 6, 18, 1)
+    expected = evaluate_trades(instruments, eth, date)
+
+    update_rolling_correlations(instruments, eth)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Price history shouldn't be loaded")
+
+    monkeypatch.setattr(trade_evaluator, "load_close_matrix", fail)
+    results = evaluate_trades(instruments, eth, date)
+    for symbol, result in results.items():
+        assert result == pytest.approx(expected[symbol])
+
+
+def test_candle_cache(load_data, tmp_path, settings):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    settings.CANDLE_CACHE_DIR = str(tmp_path)
+    DydxCandle.objects.update(updated_at=timezone.now() - dt.timedelta(hours=1))
+    call_command("refresh_candle_cache")
+
+    cache = CandleCache(tmp_path)
+    candles = cache.open(doge.id)
+    assert isinstance(candles.close, np.memmap)
+    db_closes = DydxCandle.objects.filter(instrument=doge).order_by("period_start")
+    assert candles.close.tolist() == [float(c.close) for c in db_closes]
+    assert len(cache.open(Instrument.objects.get(symbol="BTC").id)) == 0
+
+    closes = cache.close_matrix([doge.id, eth.id])
+    assert closes.shape == (99, 2)
+    assert closes.loc["2023-06-10", eth.id].item() == 1752.3
+
+    # Newer candles are appended, older ones merged in
+    newer = _make_candles(doge, 2)
+    for i, candle in enumerate(newer):
+        candle.period_start = dt.datetime(2023, 7, 1 + i, tzinfo=dt.timezone.utc)
+    sync.upsert_dydx_candles(newer + _make_candles(doge, 3))
+    assert cache.refresh() == 5
+    # Candles written just before the last refresh are read again, without duplicates
+    assert cache.refresh() == 5
+
+    candles = cache.open(doge.id)
+    assert len(candles) == 104
+    assert np.all(np.diff(candles.period_start) > 0)
+    assert candles.period_start[0] == pd.Timestamp("2020-01-01", tz="UTC").value
+
+    # Candles updated in place are overwritten in their slots
+    latest = DydxCandle.objects.filter(instrument=doge).latest("period_start")
+    latest.close = latest.high = 5
+    sync.upsert_dydx_candles([latest])
+    cache.refresh()
+    candles = cache.open(doge.id)
+    assert len(candles) == 104
+    assert candles.close[-1] == 5
+    assert candles.close.tolist() == [
+        float(c.close)
+        for c in DydxCandle.objects.filter(instrument=doge).order_by("period_start")
+    ]
+
+
+def test_backtest_signals_match_evaluate_trade(load_data):
+    instruments = list(Instrument.objects.exclude(symbol="ETH"))
+    eth = Instrument.objects.get(symbol="ETH")
+    prices = load_backtest_prices(
+        instruments + [eth], dt.datetime(2023, 3, 11), dt.datetime(2023, 6, 18)
+    )
+    closes = prices.drop(columns="ETH").to_numpy()
+    signals = compute_signals(closes, prices["ETH"].to_numpy())
+    corr = rolling_correlation(closes, prices["ETH"].to_numpy(), 30)
+
+    # The signal of a candle is the decision right after it ends
+    for date in [
+        dt.datetime(2023, 4, 20),
+        dt.datetime(2023, 5, 28),
+        dt.datetime(2023, 6, 12),
+    ]:
+        row = prices.index.get_loc(pd.Timestamp(date, tz="UTC") - dt.timedelta(days=1))
+        for column, instr in enumerate(instruments):
+            expected = evaluate_trade(instr, eth, date)
+            assert signals[row, column] == expected["open_position"]
+            assert corr[row, column] == pytest.approx(expected["corr_30d"], nan_ok=True)
+
+
+def _make_universe(num_periods, num_instruments):
+    rng = np.random.default_rng(0)
+    index = pd.date_range("2020-01-01", periods=num_periods, freq="1D", tz="UTC")
+    base = pd.Series(
+        100 * np.exp(np.cumsum(rng.normal(0, 0.03, num_periods))), index=index
+    )
+    noise = rng.normal(0, 0.03, (num_periods, num_instruments))
+    closes = pd.DataFrame(
+        np.exp(np.log(base.to_numpy())[:, None] + np.cumsum(noise, axis=0)),
+        index=index,
+        columns=["I{}".format(i) for i in range(num_instruments)],
+    )
+    return closes, base
+
+
+def test_run_backtest():
+    closes, base = _make_universe(500, 20)
+    closes.iloc[100:110, 3] = np.nan
+
+    result = run_backtest(closes, base, take_profit=0.05, stop_loss=0.05)
+
+    trades = result.trades
+    assert result.num_trades > 0
+    expected_pnl = 100 * (1 - trades["exit_instr_price"] / trades["entry_instr_price"])
+    expected_pnl += 100 * (trades["exit_base_price"] / trades["entry_base_price"] - 1)
+    assert np.allclose(trades["pnl"], expected_pnl)
+    closed = trades[trades["exit_reason"] != "open"]
+    assert (closed[closed["exit_reason"] == "take_profit"]["pnl"] >= 10).all()
+    assert (closed[closed["exit_reason"] == "stop_loss"]["pnl"] <= -10).all()
+    for _, instr_trades in trades.groupby("instrument"):
+        assert (
+            instr_trades["entry_date"].iloc[1:].to_numpy()
+            > instr_trades["exit_date"].iloc[:-1].to_numpy()
+        ).all()
+    assert result.equity.iloc[-1] == pytest.approx(result.total_pnl)
+
+
+def test_run_backtest_short_history():
+    # Fewer periods than the correlation windows, so nothing is ever traded
+    closes, base = _make_universe(20, 5)
+
+    result = run_backtest(closes, base)
+
+    assert result.num_trades == 0
+    assert result.total_pnl == 0
+
+
+def test_backtest_command(load_data):
+    out = io.StringIO()
+    call_command(
+        "backtest", since=dt.date(2023, 3, 11), until=dt.date(2023, 6, 18), stdout=out
+    )
+    assert "num_trades: " in out.getvalue()
+
+    out = io.StringIO()
+    call_command(
+        "sweep_backtest",
+        since=dt.date(2023, 3, 11),
+        until=dt.date(2023, 6, 18),
+        min_corr=[0.4, 0.5],
+        workers=1,
+        stdout=out,
+    )
+    assert "total_pnl" in out.getvalue()
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        StrategyParams(min_corr=0.4),
+        StrategyParams(corr_window=14, inverse_corr_window=7, max_inverse_corr=0.5),
+    ],
+)
+def test_evaluate_trades_params(load_data, params):
+    instruments = list(Instrument.objects.all())
+    eth = Instrument.objects.get(symbol="ETH")
+    date = dt.datetime(2023, 6, 12)
+
+    results = evaluate_trades(instruments, eth, date, params)
+
+    for instr in instruments:
+        expected = evaluate_trade(instr, eth, date, params)
+        assert results[instr.symbol] == pytest.approx(expected, nan_ok=True)
+    assert results["DOGE"]["reason"] != "30 day correlation is too low"
+
+
+def test_run_sweep():
+    closes, base = _make_universe(300, 10)
+    grid = make_grid(min_corr=[0.3, 0.5], inverse_corr_window=[3, 4])
+
+    results = run_sweep(closes, base, grid, max_workers=2, stop_loss=0.1)
+
+    assert len(results) == 4
+    assert list(results.index) == [1, 2, 3, 4]
+    assert results["total_pnl"].is_monotonic_decreasing
+    best = results.iloc[0]
+    params = next(
+        p for p in grid if all(best[f] == getattr(p, f) for f in StrategyParams._fields)
+    )
+    expected = run_backtest(closes, base, params=params, stop_loss=0.1)
+    assert best["total_pnl"] == pytest.approx(expected.total_pnl)
+    assert best["num_trades"] == expected.num_trades
+
+    with pytest.raises(ValueError):
+        make_grid(min_correlation=[0.5])
+
+
+def test_get_trader_is_shared(monkeypatch):
+    calls = {"derive_stark_key": 0, "get_markets": 0}
+
+    class FakeClient:
+        def __init__(self, default_ethereum_address, **kwargs):
+            self.default_address = default_ethereum_address
+            self.stark_private_key = None
+            self.onboarding = self
+            self.public = self
+
+        def derive_stark_key(self):
+            calls["derive_stark_key"] += 1
+            return {"private_key": "0x123"}
+
+        def get_markets(self):
+            calls["get_markets"] += 1
+            return type("Response", (), {"data": {"markets": {}}})
+
+    monkeypatch.setattr(dydx_trader, "Client", FakeClient)
+    monkeypatch.setenv("ETH_PRIVATE_KEY", "0x1")
+    monkeypatch.setenv("ETH_PUBLIC_KEY", "0xshared")
+    monkeypatch.setenv("WEB3_PROVIDER_URL", "http://localhost")
+    dydx_trader.reset_trader()
+
+    trader = dydx_trader.get_trader()
+    assert dydx_trader.get_trader() is trader
+    assert calls == {"derive_stark_key": 0, "get_markets": 0}
+
+    trader.warm_up()
+    trader.warm_up()
+    assert trader.client.stark_private_key == "0x123"
+    assert calls == {"derive_stark_key": 1, "get_markets": 1}
+
+    trader.refresh()
+    assert calls["get_markets"] == 2
+
+    # The STARK key outlives the trader
+    dydx_trader.reset_trader()
+    dydx_trader.get_trader().warm_up()
+    assert dydx_trader.get_trader() is not trader
+    assert calls == {"derive_stark_key": 1, "get_markets": 3}
+    dydx_trader.reset_trader()
+
+
+def test_market_cache():
+    loaded = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(time.monotonic())
+        loaded.set()
+        return {
+            "markets": {
+                "DOGE-USD": {
+                    "tickSize": "0.00001",
+                    "stepSize": "10",
+                    "indexPrice": "0.061234567",
+                },
+                "ETH-USD": {
+                    "tickSize": "0.1",
+                    "stepSize": "0.001",
+                    "indexPrice": "1752.37",
+                },
+                "BTC-USD": {
+                    "tickSize": "1",
+                    "stepSize": "1E-4",
+                    "indexPrice": "26000.5",
+                },
+            }
+        }
+
+    cache = MarketCache(load, ttl=0.05)
+    snapshot = cache.get()
+    assert cache.get() is snapshot
+    assert len(calls) == 1
+
+    precision = snapshot.precision
+    assert (
+        str(round_to_increment(0.061234567, precision["DOGE-USD"].tick_size))
+        == "0.06123"
+    )
+    assert round_to_increment(1234.0, precision["DOGE-USD"].step_size) == 1230
+    assert float(round_to_increment(1752.37, precision["ETH-USD"].tick_size)) == 1752.4
+    assert float(round_to_increment(0.12345, precision["BTC-USD"].step_size)) == 0.1234
+
+    # Once stale, the old snapshot is returned while the new one downloads
+    loaded.clear()
+    time.sleep(0.06)
+    assert cache.get() is snapshot
+    assert loaded.wait(5)
+    for _ in range(100):
+        if cache.get() is not snapshot:
+            break
+        time.sleep(0.01)
+    assert len(calls) == 2
+    assert cache.get() is not snapshot
+
+
+@pytest.fixture
+def fake_orders_server():
+    """
+    Serves /v3/orders/<id> locally. An order is PENDING for its first `pending_polls`
+    polls, then takes the status in `final_status`.
+    """
+    state = {"pending_polls": 3, "final_status": {}, "polls": {}}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            order_id = urlparse(self.path).path.split("/")[-1]
+            with lock:
+                state["polls"][order_id] = state["polls"].get(order_id, 0) + 1
+                polls = state["polls"][order_id]
+            status = "PENDING"
+            if polls > state["pending_polls"]:
+                status = state["final_status"].get(order_id, "FILLED")
+
+            body = json.dumps({"order": {"id": order_id, "status": status}}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state["host"] = "http://127.0.0.1:{}".format(server.server_port)
+    yield state
+    server.shutdown()
+
+
+def test_order_tracker(fake_orders_server):
+    client = DydxClient(
+        host=fake_orders_server["host"],
+        api_key_credentials={"key": "key", "secret": "c2VjcmV0", "passphrase": "pass"},
+    )
+    tracker = OrderTracker(
+        lambda order_id: client.private.get_order_by_id(order_id).data["order"],
+        initial_delay=0.01,
+    )
+    fake_orders_server["final_status"]["2"] = "CANCELED"
+
+    start_time = time.monotonic()
+    orders = tracker.wait_all(["1", "2"])
+    assert time.monotonic() - start_time < 1
+    assert orders["1"]["status"] == "FILLED"
+    assert orders["2"]["status"] == "CANCELED"
+    assert fake_orders_server["polls"] == {"1": 4, "2": 4}
+
+    # Polls back off exponentially up to max_delay
+    delays = []
+    tracker = OrderTracker(
+        lambda order_id: client.private.get_order_by_id(order_id).data["order"],
+        initial_delay=0.1,
+        max_delay=0.3,
+        sleep=delays.append,
+    )
+    fake_orders_server["pending_polls"] = 1000
+    with pytest.raises(TimeoutError):
+        tracker.wait("3", timeout_seconds=0.5)
+    assert delays[:4] == [0.1, 0.2, 0.3, 0.3]
+
+
+class FakePairTrader:
+    """
+    Acknowledges orders after `latency` seconds. Orders of the markets in `reject` are
+    rejected, and the ones in `cancel` are canceled instead of filled, after filling
+    `partial_fill` of their size.
+    """
+
+    def __init__(self, latency=0.05, reject=(), cancel=(), partial_fill=0):
+        self.latency = latency
+        self.reject = reject
+        self.cancel = cancel
+        self.partial_fill = partial_fill
+        self.orders = {}
+        self.markets = {
+            "markets": {
+                "DOGE-USD": {"indexPrice": "0.0617"},
+                "ETH-USD": {"indexPrice": "1752.3"},
+            }
+        }
+        self.order_tracker = self
+
+    def get_position_id(self):
+        return "1"
+
+    def get_price(self, market):
+        return float(self.markets["markets"][market]["indexPrice"])
+
+    def prepare_order(
+        self,
+        market,
+        side,
+        price,
+        size,
+        position_id=None,
+        reduce_only=False,
+        time_in_force="GTT",
+    ):
+        return {
+            "market": market,
+            "side": side,
+            "price": price,
+            "size": str(size),
+            "reduce_only": reduce_only,
+            "time_in_force": time_in_force,
+        }
+
+    def submit_order(self, order_params):
+        time.sleep(self.latency)
+        if order_params["market"] in self.reject:
+            raise RuntimeError("Rejected")
+        order = {**order_params, "id": str(len(self.orders)), "status": "PENDING"}
+        self.orders[order["id"]] = order
+        return {"order_params": order_params, "order_data": {"order": dict(order)}}
+
+    def short(self, market, price, size):
+        return self.submit_order(self.prepare_order(market, "SELL", price, size))
+
+    def long(self, market, price, size):
+        return self.submit_order(self.prepare_order(market, "BUY", price, size))
+
+    def cancel_order(self, order_id):
+        order = self.orders[order_id]
+        if order["status"] == "PENDING":
+            order["status"] = "CANCELED"
+            order["remainingSize"] = order["size"]
+
+    def wait_for_order(self, order_id):
+        order = self.orders[order_id]
+        if order["status"] == "PENDING":
+            order["status"] = "CANCELED" if order["market"] in self.cancel else "FILLED"
+            order["remainingSize"] = (
+                str(float(order["size"]) * (1 - self.partial_fill))
+                if order["status"] == "CANCELED"
+                else "0"
+            )
+        return order
+
+    def wait_all(self, order_ids):
+        return {order_id: self.wait_for_order(order_id) for order_id in order_ids}
+
+
+@pytest.mark.parametrize("execution", ["sequential", "concurrent"])
+def test_open_position(load_data, monkeypatch, settings, execution):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    trader = FakePairTrader(latency=0.1)
+    monkeypatch.setattr(positions, "get_trader", lambda: trader)
+    settings.PAIR_TRADE_EXECUTION = execution
+
+    pos = positions.open_position(doge, eth)
+
+    assert pos.extra_data["execution"] == execution
+    if execution == "sequential":
+        assert pos.extra_data["hedged"]
+    assert pos.extra_data["short"]["final_status"] == "FILLED"
+    assert pos.extra_data["long"]["final_status"] == "FILLED"
+    if execution == "concurrent":
+        # Both orders are in flight at the same time
+        assert pos.extra_data["leg_latency_seconds"] < 0.05
+    else:
+        assert pos.extra_data["leg_latency_seconds"] >= 0.1
+
+
+@pytest.mark.parametrize("failure", ["reject", "cancel"])
+def test_open_position_concurrently_compensates(load_data, monkeypatch, failure):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    trader = FakePairTrader(latency=0, **{failure: ["ETH-USD"]})
+    monkeypatch.setattr(positions, "get_trader", lambda: trader)
+
+    with pytest.raises(positions.LegFailedError):
+        positions.open_position_concurrently(doge, eth)
+
+    assert not Position.objects.exists()
+    compensations = [o for o in trader.orders.values() if o["reduce_only"]]
+    short = next(o for o in trader.orders.values() if o["side"] == "SELL")
+    if failure == "reject":
+        # The short was canceled before it filled, so there's nothing to compensate
+        assert short["status"] == "CANCELED"
+        assert compensations == []
+    else:
+        assert short["status"] == "FILLED"
+        assert len(compensations) == 1
+        assert compensations[0]["market"] == "DOGE-USD"
+        assert compensations[0]["side"] == "BUY"
+        assert float(compensations[0]["size"]) == float(short["size"])
+        assert compensations[0]["status"] == "FILLED"
+
+
+def test_open_position_compensates_partially_filled_short(load_data, monkeypatch):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    trader = FakePairTrader(latency=0, cancel=["DOGE-USD"], partial_fill=0.5)
+    monkeypatch.setattr(positions, "get_trader", lambda: trader)
+
+    with pytest.raises(positions.OrderNotFilledError):
+        positions.open_position(doge, eth)
+
+    assert not Position.objects.exists()
+    # The filled half of the short is bought back, and the base is never longed
+    short, compensation = trader.orders.values()
+    assert short["status"] == "CANCELED"
+    assert compensation["reduce_only"]
+    assert compensation["market"] == "DOGE-USD"
+    assert compensation["side"] == "BUY"
+    assert float(compensation["size"]) == pytest.approx(float(short["size"]) / 2)
+
+
+class TimeoutPairTrader(FakePairTrader):
+    """Times out waiting for the pending orders of the markets in `timeout`"""
+
+    def __init__(self, timeout=(), **kwargs):
+        super().__init__(**kwargs)
+        self.timeout = timeout
+
+    def wait_for_order(self, order_id):
+        order = self.orders[order_id]
+        if order["market"] in self.timeout and order["status"] == "PENDING":
+            raise TimeoutError("Timed out waiting for order {}".format(order_id))
+        return super().wait_for_order(order_id)
+
+
+@pytest.mark.parametrize("failure", ["cancel", "timeout"])
+def test_open_position_unwinds_failed_long(load_data, monkeypatch, failure):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    if failure == "cancel":
+        trader = FakePairTrader(latency=0, cancel=["ETH-USD"], partial_fill=0.5)
+    else:
+        trader = TimeoutPairTrader(latency=0, timeout=["ETH-USD"])
+    monkeypatch.setattr(positions, "get_trader", lambda: trader)
+
+    with pytest.raises(
+        positions.LegFailedError if failure == "cancel" else TimeoutError
+    ):
+        positions.open_position(doge, eth)
+
+    assert not Position.objects.exists()
+    short, long, *compensations = trader.orders.values()
+    assert short["status"] == "FILLED"
+    assert long["status"] == "CANCELED"
+    compensated = {
+        order["market"]: (order["side"], float(order["size"]))
+        for order in compensations
+    }
+    assert all(order["reduce_only"] for order in compensations)
+    assert compensated.pop("DOGE-USD") == ("BUY", float(short["size"]))
+    if failure == "cancel":
+        # The filled half of the long is sold again
+        assert compensated == {
+            "ETH-USD": ("SELL", pytest.approx(float(long["size"]) / 2))
+        }
+    else:
+        # The long was canceled before anything filled
+        assert compensated == {}
+
+
+def test_open_position_records_unhedged_short(load_data, monkeypatch):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    trader = FakePairTrader(latency=0, cancel=["ETH-USD"])
+    monkeypatch.setattr(positions, "get_trader", lambda: trader)
+
+    def fail(trader, order):
+        raise RuntimeError("Rejected")
+
+    monkeypatch.setattr(positions, "_compensate", fail)
+
+    with pytest.raises(RuntimeError):
+        positions.open_position(doge, eth)
+
+    # The short couldn't be closed, so it is tracked
+    pos = Position.objects.get()
+    assert pos.extra_data["hedged"] is False
+    assert pos.extra_data["short"]["final_status"] == "FILLED"
+    assert pos.extra_data["long"]["final_status"] == "CANCELED"
+
+
+def test_account_snapshot(monkeypatch, settings):
+    state = {"position_id": "1", "get_account": 0, "orders": []}
+
+    class FakeClient:
+        network_id = 1
+
+        def __init__(self, default_ethereum_address, **kwargs):
+            self.default_address = default_ethereum_address
+            self.stark_private_key = "0x" + "1" * 60
+            self.public = self
+            self.private = self
+
+        def get_markets(self):
+            markets = {"ETH-USD": {"tickSize": "0.1", "stepSize": "0.001"}}
+            return type("Response", (), {"data": {"markets": markets}})
+
+        def get_account(self):
+            state["get_account"] += 1
+            account = {
+                "positionId": state["position_id"],
+                "equity": "1000.5",
+                "freeCollateral": "800",
+                "openPositions": {"ETH-USD": {"size": "0.1"}},
+            }
+            return type("Response", (), {"data": {"account": account}})
+
+        def create_order(self, **order_params):
+            if order_params["position_id"] != state["position_id"]:
+                response = type(
+                    "Response", (), {"status_code": 400, "json": lambda self: {}}
+                )()
+                raise DydxApiError(response)
+            state["orders"].append(order_params)
+            return type("Response", (), {"data": {"order": {"id": "1"}}})
+
+    monkeypatch.setattr(dydx_trader, "Client", FakeClient)
+    monkeypatch.setenv("ETH_PRIVATE_KEY", "0x1")
+    monkeypatch.setenv("ETH_PUBLIC_KEY", "0xaccount")
+    monkeypatch.setenv("WEB3_PROVIDER_URL", "http://localhost")
+    trader = dydx_trader.DydxTrader()
+
+    snapshot = trader.get_account_snapshot()
+    assert snapshot.position_id == "1"
+    assert snapshot.equity == 1000.5
+    assert snapshot.free_collateral == 800
+    assert snapshot.open_positions == {"ETH-USD": {"size": "0.1"}}
+    assert trader.get_position_id() == "1"
+    assert state["get_account"] == 1
+    trader.get_account_snapshot(max_age=0)
+    assert state["get_account"] == 2
+
+    # An order rejected because of a stale position id is signed again and resubmitted
+    order_params = trader.prepare_order("ETH-USD", "BUY", 1752.34, 0.0571)
+    state["position_id"] = "2"
+    res = trader.submit_order(order_params)
+    assert state["get_account"] == 3
+    assert res["order_params"]["position_id"] == "2"
+    assert res["order_params"]["price"] == "1752.3"
+    assert res["order_params"]["size"] == "0.057"
+    assert res["order_params"]["signature"] != order_params["signature"]
+    assert state["orders"] == [res["order_params"]]
+
+
+@pytest.fixture
+def fake_dydx(monkeypatch, settings):
+    """A local fake dydx exchange that the trader talks to"""
+    eth_private_key = "0x" + "11" * 32
+    with FakeDydxExchange(assets=["ETH", "DOGE", "BTC", "SOL"]) as exchange:
+        settings.DYDX_API_HOST = exchange.host
+        monkeypatch.setenv("ETH_PRIVATE_KEY", eth_private_key)
+        monkeypatch.setenv("ETH_PUBLIC_KEY", Account.from_key(eth_private_key).address)
+        monkeypatch.setenv("WEB3_PROVIDER_URL", exchange.host)
+        monkeypatch.setenv("STARK_PRIVATE_KEY", "0x" + "1" * 60)
+        monkeypatch.setenv("DYDX_API_KEY", "key")
+        monkeypatch.setenv("DYDX_API_SECRET", "c2VjcmV0")
+        monkeypatch.setenv("DYDX_API_PASSPHRASE", "passphrase")
+        dydx_trader.reset_trader()
+        yield exchange
+        dydx_trader.reset_trader()
+
+
+def test_fake_dydx_sync(load_data, fake_dydx):
+    sync.sync_dydx_instruments()
+    sol = Instrument.objects.get(symbol="SOL")
+    assert sol.dydx_market_id == "SOL-USD"
+
+    sync.sync_dydx_candles()
+    history = SyncHistory.objects.get(sync_type="dydx_candles")
+    fake_markets = set(fake_dydx.markets)
+    missing_markets = set(
+        Instrument.objects.exclude(dydx_market_id="")
+        .exclude(dydx_market_id__in=fake_markets)
+        .values_list("dydx_market_id", flat=True)
+    )
+    assert set(history.extra_data["failed_markets"]) == missing_markets
+    assert DydxCandle.objects.filter(instrument=sol).count() == 99
+    assert (
+        fake_dydx.requests["GET /v3/candles"]
+        == Instrument.objects.exclude(dydx_market_id="").count()
+    )
+
+
+@pytest.mark.parametrize("execution", ["sequential", "concurrent"])
+def test_fake_dydx_open_position(load_data, fake_dydx, settings, execution):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    settings.PAIR_TRADE_EXECUTION = execution
+    fake_dydx.fill_delay = 0.2
+
+    pos = positions.open_position(doge, eth)
+
+    assert pos.extra_data["short"]["final_status"] == "FILLED"
+    assert pos.extra_data["long"]["final_status"] == "FILLED"
+    doge_size = float(fake_dydx.open_positions["DOGE-USD"]["size"])
+    eth_size = float(fake_dydx.open_positions["ETH-USD"]["size"])
+    assert doge_size * fake_dydx.price("DOGE-USD", pos.date_opened) == pytest.approx(
+        -100, rel=0.1
+    )
+    assert eth_size * fake_dydx.price("ETH-USD", pos.date_opened) == pytest.approx(
+        100, rel=0.1
+    )
+
+
+def test_fake_dydx_compensates_rejected_leg(load_data, fake_dydx):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    fake_dydx.reject_markets = {"ETH-USD"}
+
+    with pytest.raises(positions.LegFailedError):
+        positions.open_position_concurrently(doge, eth)
+
+    assert not Position.objects.exists()
+    assert float(fake_dydx.open_positions.get("DOGE-USD", {"size": 0})["size"]) == 0
+    assert "ETH-USD" not in fake_dydx.open_positions
+
+
+def test_compensation_order_params(load_data, fake_dydx, monkeypatch):
+    fake_dydx.fill_delay = 0
+    trader = dydx_trader.get_trader()
+    short = trader.short("DOGE-USD", trader.get_price("DOGE-USD"), 1000)
+    short_order = trader.wait_for_order(short["order_data"]["order"]["id"])
+
+    created = []
+    create_order = trader.client.private.create_order
+
+    def record_create_order(**order_params):
+        created.append(order_params)
+        return create_order(**order_params)
+
+    monkeypatch.setattr(trader.client.private, "create_order", record_create_order)
+    compensation = positions._compensate(trader, short_order)
+
+    assert len(created) == 1
+    assert created[0]["market"] == "DOGE-USD"
+    assert created[0]["side"] == "BUY"
+    assert float(created[0]["size"]) == float(short_order["size"])
+    # dydx rejects reduce only orders that could rest on the book
+    assert created[0]["reduce_only"] is True
+    assert created[0]["time_in_force"] == "IOC"
+    index_price = float(trader.markets["markets"]["DOGE-USD"]["indexPrice"])
+    assert float(created[0]["price"]) >= index_price
+    assert compensation["status"] == "FILLED"
+    assert float(fake_dydx.open_positions["DOGE-USD"]["size"]) == 0
+
+
+def test_live_price_cache():
+    live = LivePriceCache(["1MIN", "5MINS"])
+    start = dt.datetime(2023, 6, 1, 12, 0, tzinfo=dt.timezone.utc)
+    live.start_observing(start)
+    for seconds, price in [(10, 5), (20, 7), (30, 4), (50, 6), (70, 8), (400, 9)]:
+        live.add_trade("DOGE-USD", price, start + dt.timedelta(seconds=seconds))
+
+    assert live.get_price("DOGE-USD", max_age=60) == 9
+    live.set_index_price("DOGE-USD", 8.5)
+    assert live.get_price("DOGE-USD", max_age=60) == 8.5
+    assert live.get_price("BTC-USD", max_age=60) is None
+
+    bars = live.pop_completed_bars(start + dt.timedelta(minutes=6))
+    minute_bars = [bar for bar in bars if bar.resolution == "1MIN"]
+    assert [
+        (bar.period_start, bar.open, bar.high, bar.low, bar.close)
+        for bar in minute_bars
+    ] == [
+        (start, 5, 7, 4, 6),
+        (start + dt.timedelta(minutes=1), 8, 8, 8, 8),
+    ]
+    five_minute_bars = [bar for bar in bars if bar.resolution == "5MINS"]
+    assert [(bar.open, bar.high, bar.low, bar.close) for bar in five_minute_bars] == [
+        (5, 8, 4, 8)
+    ]
+    # The bar of the current period stays until its period ends
+    assert live.current_bar("DOGE-USD", "1MIN").close == 9
+    assert live.pop_completed_bars(start + dt.timedelta(minutes=6)) == []
+    assert len(live.pop_completed_bars(start + dt.timedelta(minutes=7))) == 1
+
+
+def test_live_price_cache_partial_periods():
+    live = LivePriceCache(["1MIN"])
+    start = dt.datetime(2023, 6, 1, 12, 0, tzinfo=dt.timezone.utc)
+    # Not connected yet
+    live.add_trade("DOGE-USD", 1, start)
+    # Connected in the middle of the first minute, which has no bar then
+    live.start_observing(start + dt.timedelta(seconds=30))
+    for seconds, price in [(40, 2), (70, 3)]:
+        live.add_trade("DOGE-USD", price, start + dt.timedelta(seconds=seconds))
+    # Disconnected in the middle of the second minute
+    live.stop_observing()
+    live.add_trade("DOGE-USD", 4, start + dt.timedelta(seconds=80))
+
+    assert live.get_price("DOGE-USD", max_age=60) == 4
+    assert live.pop_completed_bars(start + dt.timedelta(minutes=5)) == []
+
+
+def test_live_price_cache_shared(settings):
+    live_prices.set_index_price("DOGE-USD", 0.07)
+    live_prices.publish(timeout=60)
+    live_prices.clear()
+    # As seen by another process
+    assert get_live_price("DOGE-USD") == 0.07
+    settings.LIVE_PRICE_MAX_AGE_SECONDS = 0
+    assert get_live_price("DOGE-USD") is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_market_data_worker(load_data, fake_dydx):
+    doge = Instrument.objects.get(symbol="DOGE")
+    eth = Instrument.objects.get(symbol="ETH")
+    worker = MarketDataWorker(
+        "",
+        {"DOGE-USD": doge.id, "ETH-USD": eth.id},
+        flush_interval=60,
+    )
+
+    async def ingest():
+        stop = asyncio.Event()
+        task = asyncio.create_task(worker.run(stop))
+        while worker.num_messages < 20:
+            await asyncio.sleep(0.05)
+        stop.set()
+        await task
+
+    with FakeDydxWebsocket(fake_dydx, interval=0.02) as websocket:
+        worker.url = websocket.url
+        asyncio.run(asyncio.wait_for(ingest(), 10))
+
+    now = dt.datetime.now(dt.timezone.utc)
+    assert worker.num_connections == 1
+    assert live_prices.get_price("DOGE-USD", max_age=60) == pytest.approx(
+        fake_dydx.price("DOGE-USD", now), rel=1e-3
+    )
+    # The bars of the periods the connection started in were partial, and the ones
+    # being built were dropped on disconnect
+    assert live_prices.current_bar("DOGE-USD", "1MIN") is None
+    assert not DydxCandle.objects.filter(resolution="1MIN")
+
+    live_prices.set_index_price("DOGE-USD", 0.0712345)
+    assert dydx_trader.get_trader().get_price("DOGE-USD") == pytest.approx(
+        0.0712345, abs=float(fake_dydx.price("DOGE-USD", now)) * 1e-4
+    )
+    assert fetch_closes([(doge, now), (doge, dt.datetime(2023, 6, 11))]) == [
+        0.0712345,
+        fetch_close(doge, dt.datetime(2023, 6, 11)),
+    ]
+
+    # Bars of whole periods are written, without overwriting existing candles
+    start = dt.datetime(2023, 6, 1, 12, 0, tzinfo=dt.timezone.utc)
+    DydxCandle.objects.create(
+        instrument=eth,
+        resolution="1MIN",
+        period_start=start,
+        period_end=start + dt.timedelta(minutes=1),
+        open=1,
+        high=1,
+        low=1,
+        close=1,
+    )
+    live_prices.start_observing(start)
+    for market in ["DOGE-USD", "ETH-USD"]:
+        for seconds, price in [(10, 2), (20, 3)]:
+            live_prices.add_trade(market, price, start + dt.timedelta(seconds=seconds))
+    assert worker.flush(start + dt.timedelta(minutes=1)) == 2
+    candle = DydxCandle.objects.get(instrument=doge, resolution="1MIN")
+    assert candle.period_end - candle.period_start == dt.timedelta(minutes=1)
+    assert (candle.open, candle.high, candle.low, candle.close) == (2, 3, 2, 3)
+    assert DydxCandle.objects.get(instrument=eth, resolution="1MIN").close == 1
+
+
+def test_rollup_dydx_candles(load_data, django_capture_on_commit_callbacks):
+    doge = Instrument.objects.get(symbol="DOGE")
+    start = dt.datetime(2023, 7, 1, tzinfo=dt.timezone.utc)
+    hour = dt.timedelta(hours=1)
+    # Two full days and half of a third
+    DydxCandle.objects.bulk_create(
+        DydxCandle(
+            instrument=doge,
+            resolution="1HOUR",
+            period_start=start + i * hour,
+            period_end=start + (i + 1) * hour - dt.timedelta(seconds=1),
+            open=i - 0.5,
+            high=i + 1,
+            low=i - 1,
+            close=i,
+        )
+        for i in range(60)
+    )
+    num_daily = DydxCandle.objects.filter(resolution="1DAY").count()
+    price_store.get(doge.id, "1DAY")
+
+    with django_capture_on_commit_callbacks(execute=True):
+        num_written = rollup_dydx_candles(
+            "1HOUR", "1DAY", start + 5 * hour, start + 3 * 24 * hour, [doge]
+        )
+
+    assert num_written == 2
+    rolled_up = DydxCandle.objects.filter(
+        instrument=doge, resolution="1DAY", period_start__gte=start
+    ).order_by("period_start")
+    assert [
+        (c.period_start, c.period_end, c.open, c.high, c.low, c.close)
+        for c in rolled_up
+    ] == [
+        (start, start + 24 * hour - dt.timedelta(seconds=1), -0.5, 24, -1, 23),
+        (
+            start + 24 * hour,
+            start + 48 * hour - dt.timedelta(seconds=1),
+            23.5,
+            48,
+            23,
+            47,
+        ),
+    ]
+    assert DydxCandle.objects.filter(resolution="1DAY").count() == num_daily + 2
+    # The cached daily series sees the new candles
+    assert price_store.get(doge.id, "1DAY").closes[-1] == 47
+
+    # Running again updates the candles in place
+    DydxCandle.objects.filter(
+        instrument=doge, resolution="1HOUR", period_start=start + 47 * hour
+    ).update(close=100)
+    assert rollup_dydx_candles("1HOUR", "1DAY", start, start + 3 * 24 * hour) == 2
+    assert DydxCandle.objects.filter(resolution="1DAY").count() == num_daily + 2
+    assert rolled_up.last().close == 100
+
+
+def test_get_rollup_order():
+    assert get_rollup_order({"1DAY": "1HOUR", "5MINS": "1MIN", "1HOUR": "5MINS"}) == [
+        ("5MINS", "1MIN"),
+        ("1HOUR", "5MINS"),
+        ("1DAY", "1HOUR"),
+    ]
+    with pytest.raises(ValueError):
+        get_rollup_order({"1HOUR": "1DAY"})
+
+
+def test_prune_dydx_candles(load_data, settings, django_capture_on_commit_callbacks):
+    settings.DYDX_CANDLE_ROLLUPS = {"1DAY": "1HOUR"}
+    doge = Instrument.objects.get(symbol="DOGE")
+    start = dt.datetime(2023, 7, 1, tzinfo=dt.timezone.utc)
+    hour = dt.timedelta(hours=1)
+    DydxCandle.objects.bulk_create(
+        DydxCandle(
+            instrument=doge,
+            resolution="1HOUR",
+            period_start=start + i * hour,
+            period_end=start + (i + 1) * hour - dt.timedelta(seconds=1),
+            open=i,
+            high=i,
+            low=i,
+            close=i,
+        )
+        for i in range(60)
+        # The second day misses an hour
+        if i != 30
+    )
+    # A daily candle synced from dydx
+    DydxCandle.objects.create(
+        instrument=doge,
+        resolution="1DAY",
+        period_start=start,
+        period_end=start + 24 * hour,
+        open=1,
+        high=1,
+        low=1,
+        close=1,
+    )
+    price_store.get(doge.id, "1HOUR")
+
+    # 30 days after the last hour, so the cutoff is floored to the third day
+    now = start + 60 * hour + dt.timedelta(days=30)
+    with CaptureQueriesContext(connection) as queries:
+        with django_capture_on_commit_callbacks(execute=True):
+            num_deleted = retention.prune_dydx_candles("1HOUR", 30, now, chunk_size=10)
+
+    assert num_deleted == 47
+    assert [
+        c.period_start
+        for c in DydxCandle.objects.filter(instrument=doge, resolution="1HOUR")
+    ] == [start + i * hour for i in range(48, 60)]
+    # Deleted in chunks
+    deletes = [q for q in queries if q["sql"].startswith("DELETE")]
+    assert len(deletes) == 5
+    # The synced day is kept, and the incomplete one is still downsampled
+    assert [
+        (c.period_start, c.close)
+        for c in DydxCandle.objects.filter(
+            instrument=doge, resolution="1DAY", period_start__gte=start
+        ).order_by("period_start")
+    ] == [(start, 1), (start + 24 * hour, 47)]
+    assert list(price_store.get(doge.id, "1HOUR").closes) == list(range(48, 60))
+
+    # Nothing is left to prune
+    assert retention.prune_dydx_candles("1HOUR", 30, now) == 0
+
+
+def test_apply_retention(load_data, settings):
+    settings.DYDX_CANDLE_RETENTION_DAYS = {"1DAY": 365}
+    settings.COINGECKO_OHLC_RETENTION_DAYS = 30
+    settings.SYNC_HISTORY_RETENTION_DAYS = 7
+    now = timezone.now()
+    doge = Instrument.objects.get(symbol="DOGE")
+    CoingeckoInstrumentOHLC.objects.bulk_create(
+        CoingeckoInstrumentOHLC(
+            instrument=doge,
+            date=now - dt.timedelta(days=days),
+            open=1,
+            high=1,
+            low=1,
+            close=1,
+        )
+        for days in (1, 29, 31, 60)
+    )
+    SyncHistory.objects.bulk_create(
+        SyncHistory(date=now - dt.timedelta(days=days), records_synced=1)
+        for days in (1, 8)
+    )
+    cutoff = now - dt.timedelta(days=365)
+    num_old_candles = DydxCandle.objects.filter(
+        resolution="1DAY", period_start__lt=cutoff
+    ).count()
+    num_old_history = SyncHistory.objects.filter(
+        date__lt=now - dt.timedelta(days=7)
+    ).count()
+    num_old_ohlc = CoingeckoInstrumentOHLC.objects.filter(
+        date__lt=now - dt.timedelta(days=30)
+    ).count()
+
+    num_deleted = retention.apply_retention(now)
+
+    assert num_deleted == {
+        "1DAY": num_old_candles,
+        "coingecko_ohlc": num_old_ohlc,
+        "sync_history": num_old_history,
+    }
+    assert not DydxCandle.objects.filter(resolution="1DAY", period_start__lt=cutoff)
+    assert CoingeckoInstrumentOHLC.objects.filter(instrument=doge).count() == 2
+    history = SyncHistory.objects.get(sync_type="retention")
+    assert history.records_synced == sum(num_deleted.values())
+    assert history.extra_data == {"deleted": num_deleted}
+
+
+def test_evaluate_trades_resolution(load_data):
+    eth = Instrument.objects.get(symbol="ETH")
+    instruments = list(Instrument.objects.exclude(symbol="ETH"))
+    date = dt.datetime(2023, 6, 12)
+    daily = evaluate_trades(instruments, eth, date)
+
+    # Hourly candles over the last few days, which the daily strategy ignores
+    rng = np.random.default_rng(0)
+    start = timezone.make_aware(date) - dt.timedelta(days=3)
+    DydxCandle.objects.bulk_create(
+        DydxCandle(
+            instrument=instrument,
+            resolution="1HOUR",
+            period_start=start + dt.timedelta(hours=i),
+            period_end=start + dt.timedelta(hours=i + 1),
+            open=1,
+            high=1,
+            low=1,
+            close=float(rng.uniform(1, 2)),
+        )
+        for instrument in [*instruments, eth]
+        for i in range(72)
+    )
+    again = evaluate_trades(instruments, eth, date)
+    for instr in instruments:
+        assert again[instr.symbol] == pytest.approx(daily[instr.symbol], nan_ok=True)
+
+    params = StrategyParams(corr_window=48, inverse_corr_window=6, resolution="1HOUR")
+    hourly = evaluate_trades(instruments, eth, date, params)
+    for instr in instruments:
+        expected = evaluate_trade(instr, eth, date, params)
+        assert hourly[instr.symbol] == pytest.approx(expected, nan_ok=True)
+        assert not np.isnan(hourly[instr.symbol]["corr_30d"])
+
+
+def test_fake_dydx_sync_rollups(load_data, fake_dydx, settings):
+    settings.DYDX_CANDLE_RESOLUTIONS = ["1HOUR"]
+    settings.DYDX_CANDLE_ROLLUPS = {"4HOURS": "1HOUR", "1DAY": "4HOURS"}
+    doge = Instrument.objects.get(symbol="DOGE")
+
+    sync.sync_all_dydx_candles()
+
+    hourly = DydxCandle.objects.filter(instrument=doge, resolution="1HOUR")
+    assert hourly.count() == 99
+    assert fake_dydx.requests["GET /v3/candles"] == len(
+        Instrument.objects.exclude(dydx_market_id="")
+    )
+    four_hourly = DydxCandle.objects.filter(instrument=doge, resolution="4HOURS")
+    # Only the periods with all their hourly candles
+    assert 23 <= four_hourly.count() <= 24
+    recent_daily = DydxCandle.objects.filter(
+        instrument=doge,
+        resolution="1DAY",
+        period_start__gte=timezone.now() - dt.timedelta(days=5),
+    )
+    assert 3 <= recent_daily.count() <= 4
+    candle = four_hourly.order_by("period_start").last()
+    hours = hourly.filter(
+        period_start__gte=candle.period_start,
+        period_start__lt=candle.period_start + dt.timedelta(hours=4),
+    ).order_by("period_start")
+    assert candle.close == hours.last().close
+    assert candle.high == max(hour.high for hour in hours)
+
+
+# Query plans and counts of the hot paths, against enough rows that a missing index
+# or a query per row shows
+
+
+@pytest.fixture
+def large_dataset(db):
+    instruments = Instrument.objects.bulk_create(
+        Instrument(
+            symbol="I{}".format(i),
+            name="I{}".format(i),
+            dydx_market_id="I{}-USD".format(i),
+        )
+        for i in range(20)
+    )
+    start = dt.datetime(2020, 1, 1, tzinfo=dt.timezone.utc)
+    rng = np.random.default_rng(0)
+    for resolution, delta in [
+        ("1DAY", dt.timedelta(days=1)),
+        ("1HOUR", dt.timedelta(hours=1)),
+    ]:
+        DydxCandle.objects.bulk_create(
+            (
+                DydxCandle(
+                    instrument=instrument,
+                    resolution=resolution,
+                    period_start=start + i * delta,
+                    period_end=start + (i + 1) * delta,
+                    open=1,
+                    high=1,
+                    low=1,
+                    close=float(rng.uniform(1, 2)),
+                )
+                for instrument in instruments
+                for i in range(300)
+            ),
+            batch_size=5000,
+        )
+    CoingeckoInstrumentOHLC.objects.bulk_create(
+        (
+            CoingeckoInstrumentOHLC(
+                instrument=instrument,
+                date=start + i * dt.timedelta(hours=4),
+                open=1,
+                high=1,
+                low=1,
+                close=1,
+            )
+            for instrument in instruments
+            for i in range(300)
+        ),
+        batch_size=5000,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    return instruments
+
+
+def _explain(sql: str) -> str:
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            return "\n".join(row[-1] for row in cursor.fetchall())
+        cursor.execute("EXPLAIN " + sql)
+        return "\n".join(row[0] for row in cursor.fetchall())
+
+
+def _assert_no_full_scans(queries: list[dict], tables: list[str]) -> list[str]:
+    """Fails if any of the queries reads a whole table, and returns their plans"""
+    plans = []
+    for query in queries:
+        if not query["sql"].startswith("SELECT"):
+            continue
+        plan = _explain(query["sql"])
+        plans.append(plan)
+        for table in tables:
+            assert not re.search(
+                r"(\bSCAN {0}\b|Seq Scan on {0}\b)".format(table), plan
+            ), "Full scan of {} in\n{}\n{}".format(table, query["sql"], plan)
+    return plans
+
+
+CANDLE_TABLES = ["api_dydxcandle", "api_coingeckoinstrumentohlc"]
+
+
+def test_fetch_candles_plan(large_dataset):
+    start = dt.datetime(2020, 6, 1, tzinfo=dt.timezone.utc)
+    with CaptureQueriesContext(connection) as ctx:
+        candles = list(
+            fetch_candles(large_dataset[0], start, start + dt.timedelta(days=30))
+        )
+    assert len(candles) == 30
+    assert len(ctx.captured_queries) == 1
+    (plan,) = _assert_no_full_scans(ctx.captured_queries, CANDLE_TABLES)
+    assert "dydx_candle_end_idx" in plan
+
+
+def test_coingecko_ohlc_plan(large_dataset):
+    date = dt.datetime(2020, 1, 2, tzinfo=dt.timezone.utc)
+    with CaptureQueriesContext(connection) as ctx:
+        assert CoingeckoInstrumentOHLC.objects.filter(
+            instrument=large_dataset[0], date=date
+        ).exists()
+    (plan,) = _assert_no_full_scans(ctx.captured_queries, CANDLE_TABLES)
+    # sqlite names the index of a unique constraint itself
+    assert re.search("unique_coingecko_ohlc|sqlite_autoindex", plan)
+
+
+def test_price_store_plan(large_dataset):
+    instrument_ids = [instrument.id for instrument in large_dataset]
+    store = PriceStore(max_points=10**7, max_age=0)
+    with CaptureQueriesContext(connection) as ctx:
+        series = store.get_many(instrument_ids, "1HOUR")
+        # Stale, so the latest candles are queried again
+        store.get_many(instrument_ids, "1HOUR")
+    assert all(len(series[i]) == 300 for i in instrument_ids)
+    # One query to load every series, one to refresh them
+    assert len(ctx.captured_queries) == 2
+    _assert_no_full_scans(ctx.captured_queries, CANDLE_TABLES)
+
+
+def test_sync_queries_plan(large_dataset):
+    now = dt.datetime(2020, 1, 25, tzinfo=dt.timezone.utc)
+    with CaptureQueriesContext(connection) as ctx:
+        sync_starts = sync.get_candle_sync_starts(large_dataset, "1HOUR", now)
+    assert len(sync_starts) == len(large_dataset)
+    assert len(ctx.captured_queries) == 2
+    _assert_no_full_scans(ctx.captured_queries, CANDLE_TABLES)
+
+    candles = list(
+        DydxCandle.objects.filter(resolution="1HOUR", instrument__in=large_dataset[:5])
+    )
+    with CaptureQueriesContext(connection) as ctx:
+        sync.upsert_dydx_candles(candles)
+    # A count per (instrument, resolution) batch, then its insert, which sqlite splits
+    # into statements of at most 999 parameters
+    selects = [q for q in ctx.captured_queries if q["sql"].startswith("SELECT")]
+    assert len(selects) == 5
+    _assert_no_full_scans(ctx.captured_queries, CANDLE_TABLES)
+
+
+def test_evaluate_trades_plan(large_dataset):
+    base, *instruments = large_dataset
+    date = dt.datetime(2020, 10, 1)
+    with CaptureQueriesContext(connection) as ctx:
+        results = evaluate_trades(instruments, base, date)
+    assert not any(result["error"] for result in results.values())
+    # Constant in the number of instruments
+    assert len(ctx.captured_queries) <= 6
+    _assert_no_full_scans(ctx.captured_queries, CANDLE_TABLES)
+
+    params = StrategyParams(resolution="1HOUR")
+    with CaptureQueriesContext(connection) as ctx:
+        for instrument in instruments[:3]:
+            evaluate_trade(instrument, base, date, params)
+    _assert_no_full_scans(ctx.captured_queries, CANDLE_TABLES)
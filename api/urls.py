@@ -7,6 +7,7 @@ router = DefaultRouter()
 
 router.register(r"instruments", views.InstrumentViewSet)
 router.register(r"instruments", views.InstrumentViewSet)
+router.register(r"evaluation-results", views.EvaluationResultViewSet)
 
 urlpatterns = [
     path("check/", views.investment_check, name="create"),
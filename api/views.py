@@ -2,6 +2,7 @@ import rest_framework as rf
 from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import redirect, render
 from django.urls import reverse
+from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.viewsets import GenericViewSet
 
 from api import models, serializers
@@ -23,6 +24,33 @@ class InstrumentViewSet(
     permission_classes = [rf.permissions.IsAdminUser]
 
 
+class EvaluationResultViewSet(
+    rf.mixins.RetrieveModelMixin,
+    rf.mixins.ListModelMixin,
+    GenericViewSet,
+):
+    """
+    The evaluation results of the trade runs, newest first, e.g.
+    ?instrument__symbol=DOGE&corr_30d__gte=0.5&limit=1 for the last time DOGE passed
+    the 30 day correlation filter
+    """
+
+    queryset = models.EvaluationResult.objects.select_related(
+        "instrument", "base_instrument"
+    ).order_by("-date", "instrument_id")
+    serializer_class = serializers.EvaluationResultSerializer
+    permission_classes = [rf.permissions.IsAdminUser]
+    pagination_class = LimitOffsetPagination
+    filterset_fields = {
+        "instrument__symbol": ["exact"],
+        "sync_history": ["exact"],
+        "date": ["gte", "lt"],
+        "corr_30d": ["gte", "lt"],
+        "open_position": ["exact"],
+        "error": ["exact"],
+    }
+
+
 @staff_member_required
 def investment_check(request):
     if request.method == "POST":
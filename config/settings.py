@@ -6,6 +6,7 @@ import dj_database_url
 import dotenv
 import matplotlib
 import structlog
+from celery.schedules import crontab
 
 matplotlib.use("agg")
 
@@ -267,6 +268,53 @@ CSRF_TRUSTED_ORIGINS = ["https://*.127.0.0.1"]
 CELERY_BROKER_URL = REDIS_URL
 CELERY_RESULT_BACKEND = REDIS_URL
 
+# The Django cache holds what the processes share, e.g. the live prices and the rate
+# limits of the APIs, so every celery worker must use the same one
+if REDIS_URL and not DEBUG:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+
+
+def _crontab(expression: str) -> crontab:
+    """A celery crontab from a "minute hour day_of_month month day_of_week" string"""
+    minute, hour, day_of_month, month_of_year, day_of_week = expression.split()
+    return crontab(
+        minute=minute,
+        hour=hour,
+        day_of_month=day_of_month,
+        month_of_year=month_of_year,
+        day_of_week=day_of_week,
+    )
+
+
+# Run by `celery -A config beat`, see api.tasks
+CELERY_BEAT_SCHEDULE = {
+    "trading-pipeline": {
+        "task": "api.tasks.run_trading_pipeline",
+        "schedule": _crontab(os.getenv("TRADING_PIPELINE_CRON", "5 0 * * *")),
+    },
+    "retention": {
+        "task": "api.tasks.apply_retention_task",
+        "schedule": _crontab(os.getenv("RETENTION_CRON", "30 1 * * *")),
+    },
+}
+# Seconds each stage of the trading pipeline may run before it is stopped
+PIPELINE_SYNC_TIME_LIMIT_SECONDS = int(
+    os.getenv("PIPELINE_SYNC_TIME_LIMIT_SECONDS", "120")
+)
+PIPELINE_EVALUATE_TIME_LIMIT_SECONDS = int(
+    os.getenv("PIPELINE_EVALUATE_TIME_LIMIT_SECONDS", "300")
+)
+PIPELINE_ORDER_TIME_LIMIT_SECONDS = int(
+    os.getenv("PIPELINE_ORDER_TIME_LIMIT_SECONDS", "120")
+)
+# Retries of the sync and evaluation stages, with an exponential backoff
+PIPELINE_MAX_RETRIES = int(os.getenv("PIPELINE_MAX_RETRIES", "3"))
+
 
 # # Set up for django-admin-charts
 # # https://github.com/PetrDlouhy/django-admin-charts#installation
@@ -285,3 +333,69 @@ EXPLORER_CHARTS_ENABLED = True
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap4"
 
 CRISPY_TEMPLATE_PACK = "bootstrap4"
+
+# dYdX sync
+# The API the trader talks to, e.g. a local api.services.fake_dydx exchange
+DYDX_API_HOST = os.getenv("DYDX_API_HOST", "https://api.dydx.exchange")
+# Candle resolutions fetched from dydx on every sync
+DYDX_CANDLE_RESOLUTIONS = os.getenv("DYDX_CANDLE_RESOLUTIONS", "1DAY").split(",")
+# Coarser resolutions derived from the fetched ones instead of fetched, as
+# target:source pairs, e.g. "5MINS:1MIN,1HOUR:5MINS"
+DYDX_CANDLE_ROLLUPS = dict(
+    rollup.split(":")
+    for rollup in os.getenv("DYDX_CANDLE_ROLLUPS", "").split(",")
+    if rollup
+)
+DYDX_CANDLE_FETCH_CONCURRENCY = int(os.getenv("DYDX_CANDLE_FETCH_CONCURRENCY", "8"))
+DYDX_REQUESTS_PER_SECOND = float(os.getenv("DYDX_REQUESTS_PER_SECOND", "10"))
+# How open_position places the two orders of a pair trade: "sequential" waits for
+# the short to fill before longing base, "concurrent" submits both at once
+PAIR_TRADE_EXECUTION = os.getenv("PAIR_TRADE_EXECUTION", "sequential")
+# Seconds before the markets, and their index prices, are downloaded again
+DYDX_MARKETS_TTL_SECONDS = float(os.getenv("DYDX_MARKETS_TTL_SECONDS", "30"))
+# Seconds before the account (position id, equity, open positions) is downloaded again
+DYDX_ACCOUNT_TTL_SECONDS = float(os.getenv("DYDX_ACCOUNT_TTL_SECONDS", "60"))
+
+# Coingecko OHLC sync, see api.services.coingecko
+COINGECKO_API_URL = os.getenv("COINGECKO_API_URL", "https://api.coingecko.com/api/v3")
+# The public API allows 10-30 calls a minute
+COINGECKO_REQUESTS_PER_SECOND = float(
+    os.getenv("COINGECKO_REQUESTS_PER_SECOND", "0.25")
+)
+COINGECKO_FETCH_CONCURRENCY = int(os.getenv("COINGECKO_FETCH_CONCURRENCY", "4"))
+# Attempts per request when coingecko answers 429 or a server error
+COINGECKO_MAX_ATTEMPTS = int(os.getenv("COINGECKO_MAX_ATTEMPTS", "5"))
+
+# Market data websocket, see api.services.market_data
+DYDX_WS_URL = os.getenv("DYDX_WS_URL", "wss://api.dydx.exchange/v3/ws")
+# Resolutions of the bars the ingestion worker builds from trades
+MARKET_DATA_RESOLUTIONS = os.getenv("MARKET_DATA_RESOLUTIONS", "1MIN").split(",")
+# Seconds between writes of completed bars, and of the live prices to the cache
+MARKET_DATA_FLUSH_SECONDS = float(os.getenv("MARKET_DATA_FLUSH_SECONDS", "5"))
+# Live prices older than this are ignored, and the REST prices are used instead
+LIVE_PRICE_MAX_AGE_SECONDS = float(os.getenv("LIVE_PRICE_MAX_AGE_SECONDS", "60"))
+
+# Retention, see api.services.retention. Candles of each resolution are kept for
+# this many days, as resolution:days pairs, e.g. "1MIN:30,1HOUR:730". Before they are
+# deleted, they are downsampled into the DYDX_CANDLE_ROLLUPS resolutions made from them.
+DYDX_CANDLE_RETENTION_DAYS = {
+    resolution: int(days)
+    for resolution, days in (
+        policy.split(":")
+        for policy in os.getenv("DYDX_CANDLE_RETENTION_DAYS", "").split(",")
+        if policy
+    )
+}
+# Days of coingecko OHLC and sync history to keep, 0 keeps everything
+COINGECKO_OHLC_RETENTION_DAYS = int(os.getenv("COINGECKO_OHLC_RETENTION_DAYS", "0"))
+SYNC_HISTORY_RETENTION_DAYS = int(os.getenv("SYNC_HISTORY_RETENTION_DAYS", "0"))
+# Rows deleted per statement, so no delete holds its locks for long
+RETENTION_DELETE_CHUNK_SIZE = int(os.getenv("RETENTION_DELETE_CHUNK_SIZE", "5000"))
+
+# In-process cache of candle closes, see api.services.price_store
+PRICE_STORE_MAX_POINTS = int(os.getenv("PRICE_STORE_MAX_POINTS", "2000000"))
+PRICE_STORE_MAX_AGE_SECONDS = float(os.getenv("PRICE_STORE_MAX_AGE_SECONDS", "60"))
+
+# Directory of the memory-mapped candle cache for research and backtests, see
+# api.services.candle_cache. It is refreshed after each sync when set.
+CANDLE_CACHE_DIR = os.getenv("CANDLE_CACHE_DIR", "")
@@ -0,0 +1,54 @@
+"""
+Runs the backtest on a synthetic universe of random walks, 500 markets over 5 years of
+daily candles by default.
+
+    python -m scripts.bench_backtest [num_markets] [num_days]
+"""
+import os
+import sys
+
+import django
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "config.settings"
+django.setup()
+
+import numpy as np
+import pandas as pd
+
+from api.services.backtest import run_backtest
+
+
+def make_universe(num_markets: int, num_days: int) -> tuple[pd.DataFrame, pd.Series]:
+    rng = np.random.default_rng(0)
+    index = pd.date_range("2018-01-01", periods=num_days, freq="1D", tz="UTC")
+    base_log = np.log(1000) + np.cumsum(rng.normal(0, 0.04, num_days))
+    # Markets follow base with their own noise, like most of the altcoins
+    betas = rng.uniform(0.5, 1.5, num_markets)
+    noise = np.cumsum(rng.normal(0, 0.03, (num_days, num_markets)), axis=0)
+    closes = np.exp(betas * base_log[:, None] + noise - (betas - 1) * np.log(1000))
+    # Markets are listed over time
+    listed = rng.integers(0, num_days // 2, num_markets)
+    closes[np.arange(num_days)[:, None] < listed] = np.nan
+
+    return (
+        pd.DataFrame(
+            closes, index=index, columns=["M{}".format(i) for i in range(num_markets)]
+        ),
+        pd.Series(np.exp(base_log), index=index),
+    )
+
+
+def main() -> None:
+    num_markets = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    num_days = int(sys.argv[2]) if len(sys.argv) > 2 else 5 * 365
+    closes, base = make_universe(num_markets, num_days)
+
+    result = run_backtest(closes, base)
+
+    print("{} markets x {} days".format(num_markets, num_days))
+    for key, value in result.summary().items():
+        print("{:>16}: {}".format(key, value))
+
+
+if __name__ == "__main__":
+    main()
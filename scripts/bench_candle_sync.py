@@ -0,0 +1,70 @@
+"""
+Shows how the number of queries and the runtime of the candle upsert scale with the
+number of candles. Everything is written inside a transaction that is rolled back.
+
+    python -m scripts.bench_candle_sync
+"""
+import datetime as dt
+import os
+import time
+
+import django
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "config.settings"
+django.setup()
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api import models
+from api.services.sync import upsert_dydx_candles
+
+CANDLE_COUNTS = [10, 100, 1_000, 10_000]
+
+
+class Rollback(Exception):
+    pass
+
+
+def make_candles(instrument: models.Instrument, n: int) -> list[models.DydxCandle]:
+    start = timezone.make_aware(dt.datetime(2000, 1, 1), timezone.utc)
+    return [
+        models.DydxCandle(
+            instrument=instrument,
+            period_start=start + dt.timedelta(days=i),
+            period_end=start + dt.timedelta(days=i + 1),
+            resolution="1DAY",
+            open=1,
+            high=1,
+            low=1,
+            close=1,
+        )
+        for i in range(n)
+    ]
+
+
+def bench(n: int) -> None:
+    try:
+        with transaction.atomic():
+            instrument = models.Instrument.objects.create(
+                symbol="BENCH", name="BENCH", dydx_market_id="BENCH-USD"
+            )
+            for label in ["insert", "update"]:
+                candles = make_candles(instrument, n)
+                with CaptureQueriesContext(connection) as ctx:
+                    t0 = time.perf_counter()
+                    upsert_dydx_candles(candles)
+                    elapsed = time.perf_counter() - t0
+                print(
+                    f"{n:>8} candles {label:>6}: {len(ctx.captured_queries):>4} queries, "
+                    f"{elapsed:.3f}s, {n / elapsed:,.0f} rows/s"
+                )
+            raise Rollback()
+    except Rollback:
+        pass
+
+
+if __name__ == "__main__":
+    for n in CANDLE_COUNTS:
+        bench(n)
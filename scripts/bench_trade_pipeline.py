@@ -0,0 +1,92 @@
+"""
+Runs the sync and trade pipeline end to end against a local fake dydx exchange, and
+reports how long each stage takes. Everything is written inside a transaction that is
+rolled back.
+
+    python -m scripts.bench_trade_pipeline [num_markets] [latency_seconds]
+"""
+import os
+import sys
+import time
+
+import django
+
+os.environ["DJANGO_SETTINGS_MODULE"] = "config.settings"
+django.setup()
+
+from django.conf import settings
+from django.db import transaction
+from eth_account import Account
+
+from api import models
+from api.services import dydx_trader, positions
+from api.services.fake_dydx import FakeDydxExchange
+from api.services.sync import BASE_SYMBOL, sync_dydx_candles, sync_dydx_instruments
+
+
+class Rollback(Exception):
+    pass
+
+
+def timed(label: str, func, *args):
+    t0 = time.perf_counter()
+    result = func(*args)
+    print("{:>32}: {:.3f}s".format(label, time.perf_counter() - t0))
+    return result
+
+
+def main() -> None:
+    num_markets = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+    eth_private_key = "0x" + "11" * 32
+    exchange = FakeDydxExchange(num_markets=num_markets, latency=latency).start()
+    settings.DYDX_API_HOST = exchange.host
+    os.environ.update(
+        {
+            "ETH_PRIVATE_KEY": eth_private_key,
+            "ETH_PUBLIC_KEY": Account.from_key(eth_private_key).address,
+            "WEB3_PROVIDER_URL": exchange.host,
+            "STARK_PRIVATE_KEY": "0x" + "1" * 60,
+            "DYDX_API_KEY": "key",
+            "DYDX_API_SECRET": "c2VjcmV0",
+            "DYDX_API_PASSPHRASE": "passphrase",
+        }
+    )
+    dydx_trader.reset_trader()
+    print("{} markets, {}s latency per request".format(num_markets, latency))
+
+    try:
+        with transaction.atomic():
+            models.Instrument.objects.all().delete()
+            timed("sync_dydx_instruments", sync_dydx_instruments)
+            timed("sync_dydx_candles", sync_dydx_candles)
+
+            base = models.Instrument.objects.get(symbol=BASE_SYMBOL)
+            instr = models.Instrument.objects.exclude(id=base.id).first()
+            for execution in ["sequential", "concurrent"]:
+                settings.PAIR_TRADE_EXECUTION = execution
+                pos = timed(
+                    "open_position ({})".format(execution),
+                    positions.open_position,
+                    instr,
+                    base,
+                )
+                print(
+                    "{:>32}: {:.3f}s".format(
+                        "leg to leg", pos.extra_data["leg_latency_seconds"]
+                    )
+                )
+            raise Rollback()
+    except Rollback:
+        pass
+    finally:
+        exchange.stop()
+
+    print("Requests:")
+    for endpoint, count in sorted(exchange.requests.items()):
+        print("{:>32}: {}".format(endpoint, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,9 @@ import django
 os.environ["DJANGO_SETTINGS_MODULE"] = "config.settings"
 django.setup()
 
-from api.services.sync import do_trades, sync_dydx_candles
+from api.tasks import run_trading_pipeline
 
 if __name__ == "__main__":
-    sync_dydx_candles()
-    do_trades()
+    # Celery beat queues the pipeline on TRADING_PIPELINE_CRON, this queues one run
+    # by hand
+    run_trading_pipeline.delay()